@@ -0,0 +1,47 @@
+"""
+Purpose: Compare the captcha rendering throughput of ImageCaptcha (which draws each
+image from the fonts) with GlyphAtlasCaptcha (which composes each image from glyphs
+pre-rendered once), and report how long building the atlas takes.  Both render the
+same kind of secrets as ChallengeStore and encode them as PNG.
+
+Usage (from the repository root, with the application environment variables set and
+numpy installed):
+  python -m benchmarks.captcha_render_benchmark [--images N] [--variants N]
+"""
+import argparse
+import time
+from captcha.image import ImageCaptcha
+from kq_api.captcha_renderer import GlyphAtlasCaptcha
+from kq_api.challenge_store import SECRET_ALPHABET, generate_challenge
+
+def images_per_second(renderer, secrets):
+  #warm up (fonts)
+  renderer.generate(secrets[0]).getvalue()
+  start = time.perf_counter()
+  for secret in secrets:
+    renderer.generate(secret).getvalue()
+  return len(secrets) / (time.perf_counter() - start)
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--images", type=int, default=500)
+  parser.add_argument("--variants", type=int, default=32)
+  args = parser.parse_args()
+
+  secrets = [generate_challenge()["secret"] for _ in range(args.images)]
+
+  atlas_captcha = GlyphAtlasCaptcha(SECRET_ALPHABET, variants=args.variants)
+  start = time.perf_counter()
+  atlas_captcha.atlas
+  print("atlas: {} characters x {} variants, built in {:.2f} s".format(len(SECRET_ALPHABET), args.variants, time.perf_counter() - start))
+
+  print("images: {}".format(args.images))
+  results = []
+  for name, renderer in [("ImageCaptcha", ImageCaptcha()), ("GlyphAtlasCaptcha", atlas_captcha)]:
+    rate = images_per_second(renderer, secrets)
+    results.append(rate)
+    print("{:<18} {:>8.0f} images/s  ({:.2f} ms per image)".format(name, rate, 1000 / rate))
+  print("atlas vs ImageCaptcha: {:.1f}x".format(results[1] / results[0]))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,58 @@
+"""
+Purpose: Compare the throughput of the captcha challenge flow (create a challenge,
+then check the user's answer) with challenges stored in Redis (ChallengeStore)
+against self-contained challenge tokens (TokenChallengeStore), which only write to
+Redis once, when an answer is accepted.  Optionally the captcha image is rendered
+too, as in the real flow (GET /challenge/<id>.png), although rendering then
+dominates the time.
+
+Usage (from the repository root, with a Redis server running and the application
+environment variables set):
+  python -m benchmarks.challenge_flow_benchmark [--redis-url URL] [--flows N] [--with-images]
+"""
+import argparse
+import time
+from flask import Flask
+from kq_api import settings
+from kq_api.challenge_store import ChallengeStore, TokenChallengeStore
+from kq_api.storage import InProcessBackend
+
+def run_flow(challenge_store, render_image):
+  challenge = challenge_store.new_challenge()
+  if render_image:
+    challenge_store.challenge_id_to_captcha(challenge["challenge_id"])
+  assert challenge_store.is_valid(challenge["challenge_id"], challenge["secret"])
+
+def flows_per_second(challenge_store, flows, render_image):
+  #warm up (connections, fonts)
+  run_flow(challenge_store, render_image)
+  start = time.perf_counter()
+  for _ in range(flows):
+    run_flow(challenge_store, render_image)
+  return flows / (time.perf_counter() - start)
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--redis-url", default=settings.CAPTCHA_STORE_URL)
+  parser.add_argument("--flows", type=int, default=2000)
+  parser.add_argument("--with-images", action="store_true")
+  args = parser.parse_args()
+
+  app = Flask(__name__)
+  ttl_seconds = 300
+  stores = [
+    ("stored in Redis", ChallengeStore(app, db_url=args.redis_url, default_ttl_seconds=ttl_seconds)),
+    ("stored in memory", ChallengeStore(app, default_ttl_seconds=ttl_seconds, backend=InProcessBackend("benchmark"))),
+    ("token", TokenChallengeStore(app, db_url=args.redis_url, default_ttl_seconds=ttl_seconds, server_key="benchmark-key"))
+  ]
+
+  print("flows: {}, images: {}".format(args.flows, "yes" if args.with_images else "no"))
+  results = []
+  for name, challenge_store in stores:
+    rate = flows_per_second(challenge_store, args.flows, args.with_images)
+    results.append(rate)
+    print("{:<18} {:>10.0f} flows/s  ({:.3f} ms per flow)".format(name, rate, 1000 / rate))
+  print("token vs Redis:    {:.1f}x".format(results[2] / results[0]))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,133 @@
+"""
+Purpose: Compare the CPU time spent encoding and decoding JSON per API key request
+with the json module and with orjson (see the JSON_CODEC setting).  The JSON work of
+each endpoint is replayed on a realistic request (req_data) with a description of
+--description-words words:
+
+- POST /request_key: parse the body, save the request, encode the response
+- GET /verify_key_request: load the request, save it again
+- GET /status: load the request, encode the status
+
+The same steps are also timed through Flask (request.get_json() and jsonify() in a
+request context), with and without the codec installed in the application.
+
+Usage (from the repository root, with orjson installed):
+  python -m benchmarks.json_codec_benchmark [--iterations N] [--description-words N]
+"""
+import argparse
+import random
+import timeit
+from flask import Flask, jsonify, request
+from kq_api import json_codec
+from kq_api.key_requests import STATUS_KEY, SUBMITTED_AT_KEY
+
+WORDS = ["data", "catalogue", "service", "layer", "map", "province", "records",
+  "application", "public", "search", "feature", "boundary", "water", "road", "open",
+  "québec", "données"]
+
+def make_req_data(description_words):
+  description = " ".join(random.choice(WORDS) for _ in range(description_words))
+  contact = {
+    "name": "Pat Example",
+    "business_email": "pat.example@gov.bc.ca",
+    "business_phone": "250-555-0100",
+    "role": "pointOfContact",
+    "private": "Display",
+    "org_id": "d5316a1b-2646-4c19-9671-c12231c4ec8b",
+    "sub_org_id": "c1222ef5-5013-4d9a-a4a1-6fa0a5c8b7d2"
+  }
+  return {
+    "api": {"title": "BC Geographic Warehouse Web Map Service"},
+    "app": {
+      "title": "Regional water quality viewer",
+      "description": description,
+      "url": "https://apps.example.gov.bc.ca/water-quality",
+      "status": "completed",
+      "group": {"id": None},
+      "security": {
+        "download_audience": "Public",
+        "view_audience": "Public",
+        "metadata_visibility": "Public",
+        "security_class": "LOW-PUBLIC"
+      },
+      "owner": {"org_id": contact["org_id"], "sub_org_id": contact["sub_org_id"], "contact_person": dict(contact)}
+    },
+    "submitted_by_person": dict(contact, name="Sam Example", business_email="sam.example@gov.bc.ca"),
+    "challenge": {"id": "1f0c6e0e-6f8e-4b5e-9a39-2b8f3f1f7e3c", "secret": "x7k2p"},
+    "validated": {
+      "owner_org_name": "Ministry of Environment and Climate Change Strategy",
+      "owner_sub_org_name": "Water Protection & Sustainability Branch",
+      "submitted_by_person_org_name": "Ministry of Environment and Climate Change Strategy",
+      "submitted_by_person_sub_org_name": "Knowledge Management Branch"
+    },
+    STATUS_KEY: {
+      "state": "verified",
+      "new_metadata_record": {
+        "package_id": "0b3c7f3e-4d5a-4c48-9e4f-1d2b3c4d5e6f",
+        "metadata_web_url": "https://catalogue.data.gov.bc.ca/dataset/0b3c7f3e-4d5a-4c48-9e4f-1d2b3c4d5e6f",
+        "metadata_api_url": "https://catalogue.data.gov.bc.ca/api/3/action/package_show?id=0b3c7f3e-4d5a-4c48-9e4f-1d2b3c4d5e6f"
+      }
+    },
+    SUBMITTED_AT_KEY: 1760000000
+  }
+
+def endpoint_steps(codec, req_data):
+  """
+  The JSON work of each endpoint, as functions
+  """
+  body = json_codec.StdlibCodec().dumps_bytes(req_data)
+  stored = codec.dumps(req_data)
+  return {
+    "request_key": lambda: (codec.loads(body), codec.dumps(req_data), codec.dumps({"verification_code": "9b0e2f1c-1c8b-4f43-a7d6-3f1f6b0e2d4a"})),
+    "verify_key_request": lambda: (codec.loads(stored), codec.dumps(req_data)),
+    "status": lambda: codec.dumps(codec.loads(stored)[STATUS_KEY])
+  }
+
+def flask_round_trip(app, body):
+  """
+  Parses a request body and encodes the status, as request_key and get_status do
+  """
+  with app.test_request_context("/request_key", method="POST", data=body, content_type="application/json"):
+    req_data = request.get_json()
+    jsonify(req_data[STATUS_KEY]).get_data()
+
+def time_per_call(fn, iterations):
+  return timeit.timeit(fn, number=iterations) / iterations
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--iterations", type=int, default=2000)
+  parser.add_argument("--description-words", type=int, default=300)
+  args = parser.parse_args()
+
+  if json_codec.orjson is None:
+    parser.error("orjson is not installed")
+
+  req_data = make_req_data(args.description_words)
+  body = json_codec.StdlibCodec().dumps_bytes(req_data)
+  codecs = [json_codec.StdlibCodec(), json_codec.OrjsonCodec()]
+  assert codecs[0].loads(codecs[1].dumps(req_data)) == codecs[1].loads(codecs[0].dumps(req_data)) == req_data
+
+  print("request body: {} bytes\n".format(len(body)))
+  print("{:<22}  {:>10}  {:>10}  {:>8}".format("endpoint (us/request)", "json", "orjson", "speedup"))
+  steps = [endpoint_steps(codec, req_data) for codec in codecs]
+  total = [0, 0]
+  for name in steps[0]:
+    times = [time_per_call(s[name], args.iterations) for s in steps]
+    total = [t + times[i] for i, t in enumerate(total)]
+    print("{:<22}  {:>10.1f}  {:>10.1f}  {:>7.1f}x".format(name, times[0] * 1e6, times[1] * 1e6, times[0] / times[1]))
+  print("{:<22}  {:>10.1f}  {:>10.1f}  {:>7.1f}x".format("all three", total[0] * 1e6, total[1] * 1e6, total[0] / total[1]))
+
+  default_app = Flask("default")
+  codec_app = Flask("codec")
+  json_codec.codec = codecs[1]
+  json_codec.install(codec_app)
+  default_time = time_per_call(lambda: flask_round_trip(default_app, body), args.iterations)
+  codec_time = time_per_call(lambda: flask_round_trip(codec_app, body), args.iterations)
+  print("\nFlask get_json() + jsonify(), including the request context:")
+  print("  default provider:     {:.1f} us".format(default_time * 1e6))
+  print("  orjson provider:      {:.1f} us".format(codec_time * 1e6))
+  print("  CPU saved:            {:.1f} us per request".format((default_time - codec_time) * 1e6))
+
+if __name__ == "__main__":
+  main()
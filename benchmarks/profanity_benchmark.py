@@ -0,0 +1,61 @@
+"""
+Purpose: Compare the time taken to check an API key request for profanity using
+ProfanityFilter.is_profane once per field (the previous approach) against a single
+scan with ProfanityMatcher.
+
+Usage (from the repository root):
+  python -m benchmarks.profanity_benchmark [--iterations N] [--description-words N]
+"""
+import argparse
+import random
+import timeit
+from profanityfilter import ProfanityFilter
+from kq_api.profanity import ProfanityMatcher, FREE_TEXT_FIELDS, get_path
+
+WORDS = ["data", "catalogue", "service", "layer", "map", "province", "records",
+  "application", "public", "search", "feature", "boundary", "water", "road", "open"]
+
+def make_req_data(description_words):
+  description = " ".join(random.choice(WORDS) for _ in range(description_words))
+  return {
+    "api": {"title": "BC Geographic Warehouse Web Map Service"},
+    "app": {
+      "title": "Regional water quality viewer",
+      "description": description,
+      "owner": {"contact_person": {"name": "Pat Example"}}
+    },
+    "submitted_by_person": {"name": "Sam Example", "org_name": "Example Consulting"}
+  }
+
+def check_per_field(profanity_filter, req_data):
+  for path, label in FREE_TEXT_FIELDS:
+    value = get_path(req_data, path)
+    if value and profanity_filter.is_profane(value):
+      return path
+  return None
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--iterations", type=int, default=20)
+  parser.add_argument("--description-words", type=int, default=2000)
+  args = parser.parse_args()
+
+  profanity_filter = ProfanityFilter()
+  setup_time = timeit.timeit(lambda: ProfanityMatcher.from_profanity_filter(profanity_filter), number=1)
+  matcher = ProfanityMatcher.from_profanity_filter(profanity_filter)
+  req_data = make_req_data(args.description_words)
+
+  assert check_per_field(profanity_filter, req_data) is None
+  assert matcher.find_profane_field(req_data) is None
+
+  per_field = timeit.timeit(lambda: check_per_field(profanity_filter, req_data), number=args.iterations) / args.iterations
+  single_pass = timeit.timeit(lambda: matcher.find_profane_field(req_data), number=args.iterations) / args.iterations
+
+  print("description length:           {} chars".format(len(req_data["app"]["description"])))
+  print("ProfanityMatcher compile:     {:.2f} ms (once per process)".format(setup_time * 1000))
+  print("ProfanityFilter, per field:   {:.3f} ms per request".format(per_field * 1000))
+  print("ProfanityMatcher, one pass:   {:.3f} ms per request".format(single_pass * 1000))
+  print("speedup:                      {:.1f}x".format(per_field / single_pass))
+
+if __name__ == "__main__":
+  main()
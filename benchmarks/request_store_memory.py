@@ -0,0 +1,90 @@
+"""
+Purpose: Report the memory used by the key request store before and after verified
+requests are compacted to status-only records (RequestStore.compact_request).
+Saves --requests realistic API key requests (as POST /request_key does), then
+compacts them (as GET /verify_key_request does), and reports after each step:
+
+- the size of the stored values
+- the memory Redis reports for one record (MEMORY USAGE) and the growth of the
+  server's used_memory, per request
+- how long each record is kept (the TTL)
+
+The records are deleted at the end.  Use an empty database: used_memory is for the
+whole server, so other activity skews the per-request figure.
+
+Usage (from the repository root, with a Redis server running and the application
+environment variables set):
+  python -m benchmarks.request_store_memory [--redis-url URL] [--requests N]
+"""
+import argparse
+import uuid
+import redis
+from flask import Flask
+from kq_api import settings
+from kq_api.request_store import RequestStore
+from .json_codec_benchmark import make_req_data
+
+def measure(client, codes):
+  """
+  The total size of the values, the MEMORY USAGE of the first key, its TTL and the
+  server's used_memory
+  """
+  pipe = client.pipeline()
+  for code in codes:
+    pipe.strlen(code)
+  value_bytes = sum(pipe.execute())
+  try:
+    key_bytes = client.execute_command("MEMORY", "USAGE", codes[0])
+  except redis.exceptions.ResponseError:
+    #MEMORY USAGE is new in Redis 4
+    key_bytes = None
+  return {
+    "value_bytes": value_bytes,
+    "key_bytes": key_bytes,
+    "ttl_seconds": client.ttl(codes[0]),
+    "used_memory": client.info("memory")["used_memory"]
+  }
+
+def print_row(label, m, baseline, count):
+  print("{:<22}  {:>12.0f}  {:>12}  {:>14.0f}  {:>10}".format(
+    label,
+    m["value_bytes"] / float(count),
+    m["key_bytes"] if m["key_bytes"] is not None else "n/a",
+    (m["used_memory"] - baseline) / float(count),
+    m["ttl_seconds"]))
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--redis-url", default=settings.KQ_STORE_URL)
+  parser.add_argument("--requests", type=int, default=10000)
+  parser.add_argument("--description-words", type=int, default=300)
+  args = parser.parse_args()
+
+  app = Flask(__name__)
+  store = RequestStore(app, db_url=args.redis_url, default_ttl_seconds=int(settings.KQ_STORE_TTL_SECONDS), status_ttl_seconds=settings.STATUS_TTL_SECONDS)
+  client = redis.StrictRedis.from_url(args.redis_url)
+  req_data = make_req_data(args.description_words)
+
+  baseline = client.info("memory")["used_memory"]
+  codes = [str(uuid.uuid4()) for _ in range(args.requests)]
+  try:
+    for code in codes:
+      store.save_request(req_data, verification_code=code)
+    saved = measure(client, codes)
+    for code in codes:
+      store.compact_request(req_data, code)
+    compacted = measure(client, codes)
+  finally:
+    for i in range(0, len(codes), 1000):
+      client.delete(*codes[i:i + 1000])
+
+  print("requests: {}\n".format(args.requests))
+  print("{:<22}  {:>12}  {:>12}  {:>14}  {:>10}".format("per request", "value bytes", "MEMORY USAGE", "used_memory", "TTL (s)"))
+  print_row("awaiting verification", saved, baseline, args.requests)
+  print_row("verified (compacted)", compacted, baseline, args.requests)
+  print("\nmemory held per verified request: {:.0f}% of the full record, for {:.0f}% as long".format(
+    100.0 * (compacted["used_memory"] - baseline) / max(saved["used_memory"] - baseline, 1),
+    100.0 * compacted["ttl_seconds"] / max(saved["ttl_seconds"], 1)))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,132 @@
+"""
+Purpose: Compare the Flask application (gunicorn + gevent) with the ASGI application
+(uvicorn) under the same load.  For each server, N concurrent connections repeatedly
+request the same path for a fixed duration.  The script reports throughput, latency,
+and the growth in resident memory (RSS) of the server process tree while the
+requests are in flight, divided by the number of concurrent requests.
+
+Start both servers first, for example:
+  gunicorn -k gevent -w 1 -b :8000 kq_api.main:app
+  uvicorn kq_api.asgi:app --port 8001
+
+Then, from the repository root (Linux only, RSS is read from /proc):
+  python -m benchmarks.server_concurrency_benchmark \\
+    --target flask=http://localhost:8000@<gunicorn master pid> \\
+    --target asgi=http://localhost:8001@<uvicorn pid> \\
+    --concurrency 500 --duration 30
+
+Requires httpx (see requirements-asgi.txt).
+"""
+import argparse
+import asyncio
+import os
+import time
+import httpx
+
+def rss_bytes(pid):
+  """
+  The total resident memory of a process and all its descendants
+  """
+  total = 0
+  for p in [pid] + descendants(pid):
+    try:
+      with open("/proc/{}/status".format(p)) as f:
+        for line in f:
+          if line.startswith("VmRSS:"):
+            total += int(line.split()[1]) * 1024
+    except IOError:
+      pass
+  return total
+
+def descendants(pid):
+  children = []
+  try:
+    with open("/proc/{}/task/{}/children".format(pid, pid)) as f:
+      children = [int(c) for c in f.read().split()]
+  except IOError:
+    pass
+  result = list(children)
+  for child in children:
+    result.extend(descendants(child))
+  return result
+
+async def run_target(name, base_url, pid, path, concurrency, duration):
+  latencies = []
+  errors = [0]
+  in_flight = [0]
+  peak_in_flight = [0]
+  peak_rss = [0]
+  deadline = time.monotonic() + duration
+
+  limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+  async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+    #warm up, then measure idle memory
+    await client.get(path)
+    await asyncio.sleep(1)
+    idle_rss = rss_bytes(pid)
+
+    async def worker():
+      while time.monotonic() < deadline:
+        in_flight[0] += 1
+        peak_in_flight[0] = max(peak_in_flight[0], in_flight[0])
+        start = time.monotonic()
+        try:
+          r = await client.get(path)
+          if r.status_code >= 500:
+            errors[0] += 1
+        except httpx.HTTPError:
+          errors[0] += 1
+        finally:
+          in_flight[0] -= 1
+        latencies.append(time.monotonic() - start)
+
+    async def sample_memory():
+      while time.monotonic() < deadline:
+        peak_rss[0] = max(peak_rss[0], rss_bytes(pid))
+        await asyncio.sleep(0.25)
+
+    await asyncio.gather(sample_memory(), *[worker() for _ in range(concurrency)])
+
+  latencies.sort()
+  count = len(latencies)
+  return {
+    "name": name,
+    "requests": count,
+    "errors": errors[0],
+    "rps": count / duration,
+    "p50_ms": latencies[count // 2] * 1000 if count else 0,
+    "p99_ms": latencies[int(count * 0.99)] * 1000 if count else 0,
+    "peak_in_flight": peak_in_flight[0],
+    "idle_rss_mb": idle_rss / 1e6,
+    "peak_rss_mb": peak_rss[0] / 1e6,
+    "kb_per_in_flight": (peak_rss[0] - idle_rss) / 1000.0 / max(peak_in_flight[0], 1)
+  }
+
+def parse_target(value):
+  name, _, rest = value.partition("=")
+  url, _, pid = rest.rpartition("@")
+  if not name or not url or not pid.isdigit():
+    raise argparse.ArgumentTypeError("expected NAME=URL@PID")
+  return (name, url, int(pid))
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--target", type=parse_target, action="append", required=True, help="NAME=URL@PID")
+  parser.add_argument("--path", default="/status?verification_code=benchmark")
+  parser.add_argument("--concurrency", type=int, default=200)
+  parser.add_argument("--duration", type=float, default=20)
+  args = parser.parse_args()
+
+  results = []
+  for name, url, pid in args.target:
+    if not os.path.exists("/proc/{}".format(pid)):
+      parser.error("no such process: {}".format(pid))
+    results.append(asyncio.run(run_target(name, url, pid, args.path, args.concurrency, args.duration)))
+
+  columns = ["name", "requests", "errors", "rps", "p50_ms", "p99_ms", "peak_in_flight", "idle_rss_mb", "peak_rss_mb", "kb_per_in_flight"]
+  print("  ".join("{:>16}".format(c) for c in columns))
+  for result in results:
+    print("  ".join("{:>16}".format(result[c] if isinstance(result[c], (int, str)) else "{:.1f}".format(result[c])) for c in columns))
+
+if __name__ == "__main__":
+  main()
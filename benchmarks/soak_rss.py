@@ -0,0 +1,109 @@
+"""
+Purpose: A soak test to catch memory leaks.  Sends a steady mix of requests (the
+OpenAPI spec, new challenges, captcha images and status lookups) to a running server
+for a long time, and samples the resident memory (RSS) of the server process tree.
+After a warm-up period RSS should level off.  The script reports RSS over time and
+the growth rate (by least-squares fit) after the warm-up, and fails (exit status 1)
+if it exceeds --max-growth-kb-per-min.
+
+If the server runs with ALLOCATION_PROFILING_ENABLED (and --admin-key is its
+ADMIN_API_KEY), the top allocation sites per route (GET /admin/allocations) are
+printed at the end, which shows where the memory went.
+
+Start a server first, for example:
+  gunicorn -k gevent -w 1 -b :8000 kq_api.main:app
+
+Then, from the repository root (Linux only, RSS is read from /proc):
+  python -m benchmarks.soak_rss --url http://localhost:8000 --pid <gunicorn master pid> --duration 3600
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+import requests
+from .server_concurrency_benchmark import rss_bytes
+
+def make_requests(session, base_url):
+  """
+  One round of the request mix
+  """
+  session.get(base_url + "/")
+  r = session.post(base_url + "/challenge", json={})
+  if r.status_code == 200:
+    session.get("{}/challenge/{}.png".format(base_url, r.json()["challenge_id"]))
+  session.get(base_url + "/status", params={"verification_code": "soak-test"})
+
+def worker(base_url, deadline, counts):
+  session = requests.Session()
+  while time.time() < deadline:
+    try:
+      make_requests(session, base_url)
+      counts["rounds"] += 1
+    except requests.RequestException:
+      counts["errors"] += 1
+      time.sleep(1)
+
+def growth_kb_per_min(samples):
+  """
+  The slope of a least-squares line through (seconds, bytes) samples, in KB per minute
+  """
+  if len(samples) < 2:
+    return 0.0
+  n = float(len(samples))
+  mean_t = sum(t for t, _ in samples) / n
+  mean_rss = sum(rss for _, rss in samples) / n
+  variance = sum((t - mean_t) ** 2 for t, _ in samples)
+  if not variance:
+    return 0.0
+  covariance = sum((t - mean_t) * (rss - mean_rss) for t, rss in samples)
+  return covariance / variance * 60 / 1000
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--url", required=True)
+  parser.add_argument("--pid", type=int, required=True, help="the server (or gunicorn master) process id")
+  parser.add_argument("--duration", type=float, default=600, help="seconds")
+  parser.add_argument("--warm-up", type=float, default=60, help="seconds excluded from the growth rate")
+  parser.add_argument("--concurrency", type=int, default=4)
+  parser.add_argument("--sample-interval", type=float, default=10, help="seconds")
+  parser.add_argument("--max-growth-kb-per-min", type=float, default=100)
+  parser.add_argument("--admin-key", default="", help="the server's ADMIN_API_KEY, to read GET /admin/allocations")
+  args = parser.parse_args()
+
+  base_url = args.url.rstrip("/")
+  start = time.time()
+  deadline = start + args.duration
+  counts = {"rounds": 0, "errors": 0}
+  threads = [threading.Thread(target=worker, args=(base_url, deadline, counts)) for _ in range(args.concurrency)]
+  for t in threads:
+    t.daemon = True
+    t.start()
+
+  samples = []
+  print("{:>8}  {:>10}  {:>8}  {:>6}".format("seconds", "rss_mb", "rounds", "errors"))
+  while time.time() < deadline:
+    elapsed = time.time() - start
+    rss = rss_bytes(args.pid)
+    if elapsed >= args.warm_up:
+      samples.append((elapsed, rss))
+    print("{:>8.0f}  {:>10.1f}  {:>8}  {:>6}".format(elapsed, rss / 1e6, counts["rounds"], counts["errors"]))
+    sys.stdout.flush()
+    time.sleep(min(args.sample_interval, max(deadline - time.time(), 0)))
+  for t in threads:
+    t.join()
+
+  growth = growth_kb_per_min(samples)
+  print("\nRSS growth after warm-up: {:.1f} KB/min ({} samples)".format(growth, len(samples)))
+
+  r = requests.get(base_url + "/admin/allocations", headers={"Authorization": "Bearer {}".format(args.admin_key)})
+  if r.status_code == 200:
+    print("\nTop allocation sites per route (GET /admin/allocations):")
+    print(json.dumps(r.json(), indent=2, sort_keys=True))
+
+  if growth > args.max_growth_kb_per_min:
+    print("FAIL: RSS grew faster than {} KB/min".format(args.max_growth_kb_per_min))
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,113 @@
+"""
+Purpose: Report how long it takes to import the application and build its state, and
+how much memory each gunicorn worker uses with and without preloading (PRELOAD_APP,
+see gunicorn.conf.py).
+
+For each worker the report shows:
+  rss: resident memory, including pages shared with the master and other workers
+  pss: proportional set size (shared pages divided among the processes sharing them)
+  private: memory used only by this worker
+With preloading, pss and private should drop because the immutable state is shared.
+
+Usage (from the repository root, on Linux, with all application environment
+variables set and gunicorn installed):
+  python -m benchmarks.startup_report [--workers 4]
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+def import_times(top):
+  """
+  Runs 'import kq_api.main' in a fresh interpreter with -X importtime.  Returns the
+  total import time of kq_api.main and its slowest direct imports, as
+  (cumulative microseconds, module name) tuples.
+  """
+  p = subprocess.run([sys.executable, "-X", "importtime", "-c", "import kq_api.main"],
+    stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+  #a module's imports are listed before it, indented one more level
+  children = []
+  for line in p.stderr.splitlines():
+    m = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)", line)
+    if not m:
+      continue
+    cumulative, depth, name = int(m.group(2)), (len(m.group(3)) - 1) // 2, m.group(4)
+    if depth == 0:
+      if name == "kq_api.main":
+        return cumulative, sorted(children, reverse=True)[:top]
+      children = []
+    elif depth == 1:
+      children.append((cumulative, name))
+  return 0, []
+
+def warm_up_times():
+  code = "from kq_api import preload\nfor step, s in preload.warm_up(): print('{}\\t{}'.format(step, s))"
+  p = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE, universal_newlines=True)
+  return [line.split("\t") for line in p.stdout.splitlines() if "\t" in line]
+
+def memory(pid):
+  values = {}
+  try:
+    with open("/proc/{}/smaps_rollup".format(pid)) as f:
+      for line in f:
+        parts = line.split()
+        if parts[0] in ["Rss:", "Pss:", "Private_Clean:", "Private_Dirty:"]:
+          values[parts[0][:-1]] = int(parts[1])
+  except IOError:
+    return None
+  return {
+    "rss": values.get("Rss", 0),
+    "pss": values.get("Pss", 0),
+    "private": values.get("Private_Clean", 0) + values.get("Private_Dirty", 0)
+  }
+
+def worker_memory(workers, preload, port):
+  env = dict(os.environ, PRELOAD_APP="1" if preload else "0")
+  p = subprocess.Popen(["gunicorn", "-w", str(workers), "-b", "127.0.0.1:{}".format(port), "kq_api.main:app"], env=env,
+    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  try:
+    #wait for all workers to boot
+    pids = []
+    for _ in range(60):
+      time.sleep(1)
+      try:
+        with open("/proc/{}/task/{}/children".format(p.pid, p.pid)) as f:
+          pids = [int(c) for c in f.read().split()]
+      except IOError:
+        pids = []
+      if len(pids) >= workers:
+        break
+    time.sleep(3)
+    return [memory(pid) for pid in pids]
+  finally:
+    p.terminate()
+    p.wait()
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--workers", type=int, default=4)
+  parser.add_argument("--port", type=int, default=8765)
+  parser.add_argument("--top", type=int, default=15)
+  args = parser.parse_args()
+
+  total, top_level = import_times(args.top)
+  print("Import time of kq_api.main: {:.1f} ms".format(total / 1000.0))
+  for cumulative, name in top_level:
+    print("  {:>10.1f} ms  {}".format(cumulative / 1000.0, name))
+
+  print("\nWarm-up steps (kq_api.preload.warm_up):")
+  for step, seconds in warm_up_times():
+    print("  {:>10.1f} ms  {}".format(float(seconds) * 1000, step))
+
+  for preload in [False, True]:
+    print("\nWorker memory, PRELOAD_APP={} ({} workers, KiB):".format(int(preload), args.workers))
+    print("  {:>10} {:>10} {:>10}".format("rss", "pss", "private"))
+    for m in worker_memory(args.workers, preload, args.port):
+      if m:
+        print("  {:>10} {:>10} {:>10}".format(m["rss"], m["pss"], m["private"]))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,36 @@
+"""
+Gunicorn settings.  Gunicorn reads this file automatically when it is started from the
+repository root (as in the Dockerfile).  Command line options take precedence.
+
+Environment variables:
+  PRELOAD_APP: if set to 1, the application is imported and its immutable state
+    (word lists, fonts, templates, CSS, OpenAPI spec) is built once in the master
+    process before workers are forked.  Workers then share that memory copy-on-write
+    and start without repeating the work.  Default is 0 (each worker builds its own).
+  GUNICORN_WORKER_CLASS: the worker class.  Default is "gevent".
+"""
+import os
+
+TRUTH_VALUES = ["T", "1", "TRUE"]
+
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gevent")
+preload_app = os.environ.get("PRELOAD_APP", "0").upper() in TRUTH_VALUES
+
+#gevent workers monkey-patch the standard library after they are forked.  When the
+#application is preloaded, modules such as socket, ssl and threading are imported
+#in the master first, so patch them here, before the application is imported.
+if preload_app and worker_class == "gevent":
+  from gevent import monkey
+  monkey.patch_all()
+
+def when_ready(server):
+  """
+  Called in the master process after the application is loaded and before any
+  workers are forked
+  """
+  if not preload_app:
+    return
+  from kq_api import preload
+  for step, seconds in preload.warm_up():
+    server.log.info("Preloaded: {} ({:.3f}s)".format(step, seconds))
+  preload.freeze()
@@ -0,0 +1,40 @@
+"""
+Purpose: Authentication of the admin routes (/admin/...).  Callers send the key set in
+ADMIN_API_KEY as a bearer token:
+
+  Authorization: Bearer <key>
+
+If no key is set, the admin routes are disabled.
+"""
+import hmac
+from . import settings
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+ADMIN_PATH_PREFIX = "/admin/"
+BEARER_PREFIX = "Bearer "
+
+#------------------------------------------------------------------------------
+# Functions shared with the ASGI application
+#------------------------------------------------------------------------------
+
+def check(authorization, api_key=None):
+  """
+  Checks the Authorization header of a request to an admin route.  Returns None if
+  the request may proceed, otherwise a tuple (response body as a dictionary, HTTP
+  status code, response headers).
+  :param authorization: the value of the Authorization header (or None)
+  :param api_key: the admin key.  By default, settings.ADMIN_API_KEY.
+  """
+  if api_key is None:
+    api_key = settings.ADMIN_API_KEY
+  if not api_key:
+    return {"msg": "Not found."}, 404, {}
+  if not authorization or not authorization.startswith(BEARER_PREFIX):
+    return {"msg": "Authentication required."}, 401, {"WWW-Authenticate": "Bearer"}
+  given = authorization[len(BEARER_PREFIX):].strip().encode("utf-8")
+  if not hmac.compare_digest(given, api_key.encode("utf-8")):
+    return {"msg": "Invalid admin key."}, 403, {}
+  return None
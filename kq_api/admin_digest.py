@@ -0,0 +1,136 @@
+from flask_redis import FlaskRedis
+import redis
+import json
+import os
+import threading
+import time
+from .redis_clients import RedisProvider
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+ITEMS_KEY = "admin_digest:items"
+STARTED_KEY = "admin_digest:started"
+
+#how often (in seconds) each worker checks whether the digest is due
+FLUSH_CHECK_SECONDS = 30
+
+#Adds an item to the digest.  The time of the first item is recorded.
+#KEYS[1]: the items list.  KEYS[2]: the start time.  ARGV[1]: the item.  ARGV[2]: the time.
+#Returns the number of items.
+ADD_SCRIPT = """
+local count = redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('SET', KEYS[2], ARGV[2], 'NX')
+return count
+"""
+
+#Removes and returns all items, if there are at least max_items of them or the first
+#was added at least interval seconds ago.  Only one caller can take a given set of items.
+#KEYS[1]: the items list.  KEYS[2]: the start time.  ARGV[1]: max items.  ARGV[2]: the
+#interval.  ARGV[3]: the time.
+#Returns the items, or an empty list if the digest isn't due.
+TAKE_SCRIPT = """
+local count = redis.call('LLEN', KEYS[1])
+if count == 0 then
+  return {}
+end
+local started = tonumber(redis.call('GET', KEYS[2]) or ARGV[3])
+if count < tonumber(ARGV[1]) and tonumber(ARGV[3]) - started < tonumber(ARGV[2]) then
+  return {}
+end
+local items = redis.call('LRANGE', KEYS[1], 0, -1)
+redis.call('DEL', KEYS[1], KEYS[2])
+return items
+"""
+
+class AdminDigest(object):
+  """
+  Collects summaries of verified API key requests so the administrators can be
+  notified of them in one email (a digest) rather than one email per request.  A
+  digest is due when max_items summaries have been collected, or interval_seconds
+  after the first of them was collected.  The summaries are kept in Redis, so every
+  worker adds to the same digest and exactly one worker sends it.
+  """
+
+  def __init__(self, app, db_url=None, interval_seconds=3600, max_items=20):
+    self.app = app
+    self.db_url = db_url
+
+    if db_url:
+      app.config["REDIS_URL"] = db_url
+
+    self._interval_seconds = interval_seconds
+    self._max_items = max_items
+    self._store = FlaskRedis.from_custom_provider(RedisProvider, app)
+    self._add_script = self._store.register_script(ADD_SCRIPT)
+    self._take_script = self._store.register_script(TAKE_SCRIPT)
+    self._flusher_pid = None
+
+  def add(self, summary):
+    """
+    Adds a summary (a JSON-serializable dictionary) to the digest.  Returns True if
+    the digest is now due.
+    """
+    try:
+      count = self._add_script(keys=[ITEMS_KEY, STARTED_KEY], args=[json.dumps(summary), time.time()])
+    except redis.exceptions.RedisError as e:
+      self.app.logger.error("Unable to add to admin digest in Redis database: '%s'. %s", self.db_url, e)
+      raise RuntimeError("Unable to add to admin digest.")
+    return count >= self._max_items
+
+  def take_if_due(self):
+    """
+    If the digest is due, removes and returns its summaries (oldest first).  Otherwise
+    returns an empty list.
+    """
+    try:
+      items = self._take_script(keys=[ITEMS_KEY, STARTED_KEY], args=[self._max_items, self._interval_seconds, time.time()])
+    except redis.exceptions.RedisError as e:
+      self.app.logger.error("Unable to read admin digest from Redis database: '%s'. %s", self.db_url, e)
+      return []
+    return [json.loads(item) for item in items]
+
+  def restore(self, summaries):
+    """
+    Returns summaries which could not be sent to the front of the digest
+    """
+    if not summaries:
+      return
+    try:
+      self._store.lpush(ITEMS_KEY, *[json.dumps(s) for s in reversed(summaries)])
+      self._store.set(STARTED_KEY, time.time(), nx=True)
+    except redis.exceptions.RedisError as e:
+      self.app.logger.error("Unable to restore %s admin digest items. %s", len(summaries), e)
+
+  def start_flusher(self, send_digest):
+    """
+    Starts a background thread in this process (once per process) which sends the
+    digest when its interval has passed, even if no more requests are verified.
+    Safe to call on every request.
+    :param send_digest: a function which sends a list of summaries
+    """
+    if self._flusher_pid == os.getpid():
+      return
+    self._flusher_pid = os.getpid()
+    t = threading.Thread(target=self._flush_periodically, args=(send_digest,), name="admin-digest-flusher")
+    t.daemon = True
+    t.start()
+
+  def flush(self, send_digest):
+    """
+    Sends the digest if it is due.  If sending fails, the summaries are restored.
+    """
+    summaries = self.take_if_due()
+    if not summaries:
+      return
+    try:
+      send_digest(summaries)
+    except Exception as e:
+      self.app.logger.error("Unable to send admin digest of %s requests. %s", len(summaries), e)
+      self.restore(summaries)
+
+  def _flush_periodically(self, send_digest):
+    while True:
+      time.sleep(FLUSH_CHECK_SECONDS)
+      self.flush(send_digest)
@@ -0,0 +1,181 @@
+"""
+Purpose: Admission control for expensive endpoints.  Each controlled route has a
+gate which admits a limited number of concurrent requests.  Requests beyond that
+wait in a bounded queue.  When the queue is full, or a request has waited too long,
+the request is rejected immediately (HTTP 503) so that slow routes cannot tie up
+every worker while cheap routes (such as /status) wait behind them.
+
+Limits apply per worker process.  Gates use threading primitives, which gevent
+makes cooperative when it patches the standard library.  AsyncRouteGate is the
+equivalent for the ASGI application.
+"""
+import asyncio
+import threading
+import time
+from . import settings
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+#controlled routes (the names of the view functions)
+REQUEST_KEY = "request_key"
+VERIFY_KEY_REQUEST = "verify_key_request"
+CAPTCHA_IMAGE = "get_captcha_image"
+
+class RouteGate(object):
+  """
+  Admits at most max_concurrent requests at once.  Up to max_queued more may wait
+  (for at most max_wait_seconds) for one of them to finish.
+  """
+
+  def __init__(self, name, max_concurrent, max_queued, max_wait_seconds):
+    self.name = name
+    self.max_concurrent = max_concurrent
+    self.max_queued = max_queued
+    self.max_wait_seconds = max_wait_seconds
+    self.active = 0
+    self.queued = 0
+    self.admitted = 0
+    self.rejected = 0
+    self._condition = threading.Condition()
+
+  def enter(self):
+    """
+    Waits for the request to be admitted.  Returns True if it was, or False if it was
+    rejected.  Every admitted request must call leave() when it is finished.
+    """
+    with self._condition:
+      if self.active < self.max_concurrent:
+        return self._admit()
+      if self.queued >= self.max_queued:
+        return self._reject()
+      self.queued += 1
+      try:
+        deadline = time.time() + self.max_wait_seconds
+        while self.active >= self.max_concurrent:
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            return self._reject()
+          self._condition.wait(remaining)
+        return self._admit()
+      finally:
+        self.queued -= 1
+
+  def leave(self):
+    with self._condition:
+      self.active -= 1
+      self._condition.notify()
+
+  def stats(self):
+    return {
+      "max_concurrent": self.max_concurrent,
+      "max_queued": self.max_queued,
+      "max_wait_seconds": self.max_wait_seconds,
+      "active": self.active,
+      "queued": self.queued,
+      "admitted": self.admitted,
+      "rejected": self.rejected
+    }
+
+  def _admit(self):
+    self.active += 1
+    self.admitted += 1
+    return True
+
+  def _reject(self):
+    self.rejected += 1
+    return False
+
+class AsyncRouteGate(RouteGate):
+  """
+  A RouteGate for coroutines.  It must only be used from one event loop.
+  """
+
+  def __init__(self, name, max_concurrent, max_queued, max_wait_seconds):
+    super(AsyncRouteGate, self).__init__(name, max_concurrent, max_queued, max_wait_seconds)
+    self._condition = None
+
+  async def enter(self):
+    if self.active < self.max_concurrent:
+      return self._admit()
+    if self.queued >= self.max_queued:
+      return self._reject()
+    if not self._condition:
+      self._condition = asyncio.Condition()
+    self.queued += 1
+    try:
+      async with self._condition:
+        await asyncio.wait_for(self._condition.wait_for(lambda: self.active < self.max_concurrent), self.max_wait_seconds)
+        return self._admit()
+    except asyncio.TimeoutError:
+      return self._reject()
+    finally:
+      self.queued -= 1
+
+  async def leave(self):
+    self.active -= 1
+    if self._condition:
+      async with self._condition:
+        self._condition.notify()
+
+class AdmissionController(object):
+  """
+  Holds the gates of all controlled routes
+  """
+
+  def __init__(self, limits, max_wait_seconds, retry_after_seconds, gate_class=RouteGate):
+    """
+    :param limits: a dictionary which maps route name to a (max concurrent, max queued)
+      tuple.  Routes which are missing or None are not controlled.
+    :param max_wait_seconds: the longest time a request may wait in a queue
+    :param retry_after_seconds: the Retry-After value sent with rejections
+    """
+    self.retry_after_seconds = retry_after_seconds
+    self._gates = {}
+    for name, limit in limits.items():
+      if limit:
+        self._gates[name] = gate_class(name, limit[0], limit[1], max_wait_seconds)
+
+  def gate(self, name):
+    """
+    The gate for the given route, or None if the route is not controlled
+    """
+    return self._gates.get(name)
+
+  def stats(self):
+    return {name: gate.stats() for name, gate in self._gates.items()}
+
+#------------------------------------------------------------------------------
+# Settings
+#------------------------------------------------------------------------------
+
+def limits_from_settings():
+  """
+  The route limits configured in the application settings (an empty dictionary if
+  admission control is disabled)
+  """
+  if not settings.ADMISSION_CONTROL_ENABLED:
+    return {}
+  return {
+    REQUEST_KEY: parse_limit(settings.ADMISSION_LIMIT_REQUEST_KEY),
+    VERIFY_KEY_REQUEST: parse_limit(settings.ADMISSION_LIMIT_VERIFY_KEY_REQUEST),
+    CAPTCHA_IMAGE: parse_limit(settings.ADMISSION_LIMIT_CAPTCHA_IMAGE)
+  }
+
+def parse_limit(value):
+  """
+  Parses a limit of the form "<max concurrent>/<max queued>", e.g. "4/8".  Returns a
+  (max concurrent, max queued) tuple, or None if the value is empty or "0" (no limit).
+  Raises ValueError if the value is not valid.
+  """
+  if not value or value.strip() == "0":
+    return None
+  try:
+    max_concurrent, max_queued = value.split("/")
+    max_concurrent, max_queued = int(max_concurrent), int(max_queued)
+  except ValueError:
+    raise ValueError("Invalid admission limit '{}'.  Expecting <max concurrent>/<max queued>".format(value))
+  if max_concurrent < 1 or max_queued < 0:
+    raise ValueError("Invalid admission limit '{}'".format(value))
+  return (max_concurrent, max_queued)
@@ -0,0 +1,135 @@
+"""
+Purpose: An opt-in allocation profiling mode (see ALLOCATION_PROFILING_ENABLED) to find
+where request handlers and stores allocate memory.  tracemalloc traces every
+allocation.  A snapshot is taken before and after each request, and the allocations
+still held after the request (the net growth, by source line) are added to the
+totals of the request's route.  Sites which release their memory before the request
+ends do not appear, so the report shows what accumulates (e.g. caches or leaks)
+rather than short-lived garbage.
+
+Tracing slows every allocation down and snapshots are costly, so only enable this in
+a test or soak environment.  tracemalloc is process-wide: when several requests run
+at once (gevent or asyncio), the allocations of one are also counted in the others.
+For precise per-route figures, profile a single worker with one request at a time.
+"""
+import threading
+import tracemalloc
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+#the sites kept per route (the largest are kept when there are more)
+MAX_SITES_PER_ROUTE = 200
+
+#allocations made by the profiler itself, and by the import machinery, are ignored
+IGNORED_FILES = [tracemalloc.__file__, __file__, "<frozen importlib._bootstrap>", "<frozen importlib._bootstrap_external>", "<unknown>"]
+
+class RouteAllocations(object):
+  """
+  The net allocations of all requests to one route, by site (file and line)
+  """
+
+  def __init__(self):
+    self.requests = 0
+    self.net_bytes = 0
+    self.sites = {}
+
+  def add(self, stats):
+    """
+    :param stats: a list of tracemalloc.StatisticDiff grouped by line number
+    """
+    self.requests += 1
+    for stat in stats:
+      self.net_bytes += stat.size_diff
+      if stat.size_diff <= 0:
+        continue
+      frame = stat.traceback[0]
+      site = "{}:{}".format(frame.filename, frame.lineno)
+      totals = self.sites.setdefault(site, [0, 0])
+      totals[0] += stat.size_diff
+      totals[1] += max(stat.count_diff, 0)
+    if len(self.sites) > MAX_SITES_PER_ROUTE:
+      largest = sorted(self.sites.items(), key=lambda item: item[1][0], reverse=True)[:MAX_SITES_PER_ROUTE]
+      self.sites = dict(largest)
+
+  def report(self, top_sites):
+    largest = sorted(self.sites.items(), key=lambda item: item[1][0], reverse=True)[:top_sites]
+    return {
+      "requests": self.requests,
+      "net_bytes": self.net_bytes,
+      "net_bytes_per_request": self.net_bytes // max(self.requests, 1),
+      "top_sites": [{
+        "site": site,
+        "size_bytes": size,
+        "count": count,
+        "bytes_per_request": size // self.requests
+      } for site, (size, count) in largest]
+    }
+
+class AllocationProfiler(object):
+  """
+  Aggregates the net allocations of each request by route.  When not enabled, every
+  method does nothing, so the hooks can stay in place.  Thread safe.
+  """
+
+  def __init__(self, enabled=False, frames=1, top_sites=10):
+    """
+    :param frames: the number of frames tracemalloc stores per allocation.  Sites are
+      reported by their innermost frame.
+    :param top_sites: the number of sites reported per route
+    """
+    self.enabled = enabled
+    self.frames = frames
+    self.top_sites = top_sites
+    self._routes = {}
+    self._lock = threading.Lock()
+    self._filters = [tracemalloc.Filter(False, f) for f in IGNORED_FILES]
+
+  def start(self):
+    """
+    Starts tracing allocations (if enabled and not already tracing)
+    """
+    if self.enabled and not tracemalloc.is_tracing():
+      tracemalloc.start(self.frames)
+
+  def snapshot(self):
+    """
+    Takes a snapshot before a request.  Returns None if not enabled.
+    """
+    if not self.enabled or not tracemalloc.is_tracing():
+      return None
+    return tracemalloc.take_snapshot().filter_traces(self._filters)
+
+  def record(self, route, before):
+    """
+    Adds the allocations made since the snapshot 'before' to the totals of the route
+    """
+    if before is None:
+      return
+    after = tracemalloc.take_snapshot().filter_traces(self._filters)
+    stats = after.compare_to(before, "lineno")
+    with self._lock:
+      self._routes.setdefault(route or "unknown", RouteAllocations()).add(stats)
+
+  def report(self, top_sites=None):
+    """
+    The top allocation sites of each route, and the memory traced by tracemalloc
+    """
+    top_sites = top_sites or self.top_sites
+    current, peak = tracemalloc.get_traced_memory()
+    with self._lock:
+      routes = dict((route, allocations.report(top_sites)) for route, allocations in self._routes.items())
+    return {
+      "enabled": self.enabled,
+      "traced_bytes": current,
+      "traced_peak_bytes": peak,
+      "routes": routes
+    }
+
+  def reset(self):
+    with self._lock:
+      self._routes = {}
+    #reset_peak() is new in Python 3.9
+    if tracemalloc.is_tracing() and hasattr(tracemalloc, "reset_peak"):
+      tracemalloc.reset_peak()
@@ -0,0 +1,77 @@
+"""
+Purpose: Serve the OpenAPI specification of this API.  The spec file is read
+once, and a rendered copy (with the ${HOST} placeholder filled in) is cached for
+each known host along with its ETag and precompressed variants.
+"""
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from . import compression
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+HOST_PLACEHOLDER = "${HOST}"
+
+class ApiSpec(object):
+  """
+  An in-memory copy of the OpenAPI spec.  The spec is split around the host
+  placeholder when loaded, so rendering it for a new host is a single join.
+  Rendered copies for the known hosts are kept in a small LRU cache keyed by host.
+  The host comes from the client's request (its Host header), so other hosts are
+  rendered for each request, and neither cached nor precompressed: otherwise any
+  client could make the server compress the spec at the highest levels, and evict
+  the known hosts' copies, by sending new Host headers.
+  """
+
+  def __init__(self, filename, max_hosts=16, known_hosts=None):
+    """
+    :param known_hosts: the hosts (base URLs) whose rendered copies are cached.  If
+      None, every host is.
+    """
+    with open(filename) as f:
+      text = f.read()
+
+    self.filename = filename
+    self.last_modified = datetime.fromtimestamp(int(os.path.getmtime(filename)), timezone.utc)
+    self._parts = text.split(HOST_PLACEHOLDER)
+    self._max_hosts = max_hosts
+    self._known_hosts = None if known_hosts is None else set(h.rstrip("/") for h in known_hosts)
+    self._cache = OrderedDict()
+    self._lock = threading.Lock()
+
+  def render(self, host):
+    """
+    Returns the spec rendered for the given host as a dictionary with these keys:
+      body: the spec as utf-8 bytes
+      etag: a strong ETag of the uncompressed body
+      variants: a dictionary which maps content coding to compressed body (empty if
+        the host is not known)
+    """
+    if self._known_hosts is not None and host not in self._known_hosts:
+      body = host.join(self._parts).encode("utf-8")
+      return {"body": body, "etag": hashlib.sha1(body).hexdigest(), "variants": {}}
+
+    with self._lock:
+      rendered = self._cache.get(host)
+      if rendered:
+        self._cache.move_to_end(host)
+        return rendered
+
+    #render outside the lock.  two threads may occasionally render the same
+    #host, which is harmless.
+    body = host.join(self._parts).encode("utf-8")
+    rendered = {
+      "body": body,
+      "etag": hashlib.sha1(body).hexdigest(),
+      "variants": compression.precompress(body)
+    }
+
+    with self._lock:
+      self._cache[host] = rendered
+      while len(self._cache) > self._max_hosts:
+        self._cache.popitem(last=False)
+    return rendered
@@ -0,0 +1,849 @@
+"""
+Purpose: An asyncio-native ASGI application which serves the same endpoints as the
+Flask application (kq_api.main).  Redis, BCDC, the app URL probe and SMTP are all
+accessed without blocking, so each in-flight request is a coroutine rather than a
+greenlet holding a blocking socket.  The Flask application remains the default.
+
+Run with an ASGI server, for example:
+  uvicorn kq_api.asgi:app --port 8000
+Requires the packages listed in requirements-asgi.txt.
+"""
+import os
+import time
+import asyncio
+import logging
+import contextlib
+import contextvars
+import functools
+from email.utils import formatdate, parsedate_to_datetime
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response, HTMLResponse
+from starlette import responses
+from starlette.routing import Route
+from profanityfilter import ProfanityFilter
+from . import settings
+from . import async_bcdc
+from . import bcdc
+from . import compression
+from . import key_requests
+from . import html_templates as html
+from .api_spec import ApiSpec
+from .async_stores import AsyncRequestStore, AsyncChallengeStore, AsyncIdempotencyStore, AsyncRateLimiter, AsyncPackageNameRegistry, AsyncAdminDigest, AsyncStatusWatcher, AsyncTokenChallengeStore, AsyncLifecycleEvents
+from . import idempotency_store
+from . import rate_limiter
+from . import admission
+from . import structured_logging
+from . import storage
+from . import deadlines
+from . import json_codec
+from . import lifecycle_events
+from . import precompute
+from .precompute import AsyncPrecomputer
+from .allocation_profiler import AllocationProfiler
+from . import health
+from . import admin_auth
+from . import url_probe
+from .status_watcher import status_etag, parse_wait_seconds
+from .emailer import send_email_async, check_smtp_server_async
+from .key_requests import STATUS_KEY, PROCESSING_STATES
+from .profanity import ProfanityMatcher
+from .validation import AsyncRequestValidator, ValidationError, REQUEST_SCHEMA
+
+#------------------------------------------------------------------------------
+# Init
+#------------------------------------------------------------------------------
+
+#the correlation id of the request being processed by the current task
+correlation_id = contextvars.ContextVar("correlation_id", default=None)
+
+structured_logging.configure_logging(settings.LOG_LEVEL, log_format=settings.LOG_FORMAT, queue_size=settings.LOG_QUEUE_SIZE, info_sample_rate=settings.LOG_INFO_SAMPLE_RATE)
+structured_logging.set_correlation_id_getter(correlation_id.get)
+
+#the deadline of the request being processed by the current task
+request_deadline = contextvars.ContextVar("deadline", default=None)
+deadlines.set_deadline_getter(request_deadline.get)
+deadline_stats = deadlines.DeadlineStats()
+
+logger = logging.getLogger(__name__)
+logger.setLevel(getattr(logging, settings.LOG_LEVEL))
+
+class JSONResponse(responses.JSONResponse):
+  """
+  A JSON response encoded with the configured codec (see json_codec)
+  """
+
+  def render(self, content):
+    return json_codec.dumps_bytes(content)
+
+API_SPEC_FILENAME = os.path.join(os.path.dirname(__file__), "../docs/kq-api.openapi3.json")
+COMPRESSIBLE_MIMETYPES = ["text/html", "application/json"]
+
+api_spec = ApiSpec(API_SPEC_FILENAME, max_hosts=settings.API_SPEC_CACHE_MAX_HOSTS, known_hosts=settings.API_SPEC_CACHED_URLS)
+kq_backend = storage.backend_from_settings("kq_store", settings.KQ_STORE_BACKEND)
+challenge_backend = storage.backend_from_settings("challenge_store", settings.CAPTCHA_STORE_BACKEND)
+kq_store = AsyncRequestStore(settings.KQ_STORE_URL, default_ttl_seconds=settings.KQ_STORE_TTL_SECONDS, status_ttl_seconds=settings.STATUS_TTL_SECONDS, backend=kq_backend)
+if settings.CHALLENGE_TOKENS_ENABLED:
+  challenge_store = AsyncTokenChallengeStore(settings.CAPTCHA_STORE_URL, default_ttl_seconds=settings.CAPTCHA_STORE_TTL_SECONDS, server_key=settings.CHALLENGE_TOKEN_KEY)
+else:
+  challenge_store = AsyncChallengeStore(settings.CAPTCHA_STORE_URL, default_ttl_seconds=settings.CAPTCHA_STORE_TTL_SECONDS, shard_urls=settings.CHALLENGE_STORE_SHARD_URLS, backend=challenge_backend)
+limiter = AsyncRateLimiter(settings.CAPTCHA_STORE_URL, rules=rate_limiter.rules_from_settings(), enabled=settings.RATE_LIMITS_ENABLED)
+package_name_registry = AsyncPackageNameRegistry(settings.KQ_STORE_URL, cache_ttl_seconds=settings.PACKAGE_NAME_CACHE_TTL_SECONDS, reservation_ttl_seconds=settings.PACKAGE_NAME_RESERVATION_TTL_SECONDS)
+admin_digest = AsyncAdminDigest(settings.KQ_STORE_URL, interval_seconds=settings.ADMIN_EMAIL_DIGEST_INTERVAL_SECONDS, max_items=settings.ADMIN_EMAIL_DIGEST_MAX_ITEMS)
+submission_store = AsyncIdempotencyStore(settings.KQ_STORE_URL, key_ttl_seconds=settings.IDEMPOTENCY_KEY_TTL_SECONDS, window_seconds=settings.DUPLICATE_SUBMISSION_WINDOW_SECONDS)
+status_watcher = AsyncStatusWatcher(settings.KQ_STORE_URL)
+lifecycle = AsyncLifecycleEvents(settings.KQ_STORE_URL, enabled=settings.LIFECYCLE_EVENTS_ENABLED, stream_max_length=settings.LIFECYCLE_STREAM_MAX_LENGTH, retention_days=settings.LIFECYCLE_STATS_RETENTION_DAYS)
+precomputer = AsyncPrecomputer(kq_store, [
+    (precompute.APP_FORMAT, lambda req_data: precompute_app_format(req_data))
+  ],
+  enabled=settings.PRECOMPUTE_ENABLED,
+  max_pending=settings.PRECOMPUTE_MAX_PENDING)
+if kq_backend:
+  kq_backend.subscribe(status_watcher.dispatch)
+profanity_matcher = ProfanityMatcher.from_profanity_filter(ProfanityFilter())
+admission_controller = admission.AdmissionController(admission.limits_from_settings(), settings.ADMISSION_MAX_WAIT_SECONDS, settings.ADMISSION_RETRY_AFTER_SECONDS, gate_class=admission.AsyncRouteGate)
+request_validator = AsyncRequestValidator(REQUEST_SCHEMA, profanity_matcher, challenge_store)
+health_checker = health.AsyncHealthChecker([
+    (health.KQ_STORE, kq_store.ping),
+    (health.CAPTCHA_STORE, challenge_store.ping),
+    (health.BCDC, functools.partial(async_bcdc.status_show, timeout=settings.HEALTH_CHECK_TIMEOUT_SECONDS)),
+    (health.SMTP, functools.partial(check_smtp_server_async, settings.SMTP_SERVER, settings.SMTP_PORT, timeout=settings.HEALTH_CHECK_TIMEOUT_SECONDS))
+  ],
+  required=settings.HEALTH_REQUIRED_CHECKS,
+  interval_seconds=settings.HEALTH_CHECK_INTERVAL_SECONDS,
+  timeout_seconds=settings.HEALTH_CHECK_TIMEOUT_SECONDS)
+allocation_profiler = AllocationProfiler(enabled=settings.ALLOCATION_PROFILING_ENABLED, frames=settings.ALLOCATION_PROFILING_FRAMES, top_sites=settings.ALLOCATION_PROFILING_TOP_SITES)
+allocation_profiler.start()
+
+#------------------------------------------------------------------------------
+# API Endpoints
+#------------------------------------------------------------------------------
+
+async def api(request):
+  """
+  Summary information about this API
+  """
+  spec = api_spec.render(str(request.base_url).rstrip("/"))
+  r = make_precompressed_response(request, spec["body"], spec["variants"], spec["etag"], "application/json")
+  r.headers["Last-Modified"] = formatdate(api_spec.last_modified.timestamp(), usegmt=True)
+  r.headers["Cache-Control"] = "public, max-age={}".format(settings.API_SPEC_MAX_AGE_SECONDS)
+  return make_conditional(request, r, api_spec.last_modified)
+
+async def request_key(request):
+  """
+  Create a new request for an API key
+  """
+  contentType = request.headers.get('Content-Type')
+  if not contentType or contentType != "application/json":
+    return JSONResponse({"msg": "Invalid Content-Type.  Expecting application/json"}, 400)
+
+  try:
+    req_data = json_codec.loads(await request.body())
+  except ValueError as e:
+    return JSONResponse({"msg": "request body is not valid json"}, 400)
+
+  #requests are limited per submitter once they are validated (see process_key_request)
+  throttled = await check_rate_limits([(rate_limiter.REQUEST_KEY, get_client_ip(request))])
+  if throttled:
+    return throttled
+
+  #a retried or double-submitted request gets the original response (see main.request_key)
+  try:
+    submission = await submission_store.begin(request.headers.get("Idempotency-Key"), req_data)
+  except RuntimeError as e:
+    logger.error("Unable to check for duplicate submission. %s", e)
+    return JSONResponse({"msg": "Server error.  Unable to record API key request."}, 500)
+
+  if submission["outcome"] == idempotency_store.REPLAY:
+    return JSONResponse(submission["response"], 200, headers={"Idempotent-Replayed": "true"})
+  if submission["outcome"] == idempotency_store.IN_PROGRESS:
+    return JSONResponse({"msg": "An identical API key request is already being processed."}, 409, headers={"Retry-After": "1"})
+  if submission["outcome"] == idempotency_store.MISMATCH:
+    return JSONResponse({"msg": "Idempotency-Key has already been used with a different request body."}, 422)
+
+  resp, status_code, headers = await process_key_request(req_data)
+  if status_code == 200:
+    await submission_store.complete(submission["claim"], resp)
+  else:
+    await submission_store.release(submission["claim"])
+  return JSONResponse(resp, status_code, headers=headers)
+
+async def verify_key_request(request):
+  """
+  Accepts a veritication code.  Checks that the code corresponds to an active API Key Request.  If so
+  the request is verified and processing of it is initiated:
+  Returns a text/html response
+  """
+  verification_code = request.query_params.get('verification_code')
+
+  try:
+    req_data = await kq_store.load_request(verification_code)
+  except RuntimeError as e:
+    logger.error("Unable to access request from store. %s", e)
+    return HTMLResponse(html.get_err_verify_key_request_store(), 500)
+
+  if not req_data:
+    return HTMLResponse(html.get_err_verify_key_request_invalid_code(), 404)
+
+  if not key_requests.is_awaiting_verification(req_data):
+    return HTMLResponse(html.get_err_verify_key_request_already_done(), 400)
+
+  precomputed = await kq_store.load_precomputed(verification_code)
+
+  #create a draft metadata record (if one doesn't exist yet, and wasn't created by an
+  #earlier attempt to verify this request)
+  if not req_data["app"].get("metadata_url") and not key_requests.has_new_metadata_record(req_data):
+    try:
+      package = await create_package(req_data)
+      if not package:
+        raise ValueError("Unknown reason")
+      req_data[STATUS_KEY]["new_metadata_record"] = key_requests.new_metadata_record_details(package)
+    except ValueError as e: #user input errors cause HTTP 400
+      return HTMLResponse(html.get_err_create_metadata(e), 400)
+    except RuntimeError as e: #unexpected system errors cause HTTP 500
+      logger.error("%s", e)
+      return HTMLResponse(html.get_err_verify_key_request_general(), 500)
+
+    #the package exists now, so verification must complete.  see kq_api.main.verify_key_request.
+    deadlines.lift()
+    try:
+      await kq_store.save_request(req_data, verification_code=verification_code)
+    except RuntimeError as e:
+      logger.error("Unable to record the new metadata record of request. %s", e)
+
+    try:
+      await create_app_resource(package["id"], req_data, format=precomputed.get(precompute.APP_FORMAT))
+    except (ValueError, RuntimeError) as e:
+      logger.warning("Unable to create app root resource associated with the new metadata record. %s", e)
+
+  admin_notification = notify_admin(req_data)
+  req_data[STATUS_KEY]["state"] = PROCESSING_STATES["VERIFIED"]
+  submitter_email = key_requests.submitter_notification_email(req_data)
+  results = await asyncio.gather(admin_notification, send_email(*submitter_email), return_exceptions=True)
+  for recipient, result in zip(["admin", "submitter"], results):
+    if isinstance(result, Exception):
+      logger.error("Unable to send notification email to %s. %s", recipient, result)
+
+  #only the status is needed from now on
+  await kq_store.compact_request(req_data, verification_code)
+  await lifecycle.verified(req_data, verification_code)
+
+  return HTMLResponse(html.get_verify_key_request_success(req_data), 200)
+
+async def get_status(request):
+  """
+  Gets a json object which summarizes the processing status of the API Key Request
+  associated with a given verification code.  Supports long-polling with the 'wait'
+  parameter and an If-None-Match header (see kq_api.main.get_status).
+  """
+  verification_code = request.query_params.get('verification_code')
+
+  try:
+    wait_seconds = parse_wait_seconds(request.query_params.get('wait'), settings.STATUS_LONG_POLL_MAX_SECONDS)
+  except ValueError as e:
+    return JSONResponse({"msg": "{}".format(e)}, 400)
+
+  waiter = None
+  if wait_seconds and verification_code and request.headers.get("If-None-Match"):
+    waiter = status_watcher.watch(verification_code)
+  try:
+    try:
+      req_data = await kq_store.load_request(verification_code)
+    except RuntimeError as e:
+      logger.error("Unable to access request from store. %s", e)
+      return JSONResponse({"msg": "Server error.  Unable to access status of API key request."}, 500)
+
+    if not req_data:
+      return JSONResponse({"msg": "Unknown verification code"}, 404)
+
+    if not STATUS_KEY in req_data:
+      return JSONResponse({"msg": "Unable to find status of this request"}, 500)
+
+    status = req_data[STATUS_KEY]
+    etag = status_etag(status)
+    if waiter:
+      status, etag = await wait_for_status_change(request, waiter, status, etag, wait_seconds)
+  finally:
+    if waiter:
+      status_watcher.unwatch(waiter)
+
+  r = JSONResponse(status, 200, headers={"ETag": '"{}"'.format(etag), "Cache-Control": "no-cache"})
+  return make_conditional(request, r)
+
+async def get_status_batch(request):
+  """
+  Gets the statuses of several API Key Requests.  See kq_api.main.get_status_batch.
+  """
+  try:
+    body = json_codec.loads(await request.body())
+  except ValueError:
+    body = None
+  try:
+    codes = key_requests.parse_status_batch(body, settings.STATUS_BATCH_MAX_CODES)
+  except ValueError as e:
+    return JSONResponse({"msg": "{}".format(e)}, 400)
+
+  try:
+    statuses = await kq_store.load_many(codes)
+  except RuntimeError as e:
+    logger.error("Unable to access requests from store. %s", e)
+    return JSONResponse({"msg": "Server error.  Unable to access status of API key requests."}, 500)
+
+  return JSONResponse(key_requests.status_batch_response(statuses), 200, headers={"Cache-Control": "no-cache"})
+
+async def new_challenge(request):
+  """
+  Creates a new random challenge.  See kq_api.main.new_challenge.
+  """
+  throttled = await check_rate_limits([(rate_limiter.CHALLENGE, get_client_ip(request))])
+  if throttled:
+    return throttled
+
+  include_secret = False
+  contentType = request.headers.get('Content-Type')
+  if contentType and contentType == "application/json":
+    try:
+      include_secret = json_codec.loads(await request.body()).get('include_secret', False)
+    except Exception as e:
+      pass
+
+  try:
+    challenge = await challenge_store.new_challenge()
+  except RuntimeError as e:
+    logger.error("Unable to create new challenge. %s", e)
+    return JSONResponse({"msg": "Unable to create new challenge"}, 500)
+  await lifecycle.challenge_created()
+
+  resp_success = {
+    "challenge_id": challenge["challenge_id"]
+  }
+  if settings.ALLOW_TEST_MODE and include_secret:
+    resp_success["secret"] = challenge["secret"]
+    logger.warning("Challenge secret sent in /challenge response because 'TEST MODE' is active.")
+
+  return JSONResponse(resp_success, 200)
+
+async def get_captcha_image(request):
+  """
+  Gets a captcha image correspondong to a given challenge id.
+  """
+  throttled = await check_rate_limits([(rate_limiter.CAPTCHA_IMAGE, get_client_ip(request))])
+  if throttled:
+    return throttled
+
+  try:
+    captcha_bytes = await challenge_store.challenge_id_to_captcha(request.path_params["challenge_id"])
+  except ValueError as e:
+    return JSONResponse({"msg": "Not found"}, 404)
+  except RuntimeError as e:
+    logger.error("Unable to create captcha image. %s", e)
+    return JSONResponse({"msg": "Unable to create captcha image"}, 500)
+  await lifecycle.captcha_served()
+  return Response(captcha_bytes.getvalue(), media_type="image/png")
+
+async def get_static_file(request):
+  """
+  Gets a fingerprinted static file.  See kq_api.main.get_static_file.
+  """
+  css = html.get_bootstrap_css()
+  if request.path_params["filename"] != css.published_name:
+    return JSONResponse({"msg": "Not found"}, 404)
+
+  r = make_precompressed_response(request, css.body, css.variants, css.etag, css.mimetype)
+  r.headers["Cache-Control"] = "public, max-age={}, immutable".format(settings.STATIC_MAX_AGE_SECONDS)
+  return make_conditional(request, r)
+
+async def get_admission_stats(request):
+  """
+  Gets the admission control limits and the current number of active and queued
+  requests.  See kq_api.main.get_admission_stats.
+  """
+  return JSONResponse(admission_controller.stats(), 200)
+
+async def get_liveness(request):
+  """
+  Liveness probe.  See kq_api.main.get_liveness.
+  """
+  return JSONResponse({"status": "ok"}, 200)
+
+async def get_readiness(request):
+  """
+  Readiness probe.  See kq_api.main.get_readiness.
+  """
+  ready, body = health_checker.readiness()
+  return JSONResponse(body, 200 if ready else 503, headers={"Cache-Control": "no-store"})
+
+async def get_deadline_stats(request):
+  """
+  Gets the deadline overruns of each route.  See kq_api.main.get_deadline_stats.
+  """
+  return JSONResponse(deadline_stats.stats(), 200)
+
+async def get_allocations(request):
+  """
+  Gets (or clears) the top allocation sites of each route.  See
+  kq_api.main.get_allocations.
+  """
+  if not allocation_profiler.enabled:
+    return JSONResponse({"msg": "Allocation profiling is not enabled."}, 404)
+  if request.method == "DELETE":
+    allocation_profiler.reset()
+    return JSONResponse({"msg": "Allocation statistics cleared."}, 200)
+  try:
+    top_sites = int(request.query_params.get("top") or allocation_profiler.top_sites)
+  except ValueError:
+    return JSONResponse({"msg": "Invalid 'top' parameter.  Expecting an integer."}, 400)
+  return JSONResponse(allocation_profiler.report(top_sites), 200)
+
+async def get_lifecycle_stats(request):
+  """
+  Gets the daily counts of lifecycle events.  See kq_api.main.get_lifecycle_stats.
+  """
+  try:
+    days = lifecycle_events.parse_days(request.query_params.get("days"), settings.LIFECYCLE_STATS_RETENTION_DAYS)
+  except ValueError as e:
+    return JSONResponse({"msg": "{}".format(e)}, 400)
+  try:
+    stats = await lifecycle.stats(days)
+  except RuntimeError as e:
+    logger.error("%s", e)
+    return JSONResponse({"msg": "Server error.  Unable to read statistics."}, 500)
+  return JSONResponse(stats, 200)
+
+# -----------------------------------------------------------------------------
+# Helper functions
+# -----------------------------------------------------------------------------
+
+def admission_controlled(endpoint):
+  """
+  Wraps an endpoint so that requests to it must pass its admission control gate (if
+  it has one).  See kq_api.main.admit_request.
+  """
+  gate = admission_controller.gate(endpoint.__name__)
+  if not gate:
+    return endpoint
+
+  @functools.wraps(endpoint)
+  async def controlled_endpoint(request):
+    if not await gate.enter():
+      logger.warning("Rejected request to '%s': %s active, %s queued.", gate.name, gate.active, gate.queued)
+      return JSONResponse({"msg": "The server is busy.  Please try again later."}, 503, headers={"Retry-After": str(admission_controller.retry_after_seconds)})
+    try:
+      return await endpoint(request)
+    finally:
+      await gate.leave()
+  return controlled_endpoint
+
+def admin_only(endpoint):
+  """
+  Wraps an admin endpoint so that requests to it must carry the admin key.  See
+  kq_api.main.authenticate_admin_request.
+  """
+  @functools.wraps(endpoint)
+  async def authenticated_endpoint(request):
+    rejection = admin_auth.check(request.headers.get("Authorization"))
+    if not rejection:
+      return await endpoint(request)
+    body, status_code, headers = rejection
+    logger.warning("Rejected request to '%s': HTTP %s.", request.url.path, status_code)
+    return JSONResponse(body, status_code, headers=headers)
+  return authenticated_endpoint
+
+def with_deadline(endpoint):
+  """
+  Wraps an endpoint so that each request to it has a time budget (if its route has
+  one).  See kq_api.main.start_deadline.
+  """
+  seconds = deadlines.seconds_for_route(endpoint.__name__)
+  if not seconds:
+    return endpoint
+
+  @functools.wraps(endpoint)
+  async def bounded_endpoint(request):
+    deadline = deadlines.Deadline(endpoint.__name__, seconds)
+    token = request_deadline.set(deadline)
+    try:
+      return await endpoint(request)
+    finally:
+      request_deadline.reset(token)
+      deadline_stats.record(deadline)
+  return bounded_endpoint
+
+async def process_key_request(req_data):
+  """
+  Validates a new API key request, saves it and emails a verification code to the
+  submitter.  Returns a tuple (response body as a dictionary, HTTP status code,
+  response headers).
+  """
+  try:
+    req_data = key_requests.add_initial_status(await request_validator.validate(req_data))
+  except ValidationError as e:
+    return {"msg": "{}".format(e), "errors": e.errors}, 400, {}
+  except ValueError as e:
+    return {"msg": "{}".format(e)}, 400, {}
+  except RuntimeError as e:
+    logger.error("%s", e)
+    return {"msg": "An unexpected error occurred while validating the API key request."}, 500, {}
+
+  #only requests which passed the captcha challenge count against the submitter's limit
+  retry_after = await limiter.hit([(rate_limiter.REQUEST_KEY_PER_EMAIL, key_requests.submitter_email(req_data))])
+  if retry_after:
+    return {"msg": "Too many requests.  Please try again later."}, 429, {"Retry-After": str(retry_after)}
+
+  try:
+    verification_code = await kq_store.save_request(req_data)
+  except RuntimeError as e:
+    logger.error("Unable to save request. %s", e)
+    return {"msg": "Server error.  Unable to record API key request."}, 500, {}
+  await lifecycle.submitted(req_data, verification_code, settings.KQ_STORE_TTL_SECONDS)
+  precomputer.schedule(req_data, verification_code)
+
+  try:
+    await send_email(*key_requests.verification_email(req_data, verification_code))
+  except Exception as e:
+    logger.error("Unable to send verification email for new API. %s", e)
+    return {"msg": "Server error.  Unable to record API key request."}, 500, {}
+
+  return {"verification_code": verification_code}, 200, {}
+
+async def create_package(req_data):
+  """
+  Registers a new package with BCDC, with a unique name.  See kq_api.main.create_package.
+  """
+  package_dict = key_requests.make_package_dict(req_data)
+  preferred_name = package_dict["name"]
+  package_dict["name"], token = await package_name_registry.reserve(preferred_name)
+  try:
+    package = await create_package_with_reserved_name(package_dict, token)
+  except bcdc.PackageNameTakenError as e:
+    logger.info("Package name '%s' is taken. %s", package_dict["name"], e)
+    package_dict["name"], token = await package_name_registry.reserve(preferred_name)
+    package = await create_package_with_reserved_name(package_dict, token)
+  await package_name_registry.mark_taken(package_dict["name"])
+  return package
+
+async def create_package_with_reserved_name(package_dict, token):
+  """
+  See kq_api.main.create_package_with_reserved_name
+  """
+  try:
+    return await async_bcdc.package_create(package_dict, api_key=settings.BCDC_API_KEY)
+  except bcdc.PackageNameTakenError:
+    await package_name_registry.mark_taken(package_dict["name"])
+    raise
+  except Exception:
+    await package_name_registry.release(package_dict["name"], token)
+    raise
+
+async def create_app_resource(package_id, req_data, format=None):
+  """
+  Adds a new resource which represents the URL of the app to the given package.
+  Unless its format is given (precomputed), the app URL is requested first to
+  determine its content type.
+  """
+  if not format:
+    timeout = deadlines.optional_timeout(deadlines.APP_URL_PROBE, settings.APP_URL_PROBE_TIMEOUT_SECONDS)
+    if timeout is None:
+      logger.warning("Skipped content type probe of app '%s' to meet the request's deadline.", req_data["app"]["url"])
+    else:
+      content_type = await get_content_type(req_data["app"]["url"], timeout)
+      if content_type:
+        format = key_requests.content_type_to_format(content_type, "text")
+      else:
+        logger.warning("Unable to access app '%s' to determine content type.", req_data["app"]["url"])
+
+  resource_dict = key_requests.make_app_resource_dict(package_id, req_data, format or "text")
+  return await async_bcdc.resource_create(resource_dict, api_key=settings.BCDC_API_KEY)
+
+async def get_content_type(url, timeout):
+  """
+  Gets the content type of the given URL, or None if the URL may not be probed, could
+  not be accessed (within timeout seconds) or responded with an error.  See url_probe.
+  """
+  return await url_probe.get_content_type_async(async_bcdc.get_client(), url, timeout)
+
+async def precompute_app_format(req_data):
+  """
+  The format of the app's content, or None if the app could not be accessed (see
+  precompute)
+  """
+  #the task inherits the context of the request which scheduled it, but not its deadline
+  request_deadline.set(None)
+  content_type = await get_content_type(req_data["app"]["url"], settings.APP_URL_PROBE_TIMEOUT_SECONDS)
+  if content_type:
+    return key_requests.content_type_to_format(content_type, "text")
+  return None
+
+def notify_admin(req_data):
+  """
+  Returns a coroutine which notifies the administrators of a verified request,
+  immediately or in the next digest.  See kq_api.main.send_notification_email_to_admin.
+  The notification is prepared before this function returns, so later changes to
+  req_data do not affect it.
+  """
+  if settings.ADMIN_EMAIL_DIGEST_ENABLED and not key_requests.is_urgent(req_data):
+    return add_to_admin_digest(req_data, key_requests.admin_digest_summary(req_data))
+  return send_email(*key_requests.admin_notification_email(req_data))
+
+async def add_to_admin_digest(req_data, summary):
+  try:
+    if await admin_digest.add(summary):
+      await admin_digest.flush(send_admin_digest)
+  except RuntimeError as e:
+    logger.error("%s  Sending admin notification immediately.", e)
+    await send_email(*key_requests.admin_notification_email(req_data))
+
+async def send_admin_digest(summaries):
+  await send_email(*key_requests.admin_digest_email(summaries))
+
+async def send_email(to, subject, body):
+  await send_email_async(
+    to=to,
+    bcc=None,
+    email_subject=subject,
+    email_body=body,
+    smtp_server=settings.SMTP_SERVER,
+    smtp_port=settings.SMTP_PORT,
+    from_email_address=settings.FROM_EMAIL_ADDRESS,
+    from_password=settings.FROM_EMAIL_PASSWORD,
+    timeout=deadlines.timeout(deadlines.SMTP))
+
+def get_client_ip(request):
+  remote_addr = request.client.host if request.client else None
+  return rate_limiter.client_ip(remote_addr, request.headers.get("X-Forwarded-For"), settings.TRUSTED_PROXY_COUNT)
+
+async def check_rate_limits(rule_identities):
+  """
+  Returns a 429 response if any of the given rate limits has been reached, otherwise
+  None.  See kq_api.main.check_rate_limits.
+  """
+  retry_after = await limiter.hit(rule_identities)
+  if not retry_after:
+    return None
+  return JSONResponse({"msg": "Too many requests.  Please try again later."}, 429, headers={"Retry-After": str(retry_after)})
+
+async def wait_for_status_change(request, waiter, status, etag, wait_seconds):
+  """
+  Waits until a status other than the one the client has is published, or
+  wait_seconds have passed.  Returns the latest (status, etag).
+  """
+  deadline = time.time() + wait_seconds
+  #the client may have the ETag of a compressed variant of the status
+  while compression.etags_match(request.headers.get("If-None-Match"), etag):
+    remaining = deadline - time.time()
+    if remaining <= 0:
+      break
+    published = await waiter.wait(remaining)
+    if published is None:
+      break
+    status, etag = published, status_etag(published)
+  return status, etag
+
+def make_precompressed_response(request, body, variants, etag, mimetype):
+  """
+  Creates a response for content which has already been compressed.  See
+  kq_api.main.make_precompressed_response.
+  """
+  encoding = compression.choose_encoding(request.headers.get("Accept-Encoding"), list(variants))
+  if encoding:
+    r = Response(variants[encoding], media_type=mimetype)
+    r.headers["Content-Encoding"] = encoding
+    r.headers["ETag"] = '"{}"'.format(compression.encoded_etag(etag, encoding))
+  else:
+    r = Response(body, media_type=mimetype)
+    r.headers["ETag"] = '"{}"'.format(etag)
+  r.headers["Vary"] = "Accept-Encoding"
+  return r
+
+def make_conditional(request, response, last_modified=None):
+  """
+  Converts the response into a 304 if the request's If-None-Match or
+  If-Modified-Since header shows the client's cached copy is still current.
+  """
+  not_modified = False
+  if_none_match = request.headers.get("If-None-Match")
+  if_modified_since = request.headers.get("If-Modified-Since")
+  if if_none_match:
+    #the variants of the content (see compression.encoded_etag) match each other
+    not_modified = compression.etags_match(if_none_match, response.headers.get("ETag"))
+  elif if_modified_since and last_modified:
+    try:
+      not_modified = parsedate_to_datetime(if_modified_since) >= last_modified
+    except (TypeError, ValueError):
+      pass
+
+  if not not_modified:
+    return response
+  r = Response(status_code=304)
+  for name in ["ETag", "Last-Modified", "Cache-Control", "Vary"]:
+    if name in response.headers:
+      r.headers[name] = response.headers[name]
+  return r
+
+class CorrelationIdMiddleware(object):
+  """
+  Assigns each request a correlation id, which is added to its log records and
+  returned in the X-Request-ID header.  See kq_api.main.assign_correlation_id.
+  """
+
+  def __init__(self, app):
+    self.app = app
+
+  async def __call__(self, scope, receive, send):
+    if scope["type"] != "http":
+      await self.app(scope, receive, send)
+      return
+
+    requested = None
+    for name, value in scope["headers"]:
+      if name == b"x-request-id":
+        requested = value.decode("latin-1")
+    request_id = structured_logging.new_correlation_id(requested)
+    correlation_id.set(request_id)
+
+    async def send_with_request_id(message):
+      if message["type"] == "http.response.start":
+        message = dict(message, headers=list(message.get("headers", [])) + [(b"x-request-id", request_id.encode("latin-1"))])
+      await send(message)
+
+    await self.app(scope, receive, send_with_request_id)
+
+class AllocationProfilingMiddleware(object):
+  """
+  Records the memory allocated by each request, by route.  The ASGI equivalent of
+  kq_api.main.snapshot_allocations and kq_api.main.record_allocations.
+  """
+
+  def __init__(self, app):
+    self.app = app
+
+  async def __call__(self, scope, receive, send):
+    if scope["type"] != "http" or not allocation_profiler.enabled:
+      await self.app(scope, receive, send)
+      return
+
+    before = allocation_profiler.snapshot()
+    try:
+      await self.app(scope, receive, send)
+    finally:
+      #the router adds the endpoint to the scope
+      endpoint = scope.get("endpoint")
+      name = getattr(endpoint, "__name__", None)
+      if name != "get_allocations":
+        allocation_profiler.record(name, before)
+
+class CompressionMiddleware(object):
+  """
+  Compresses HTML and JSON responses.  The ASGI equivalent of
+  kq_api.main.compress_response.
+  """
+
+  def __init__(self, app):
+    self.app = app
+
+  async def __call__(self, scope, receive, send):
+    if scope["type"] != "http" or not settings.COMPRESS_RESPONSES:
+      await self.app(scope, receive, send)
+      return
+
+    accept_encoding = None
+    for name, value in scope["headers"]:
+      if name == b"accept-encoding":
+        accept_encoding = value.decode("latin-1")
+    encoding = compression.choose_encoding(accept_encoding)
+
+    #the start message is held back until the body is known.  streamed responses
+    #(more_body) are passed through unchanged.
+    state = {"start": None, "passthrough": False}
+    async def compressing_send(message):
+      if message["type"] == "http.response.start":
+        headers = dict((k.lower(), v) for k, v in message.get("headers", []))
+        mimetype = headers.get(b"content-type", b"").split(b";")[0].decode("latin-1")
+        if not encoding or b"content-encoding" in headers or mimetype not in COMPRESSIBLE_MIMETYPES:
+          state["passthrough"] = True
+          await send(message)
+        else:
+          state["start"] = message
+        return
+      if state["passthrough"] or message["type"] != "http.response.body":
+        await send(message)
+        return
+
+      start = state["start"]
+      body = message.get("body", b"")
+      headers = [(k, v) for k, v in start.get("headers", []) if k.lower() != b"content-length"]
+      if not message.get("more_body") and len(body) >= settings.COMPRESS_MIN_SIZE_BYTES:
+        body = compression.compress(body, encoding)
+        #each variant has its own ETag.  (make_conditional matches any variant.)
+        headers = [(k, compression.etag_header_with_encoding(v.decode("latin-1"), encoding).encode("latin-1") if k.lower() == b"etag" else v) for k, v in headers]
+        headers.append((b"content-encoding", encoding.encode("latin-1")))
+        headers.append((b"vary", b"Accept-Encoding"))
+      headers.append((b"content-length", str(len(body)).encode("latin-1")))
+      start["headers"] = headers
+      state["passthrough"] = True
+      await send(start)
+      await send(dict(message, body=body))
+
+    await self.app(scope, receive, compressing_send)
+
+# -----------------------------------------------------------------------------
+# Application
+# -----------------------------------------------------------------------------
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+  logger.info("Initializing %s", __name__)
+  flusher = None
+  if settings.ADMIN_EMAIL_DIGEST_ENABLED:
+    flusher = asyncio.ensure_future(admin_digest.flush_periodically(send_admin_digest))
+  status_listener = None
+  if settings.STATUS_LONG_POLL_MAX_SECONDS and not kq_backend:
+    status_listener = asyncio.ensure_future(status_watcher.listen())
+  for backend in [kq_backend, challenge_backend]:
+    if backend:
+      backend.start_snapshots()
+  await asyncio.get_event_loop().run_in_executor(None, challenge_store.warm_up)
+  health_check = asyncio.ensure_future(health_checker.check_periodically())
+  yield
+  health_check.cancel()
+  precomputer.cancel()
+  if flusher:
+    flusher.cancel()
+  if status_listener:
+    status_listener.cancel()
+  await status_watcher.close()
+  await admin_digest.close()
+  await lifecycle.close()
+  await kq_store.close()
+  await challenge_store.close()
+  await submission_store.close()
+  await limiter.close()
+  await package_name_registry.close()
+  await async_bcdc.close_client()
+
+middleware = [Middleware(CorrelationIdMiddleware), Middleware(AllocationProfilingMiddleware), Middleware(CompressionMiddleware)]
+#In debug mode add CORS headers to responses (as in kq_api.main)
+if "FLASK_DEBUG" in os.environ and os.environ["FLASK_DEBUG"]:
+  middleware.append(Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]))
+
+app = Starlette(
+  routes=[
+    Route("/", api, methods=["GET"]),
+    Route("/request_key", with_deadline(admission_controlled(request_key)), methods=["POST"]),
+    Route("/verify_key_request", with_deadline(admission_controlled(verify_key_request)), methods=["GET"]),
+    Route("/status", with_deadline(get_status), methods=["GET"]),
+    Route("/status/batch", with_deadline(get_status_batch), methods=["POST"]),
+    Route("/challenge", with_deadline(new_challenge), methods=["POST"]),
+    Route("/challenge/{challenge_id}.png", with_deadline(admission_controlled(get_captcha_image)), methods=["GET"]),
+    Route("/static/{filename}", get_static_file, methods=["GET"]),
+    Route("/healthz", get_liveness, methods=["GET"]),
+    Route("/readyz", get_readiness, methods=["GET"]),
+    Route("/admin/admission", admin_only(get_admission_stats), methods=["GET"]),
+    Route("/admin/deadlines", admin_only(get_deadline_stats), methods=["GET"]),
+    Route("/admin/allocations", admin_only(get_allocations), methods=["GET", "DELETE"]),
+    Route("/admin/stats", admin_only(get_lifecycle_stats), methods=["GET"])
+  ],
+  middleware=middleware,
+  lifespan=lifespan
+)
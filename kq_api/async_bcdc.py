@@ -0,0 +1,88 @@
+"""
+Purpose: Asynchronous versions of the BCDC functions used while processing a key
+request, for the ASGI application.  Requests are made with a shared httpx.AsyncClient
+(so connections are pooled) and responses are interpreted by the same functions as
+the synchronous versions in bcdc.py.
+"""
+import json
+import httpx
+from . import bcdc
+from . import deadlines
+
+_client = None
+
+def get_client():
+  """
+  Gets the shared HTTP client, creating it on first use.  Must be called from
+  within the event loop.
+  """
+  global _client
+  if _client is None:
+    _client = httpx.AsyncClient()
+  return _client
+
+async def close_client():
+  global _client
+  if _client is not None:
+    await _client.aclose()
+    _client = None
+
+async def get_organization(org_id):
+  """
+  Gets an organization given its id
+  :param org_id: the id of the organiztion to fetch
+  """
+  if not org_id:
+    return None
+
+  url = bcdc.organization_show_url(org_id)
+  r = await _request("GET", url, headers=bcdc.request_headers())
+  return bcdc.parse_organization_show_response(r.status_code, r.text, url)
+
+async def package_create(package_dict, api_key=None):
+  """
+  Creates a new package (dataset) in BCDC
+  :param package_dict: a dictionary with all require package properties
+  :param api_key: the BCDC API key to create the package with
+  """
+  r = await _request("POST", bcdc.action_url("package_create"),
+    content=json.dumps(package_dict),
+    headers=bcdc.request_headers(api_key)
+    )
+  return bcdc.parse_package_create_response(r.status_code, r.text)
+
+async def package_list(timeout=None):
+  """
+  Gets the names of all public packages in BCDC
+  """
+  r = await _request("GET", bcdc.action_url("package_list"), headers=bcdc.request_headers(), timeout=timeout)
+  return bcdc.parse_package_list_response(r.status_code, r.text)
+
+async def status_show(timeout=None):
+  """
+  Gets BCDC's status.  See bcdc.status_show.
+  """
+  r = await _request("GET", bcdc.action_url("status_show"), headers=bcdc.request_headers(), timeout=timeout)
+  return bcdc.parse_status_show_response(r.status_code, r.text)
+
+async def resource_create(resource_dict, api_key=None):
+  """
+  Creates a new resource associated with a given package
+  :param resource_dict: a dictionary with the resource properties (including package_id and url)
+  :param api_key: the BCDC API key to create the resource with
+  """
+  r = await _request("POST", bcdc.action_url("resource_create"),
+    content=json.dumps(resource_dict),
+    headers=bcdc.request_headers(api_key)
+    )
+  return bcdc.parse_resource_create_response(r.status_code, r.text)
+
+async def _request(method, url, timeout=None, **kwargs):
+  """
+  Sends a request to BCDC with the shared client.  See bcdc._request.
+  """
+  timeout = timeout or deadlines.timeout(deadlines.BCDC)
+  try:
+    return await get_client().request(method, url, timeout=timeout, **kwargs)
+  except httpx.TimeoutException:
+    raise RuntimeError("BCDC did not respond within {:.1f} seconds. URL was: {}".format(timeout, url))
@@ -0,0 +1,683 @@
+"""
+Purpose: Asynchronous versions of RequestStore, ChallengeStore, TokenChallengeStore,
+IdempotencyStore, RateLimiter, PackageNameRegistry, AdminDigest, StatusWatcher and
+LifecycleEvents for the ASGI application.  They use the same Redis keys and value formats as the
+synchronous versions, so both applications can share the same Redis databases.
+Requires redis-py 4.2 or later (redis.asyncio).
+"""
+import asyncio
+import json
+import logging
+import math
+import time
+import uuid
+import redis
+from . import settings
+from . import json_codec
+from . import captcha_renderer
+from .challenge_store import SECRET_ALPHABET, generate_challenge, secrets_match, used_token_args
+from . import challenge_tokens
+from . import idempotency_store
+from .idempotency_store import CLAIM_SCRIPT, PENDING_TTL_SECONDS
+from .rate_limiter import SLIDING_WINDOW_SCRIPT, make_script_args
+from . import package_names
+from . import admin_digest
+from . import lifecycle_events
+from .key_requests import SUBMITTED_AT_KEY, owner_org_id
+from . import async_bcdc
+from .redis_clients import ShardRing, create_async_client, ping_async
+from . import storage
+from . import deadlines
+from . import status_watcher
+from .request_store import STATUS_CHANNEL_PREFIX, status_notification, compact, status_of, precomputed_key, is_verification_code
+
+logger = logging.getLogger(__name__)
+
+class AsyncRedisBackend(object):
+  """
+  Stores values in Redis.  See RedisBackend.
+  """
+
+  def __init__(self, client):
+    self._client = client
+
+  async def get(self, key):
+    return await self._client.get(key)
+
+  async def get_many(self, keys):
+    return await self._client.mget(keys)
+
+  async def set(self, key, value, ttl_seconds, notify=None):
+    if not notify:
+      await self._client.set(key, value, ex=ttl_seconds)
+      return
+    pipe = self._client.pipeline()
+    pipe.set(key, value, ex=ttl_seconds)
+    pipe.publish(*notify)
+    await pipe.execute()
+
+  async def delete(self, key):
+    await self._client.delete(key)
+
+  async def ping(self):
+    return {"backend": storage.REDIS, "connections": await ping_async(self._client)}
+
+  async def close(self):
+    await self._client.close()
+
+class AsyncInProcessBackend(object):
+  """
+  Adapts an InProcessBackend to the asynchronous interface.  Its operations never
+  wait for I/O, so they are called directly on the event loop.
+  """
+
+  def __init__(self, backend):
+    self.backend = backend
+
+  async def get(self, key):
+    return self.backend.get(key)
+
+  async def get_many(self, keys):
+    return self.backend.get_many(keys)
+
+  async def set(self, key, value, ttl_seconds, notify=None):
+    self.backend.set(key, value, ttl_seconds, notify=notify)
+
+  async def delete(self, key):
+    self.backend.delete(key)
+
+  async def ping(self):
+    return self.backend.ping()
+
+  async def close(self):
+    pass
+
+class AsyncRequestStore(object):
+  """
+  Persists API key requests.  See RequestStore.
+  """
+
+  def __init__(self, db_url, default_ttl_seconds=settings.SECONDS_PER_DAY, status_ttl_seconds=None, backend=None):
+    """
+    :param status_ttl_seconds: the TTL of compacted (verified) requests
+    :param backend: an InProcessBackend in which to keep requests instead of the Redis
+      database at db_url
+    """
+    self.db_url = db_url
+    self._default_ttl_seconds = default_ttl_seconds
+    self._status_ttl_seconds = status_ttl_seconds or default_ttl_seconds
+    if backend:
+      self._store = AsyncInProcessBackend(backend)
+    else:
+      self._store = AsyncRedisBackend(create_async_client(db_url, socket_timeout=settings.OUTBOUND_TIMEOUT_SECONDS))
+
+  async def save_request(self, req_data, verification_code=None, ttl_seconds=None):
+    """
+    Saves the given API request object.  Returns its verification code (a new one is
+    assigned if none is given).
+    """
+    if not verification_code:
+      verification_code = str(uuid.uuid4())
+    if not ttl_seconds:
+      ttl_seconds = self._default_ttl_seconds
+    try:
+      await self._store.set(verification_code, json_codec.dumps(req_data), ttl_seconds, notify=status_notification(verification_code, req_data))
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+      logger.error("Unable to connect to Redis database: '%s'.", self.db_url)
+      raise RuntimeError("Unable to connect to Redis database.")
+    return verification_code
+
+  async def load_request(self, verification_code):
+    """
+    If the verification_code exists, returns the corresponding request data
+    (req_data) object. Otherwise returns None.
+    """
+    if not is_verification_code(verification_code):
+      return None
+    deadlines.check(deadlines.KQ_STORE)
+    try:
+      req_data_as_json = await self._store.get(verification_code)
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+      logger.error("Unable to connect to Redis database: '%s'.", self.db_url)
+      raise RuntimeError("Unable to connect to Redis database")
+    if not req_data_as_json:
+      return None
+    return json_codec.loads(req_data_as_json)
+
+  async def load_many(self, verification_codes):
+    """
+    Loads the status of several requests in one round trip.  See RequestStore.load_many.
+    """
+    statuses = dict.fromkeys(verification_codes)
+    valid_codes = [code for code in statuses if is_verification_code(code)]
+    if not valid_codes:
+      return statuses
+    deadlines.check(deadlines.KQ_STORE)
+    try:
+      values = await self._store.get_many(valid_codes)
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+      logger.error("Unable to connect to Redis database: '%s'.", self.db_url)
+      raise RuntimeError("Unable to connect to Redis database")
+    statuses.update((code, status_of(value)) for code, value in zip(valid_codes, values))
+    return statuses
+
+  async def save_precomputed(self, verification_code, results):
+    """
+    Saves the results of steps precomputed for a request.  See
+    RequestStore.save_precomputed.
+    """
+    try:
+      await self._store.set(precomputed_key(verification_code), json_codec.dumps(results), self._default_ttl_seconds)
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+      logger.error("Unable to connect to Redis database: '%s'.", self.db_url)
+      raise RuntimeError("Unable to connect to Redis database.")
+
+  async def load_precomputed(self, verification_code):
+    try:
+      value = await self._store.get(precomputed_key(verification_code))
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+      logger.warning("Unable to load precomputed results from Redis database: '%s'.", self.db_url)
+      return {}
+    return json_codec.loads(value) if value else {}
+
+  async def compact_request(self, req_data, verification_code):
+    """
+    Replaces a verified request with just its status.  See RequestStore.compact_request.
+    """
+    verification_code = await self.save_request(compact(req_data), verification_code=verification_code, ttl_seconds=self._status_ttl_seconds)
+    try:
+      await self._store.delete(precomputed_key(verification_code))
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+      logger.warning("Unable to delete precomputed results from Redis database: '%s'.", self.db_url)
+    return verification_code
+
+  async def ping(self):
+    return await self._store.ping()
+
+  async def close(self):
+    await self._store.close()
+
+class AsyncShardedRedis(object):
+  """
+  Spreads single-key commands across several Redis nodes.  See ShardedRedis.
+  """
+
+  def __init__(self, urls, **kwargs):
+    self.urls = urls
+    self._clients = [create_async_client(url, **kwargs) for url in urls]
+    self._ring = ShardRing(urls)
+
+  def client_for(self, key):
+    return self._clients[self._ring.index(key)]
+
+  async def get(self, key):
+    return await self.client_for(key).get(key)
+
+  async def set(self, key, value, **kwargs):
+    return await self.client_for(key).set(key, value, **kwargs)
+
+  async def delete(self, key):
+    return await self.client_for(key).delete(key)
+
+  async def ping(self):
+    for client in self._clients:
+      await client.ping()
+    return True
+
+  def connection_pools(self):
+    return [client.connection_pool for client in self._clients]
+
+  async def close(self):
+    for client in self._clients:
+      await client.close()
+
+class AsyncChallengeStore(object):
+  """
+  Stores captcha challenges.  See ChallengeStore.  Captcha images are rendered
+  in the default thread pool so that rendering does not block the event loop.
+  """
+
+  def __init__(self, db_url, default_ttl_seconds=settings.SECONDS_PER_DAY, shard_urls=None, backend=None):
+    self.db_url = db_url
+    self._default_ttl_seconds = default_ttl_seconds
+    if backend:
+      self._store = AsyncInProcessBackend(backend)
+    elif shard_urls:
+      self._store = AsyncRedisBackend(AsyncShardedRedis(shard_urls, socket_timeout=settings.OUTBOUND_TIMEOUT_SECONDS))
+    else:
+      self._store = AsyncRedisBackend(create_async_client(db_url, socket_timeout=settings.OUTBOUND_TIMEOUT_SECONDS))
+    self._imageCaptcha = captcha_renderer.create_renderer(SECRET_ALPHABET)
+
+  def warm_up(self):
+    """
+    Loads the captcha fonts (or builds the glyph atlas).  Blocking; run it in an executor.
+    """
+    captcha_renderer.warm_up(self._imageCaptcha)
+
+  async def new_challenge(self):
+    challenge = generate_challenge()
+    try:
+      await self._store.set(challenge["challenge_id"], challenge["secret"].encode('utf-8'), self._default_ttl_seconds)
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+      logger.error("Unable to connect to Redis database: '%s'. %s", self.db_url, e)
+      raise RuntimeError("Unable to connect to Redis database.")
+    except redis.exceptions.ResponseError as e:
+      logger.error("Unable to save challenge to Redis database: %s.", e)
+      raise RuntimeError("Unable to save challenge.")
+    return challenge
+
+  async def is_valid(self, challenge_id, secret_to_check):
+    return secrets_match(await self._get_secret(challenge_id), secret_to_check)
+
+  async def challenge_id_to_captcha(self, challenge_id):
+    """
+    Creates a new PNG image which shows the secret corresponding
+    to the specified challenge_id
+    Returns a ByteIO object with the image content
+    """
+    secret = await self._get_secret(challenge_id)
+    if not secret:
+      raise ValueError("No such challenge")
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, self._imageCaptcha.generate, secret.decode('utf-8'))
+
+  async def _get_secret(self, challenge_id):
+    if not challenge_id:
+      return None
+    deadlines.check(deadlines.CAPTCHA_STORE)
+    try:
+      return await self._store.get(challenge_id)
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+      logger.error("Unable to connect to Redis database: '%s'.", self.db_url)
+      raise RuntimeError("Unable to connect to Redis database")
+    except redis.exceptions.ResponseError as e:
+      logger.error("Unable to get challenge from Redis database: %s.", e)
+      raise RuntimeError("Unable to get challenge.")
+
+  async def ping(self):
+    return await self._store.ping()
+
+  async def close(self):
+    await self._store.close()
+
+class AsyncTokenChallengeStore(object):
+  """
+  Creates and checks self-contained challenge tokens.  See TokenChallengeStore.
+  """
+
+  def __init__(self, db_url, default_ttl_seconds=settings.SECONDS_PER_DAY, server_key=None):
+    self.db_url = db_url
+    self._default_ttl_seconds = int(default_ttl_seconds)
+    self._keys = challenge_tokens.TokenKeys(server_key)
+    self._store = create_async_client(db_url, socket_timeout=settings.OUTBOUND_TIMEOUT_SECONDS)
+    self._imageCaptcha = captcha_renderer.create_renderer(SECRET_ALPHABET)
+
+  def warm_up(self):
+    """
+    Loads the captcha fonts (or builds the glyph atlas).  Blocking; run it in an executor.
+    """
+    captcha_renderer.warm_up(self._imageCaptcha)
+
+  async def new_challenge(self):
+    challenge = generate_challenge()
+    challenge["challenge_id"] = challenge_tokens.seal(challenge["secret"], time.time() + self._default_ttl_seconds, self._keys)
+    return challenge
+
+  async def is_valid(self, challenge_id, secret_to_check):
+    if not secrets_match(challenge_tokens.unseal(challenge_id, self._keys), secret_to_check):
+      return False
+    key, ttl_seconds = used_token_args(challenge_id)
+    deadlines.check(deadlines.CAPTCHA_STORE)
+    try:
+      first_use = await self._store.set(key, 1, nx=True, ex=ttl_seconds)
+    except redis.exceptions.RedisError as e:
+      logger.error("Unable to record used challenge token in Redis database: '%s'. %s", self.db_url, e)
+      raise RuntimeError("Unable to record used challenge token.")
+    return bool(first_use)
+
+  async def challenge_id_to_captcha(self, challenge_id):
+    secret = challenge_tokens.unseal(challenge_id, self._keys)
+    if not secret:
+      raise ValueError("No such challenge")
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, self._imageCaptcha.generate, secret)
+
+  async def ping(self):
+    return {"backend": storage.REDIS, "connections": await ping_async(self._store)}
+
+  async def close(self):
+    await self._store.close()
+
+class AsyncIdempotencyStore(object):
+  """
+  Suppresses duplicate submissions of API key requests.  See IdempotencyStore.
+  """
+
+  def __init__(self, db_url, key_ttl_seconds=settings.SECONDS_PER_DAY, window_seconds=600):
+    self.db_url = db_url
+    self._key_ttl_seconds = key_ttl_seconds
+    self._window_seconds = window_seconds
+    self._store = create_async_client(db_url)
+    self._claim_script = self._store.register_script(CLAIM_SCRIPT)
+
+  async def begin(self, idempotency_key, req_data):
+    claim = idempotency_store.make_claim(idempotency_key, req_data, self._key_ttl_seconds, self._window_seconds)
+    if not claim["keys"]:
+      return {"outcome": idempotency_store.NEW, "claim": claim}
+    try:
+      result = await self._claim_script(keys=claim["keys"], args=[idempotency_store.pending_value(claim), PENDING_TTL_SECONDS])
+    except redis.exceptions.ConnectionError as e:
+      logger.error("Unable to connect to Redis database: '%s'.", self.db_url)
+      raise RuntimeError("Unable to connect to Redis database.")
+    return idempotency_store.claim_outcome(claim, result)
+
+  async def complete(self, claim, response):
+    """
+    Records the response to a submission, or releases the claim if it can't be
+    recorded.  See IdempotencyStore.complete.
+    """
+    if not claim["keys"]:
+      return
+    try:
+      value = idempotency_store.completed_value(claim, response)
+      pipe = self._store.pipeline()
+      for key, ttl in zip(claim["keys"], claim["ttls"]):
+        pipe.set(key, value, ex=ttl)
+      await pipe.execute()
+    except (TypeError, ValueError) as e:
+      logger.error("Unable to encode the response to a submission. %s", e)
+      await self.release(claim)
+    except redis.exceptions.RedisError as e:
+      logger.error("Unable to record the response to a submission in Redis database: '%s'. %s", self.db_url, e)
+      await self.release(claim)
+
+  async def release(self, claim):
+    if not claim["keys"]:
+      return
+    try:
+      await self._store.delete(*claim["keys"])
+    except redis.exceptions.RedisError as e:
+      logger.error("Unable to connect to Redis database: '%s'.", self.db_url)
+
+  async def close(self):
+    await self._store.close()
+
+class AsyncRateLimiter(object):
+  """
+  Limits how often a client may call an endpoint.  See RateLimiter.
+  """
+
+  def __init__(self, db_url, rules=None, enabled=True):
+    self.db_url = db_url
+    self._rules = rules or {}
+    self._enabled = enabled
+    self._store = create_async_client(db_url)
+    self._script = self._store.register_script(SLIDING_WINDOW_SCRIPT)
+
+  async def hit(self, rule_identities):
+    keys, args = make_script_args(self._rules, rule_identities) if self._enabled else ([], [])
+    if not keys:
+      return 0
+    try:
+      retry_after_ms = await self._script(keys=keys, args=args)
+    except redis.exceptions.RedisError as e:
+      logger.error("Unable to check rate limits in Redis database: '%s'. %s", self.db_url, e)
+      return 0
+    return int(math.ceil(retry_after_ms / 1000.0))
+
+  async def close(self):
+    await self._store.close()
+
+class AsyncPackageNameRegistry(object):
+  """
+  Chooses unique names for new BCDC packages.  See PackageNameRegistry.
+  """
+
+  def __init__(self, db_url, cache_ttl_seconds=3600, reservation_ttl_seconds=3600):
+    self.db_url = db_url
+    self._cache_ttl_seconds = cache_ttl_seconds
+    self._reservation_ttl_seconds = reservation_ttl_seconds
+    self._store = create_async_client(db_url)
+    self._reserve_script = self._store.register_script(package_names.RESERVE_SCRIPT)
+    self._release_script = self._store.register_script(package_names.RELEASE_SCRIPT)
+    self._refresh_tasks = set()
+
+  async def reserve(self, name):
+    """
+    Returns a tuple (name, reservation token).  Stale names are refreshed by a
+    background task.  See PackageNameRegistry.reserve.
+    """
+    token = uuid.uuid4().hex
+    try:
+      if await self.claim_refresh():
+        task = asyncio.ensure_future(self.refresh(timeout=settings.OUTBOUND_TIMEOUT_SECONDS))
+        self._refresh_tasks.add(task)
+        task.add_done_callback(self._refresh_tasks.discard)
+      reserved = await self._reserve_script(keys=[package_names.KNOWN_NAMES_KEY],
+        args=package_names.reserve_args(name, token, self._reservation_ttl_seconds))
+    except redis.exceptions.RedisError as e:
+      logger.error("Unable to reserve package name in Redis database: '%s'. %s", self.db_url, e)
+      return (name, None)
+    if not reserved:
+      logger.warning("No unique package name available for '%s'.", name)
+      return (name, None)
+    return (reserved.decode("utf-8") if isinstance(reserved, bytes) else reserved, token)
+
+  async def release(self, name, token):
+    if not token:
+      return
+    try:
+      await self._release_script(keys=[package_names.reservation_key(name)], args=[token])
+    except redis.exceptions.RedisError as e:
+      logger.error("Unable to release package name in Redis database: '%s'. %s", self.db_url, e)
+
+  async def mark_taken(self, name):
+    try:
+      await self._store.sadd(package_names.KNOWN_NAMES_KEY, name)
+    except redis.exceptions.RedisError as e:
+      logger.error("Unable to record package name in Redis database: '%s'. %s", self.db_url, e)
+
+  async def refresh_if_stale(self):
+    if await self.claim_refresh():
+      await self.refresh()
+
+  async def claim_refresh(self):
+    if await self._store.exists(package_names.REFRESHED_KEY):
+      return False
+    return bool(await self._store.set(package_names.REFRESH_LOCK_KEY, 1, nx=True, ex=package_names.REFRESH_LOCK_TTL_SECONDS))
+
+  async def refresh(self, timeout=None):
+    try:
+      names = await async_bcdc.package_list(timeout=timeout)
+    except Exception as e:
+      logger.warning("Unable to refresh package names from BCDC. %s", e)
+      return
+    try:
+      pipe = self._store.pipeline()
+      for command in package_names.add_known_names_commands(names, self._cache_ttl_seconds):
+        pipe.execute_command(*command)
+      await pipe.execute()
+    except redis.exceptions.RedisError as e:
+      logger.error("Unable to save package names in Redis database: '%s'. %s", self.db_url, e)
+
+  async def close(self):
+    for task in list(self._refresh_tasks):
+      task.cancel()
+    await self._store.close()
+
+class AsyncAdminDigest(object):
+  """
+  Collects summaries of verified requests for the admin digest email.  See AdminDigest.
+  """
+
+  def __init__(self, db_url, interval_seconds=3600, max_items=20):
+    self.db_url = db_url
+    self._interval_seconds = interval_seconds
+    self._max_items = max_items
+    self._store = create_async_client(db_url)
+    self._add_script = self._store.register_script(admin_digest.ADD_SCRIPT)
+    self._take_script = self._store.register_script(admin_digest.TAKE_SCRIPT)
+
+  async def add(self, summary):
+    try:
+      count = await self._add_script(keys=[admin_digest.ITEMS_KEY, admin_digest.STARTED_KEY], args=[json.dumps(summary), time.time()])
+    except redis.exceptions.RedisError as e:
+      logger.error("Unable to add to admin digest in Redis database: '%s'. %s", self.db_url, e)
+      raise RuntimeError("Unable to add to admin digest.")
+    return count >= self._max_items
+
+  async def take_if_due(self):
+    try:
+      items = await self._take_script(keys=[admin_digest.ITEMS_KEY, admin_digest.STARTED_KEY], args=[self._max_items, self._interval_seconds, time.time()])
+    except redis.exceptions.RedisError as e:
+      logger.error("Unable to read admin digest from Redis database: '%s'. %s", self.db_url, e)
+      return []
+    return [json.loads(item) for item in items]
+
+  async def restore(self, summaries):
+    if not summaries:
+      return
+    try:
+      await self._store.lpush(admin_digest.ITEMS_KEY, *[json.dumps(s) for s in reversed(summaries)])
+      await self._store.set(admin_digest.STARTED_KEY, time.time(), nx=True)
+    except redis.exceptions.RedisError as e:
+      logger.error("Unable to restore %s admin digest items. %s", len(summaries), e)
+
+  async def flush(self, send_digest):
+    """
+    Sends the digest if it is due.  send_digest is a coroutine function which sends a
+    list of summaries.
+    """
+    summaries = await self.take_if_due()
+    if not summaries:
+      return
+    try:
+      await send_digest(summaries)
+    except Exception as e:
+      logger.error("Unable to send admin digest of %s requests. %s", len(summaries), e)
+      await self.restore(summaries)
+
+  async def flush_periodically(self, send_digest):
+    while True:
+      await asyncio.sleep(admin_digest.FLUSH_CHECK_SECONDS)
+      await self.flush(send_digest)
+
+  async def close(self):
+    await self._store.close()
+
+class AsyncLifecycleEvents(object):
+  """
+  Records lifecycle events and reads the daily statistics.  See LifecycleEvents.
+  """
+
+  def __init__(self, db_url, enabled=True, stream_max_length=100000, retention_days=400):
+    self.db_url = db_url
+    self.enabled = enabled
+    self.stream_max_length = stream_max_length
+    self.retention_days = retention_days
+    self._store = create_async_client(db_url)
+    self._record_script = self._store.register_script(lifecycle_events.RECORD_SCRIPT)
+
+  async def submitted(self, req_data, verification_code, ttl_seconds):
+    await self.record(lifecycle_events.SUBMITTED, org=owner_org_id(req_data), code=verification_code, expires=time.time() + int(ttl_seconds))
+
+  async def verified(self, req_data, verification_code):
+    submitted_at = req_data.get(SUBMITTED_AT_KEY)
+    verify_seconds = max(time.time() - submitted_at, 0) if submitted_at else None
+    await self.record(lifecycle_events.VERIFIED, org=owner_org_id(req_data), code=verification_code, verify_seconds=verify_seconds)
+
+  async def challenge_created(self):
+    await self.record(lifecycle_events.CHALLENGE_CREATED)
+
+  async def captcha_served(self):
+    await self.record(lifecycle_events.CAPTCHA_SERVED)
+
+  async def record(self, event, org=None, code=None, expires=None, verify_seconds=None):
+    if not self.enabled:
+      return
+    try:
+      await self._record_script(keys=[lifecycle_events.STREAM_KEY, lifecycle_events.PENDING_KEY], args=lifecycle_events.script_args(self, event, org, code, expires, verify_seconds))
+    except redis.exceptions.RedisError as e:
+      logger.error("Unable to record '%s' event in Redis database: '%s'. %s", event, self.db_url, e)
+
+  async def stats(self, days=7):
+    dates = lifecycle_events.recent_dates(days)
+    try:
+      await self._record_script(keys=[lifecycle_events.STREAM_KEY, lifecycle_events.PENDING_KEY], args=lifecycle_events.script_args(self, None))
+      pipe = self._store.pipeline()
+      for date in dates:
+        pipe.hgetall(lifecycle_events.day_key(date))
+      hashes = await pipe.execute()
+    except redis.exceptions.RedisError as e:
+      logger.error("Unable to read statistics from Redis database: '%s'. %s", self.db_url, e)
+      raise RuntimeError("Unable to read statistics.")
+    return lifecycle_events.summarize(dates, hashes)
+
+  async def close(self):
+    await self._store.close()
+
+class AsyncStatusWaiter(object):
+  """
+  A request waiting for the status of one API key request to change.  See StatusWaiter.
+  """
+
+  def __init__(self, verification_code):
+    self.verification_code = verification_code
+    self.status = None
+    self._event = asyncio.Event()
+
+  def notify(self, status):
+    self.status = status
+    self._event.set()
+
+  async def wait(self, timeout_seconds):
+    try:
+      await asyncio.wait_for(self._event.wait(), timeout_seconds)
+    except asyncio.TimeoutError:
+      return None
+    self._event.clear()
+    return self.status
+
+class AsyncStatusWatcher(object):
+  """
+  Dispatches published statuses to the requests waiting for them.  See StatusWatcher.
+  The listener runs as a task on the application's event loop.
+  """
+
+  def __init__(self, db_url):
+    self.db_url = db_url
+    self._store = create_async_client(db_url)
+    self._waiters = {}
+
+  def watch(self, verification_code):
+    waiter = AsyncStatusWaiter(str(verification_code))
+    self._waiters.setdefault(waiter.verification_code, set()).add(waiter)
+    return waiter
+
+  def unwatch(self, waiter):
+    waiters = self._waiters.get(waiter.verification_code)
+    if waiters:
+      waiters.discard(waiter)
+      if not waiters:
+        del self._waiters[waiter.verification_code]
+
+  def dispatch(self, message):
+    verification_code, status = status_watcher.parse_status_message(message)
+    for waiter in list(self._waiters.get(verification_code, [])):
+      waiter.notify(status)
+
+  async def listen(self):
+    while True:
+      pubsub = self._store.pubsub(ignore_subscribe_messages=True)
+      try:
+        await pubsub.psubscribe(STATUS_CHANNEL_PREFIX + "*")
+        async for message in pubsub.listen():
+          self.dispatch(message)
+      except redis.exceptions.RedisError as e:
+        logger.error("Status listener lost its connection to Redis database: '%s'. %s", self.db_url, e)
+      finally:
+        await pubsub.close()
+      await asyncio.sleep(status_watcher.LISTENER_RETRY_SECONDS)
+
+  async def close(self):
+    await self._store.close()
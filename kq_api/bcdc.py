@@ -2,6 +2,21 @@ import json
 import requests
 import re
 from . import settings
+from . import deadlines
+
+#CKAN package names are 2 to 100 characters long
+MAX_PACKAGE_NAME_LENGTH = 100
+
+#part of the error CKAN reports (with HTTP 409) for a package name which is in use
+#("That URL is already in use.").  other errors about the name (e.g. its format) use
+#the same status.
+NAME_TAKEN_MESSAGE = "already in use"
+
+class PackageNameTakenError(ValueError):
+  """
+  Raised when BCDC rejects a new package because its name is already in use
+  """
+  pass
 
 def get_organization(org_id):
   """
@@ -11,23 +26,28 @@ def get_organization(org_id):
   if not org_id:
     return None
 
-  url = "{}{}/action/organization_show?id={}".format(settings.BCDC_BASE_URL, settings.BCDC_API_PATH, org_id)
-   
-  headers = {
-    "Content-Type": "application/json",
-  }
-  r = requests.get(url, 
-      headers=headers
+  url = organization_show_url(org_id)
+  r = _request("GET", url, 
+      headers=request_headers()
     )
-  
-  if r.status_code == 404:
+  return parse_organization_show_response(r.status_code, r.text, url)
+
+def organization_show_url(org_id):
+  return "{}{}/action/organization_show?id={}".format(settings.BCDC_BASE_URL, settings.BCDC_API_PATH, org_id)
+
+def parse_organization_show_response(status_code, text, url):
+  """
+  Interprets the response from BCDC's organization_show action.  Returns the
+  organization, or None if it doesn't exist.
+  """
+  if status_code == 404:
     return None
-  elif r.status_code >= 400:
+  elif status_code >= 400:
     raise RuntimeError("Unable to fetch organization by id from BCDC. URL was: {}".format(url))
     #raise ValueError("HTTP {} - {}".format(r.status_code, r.text))
   
   #get the response object
-  response_dict = json.loads(r.text)
+  response_dict = json.loads(text)
   assert response_dict['success'] is True
   organization = response_dict['result']
 
@@ -37,56 +57,93 @@ def package_create(package_dict, api_key=None):
   """
   Creates a new package (dataset) in BCDC
   :param package_dict: a dictionary with all require package properties
-  :param user: the username to create the package under
-  :param password: the password associated with the user
+  :param api_key: the BCDC API key to create the package with
   """
-  url = "{}{}/action/package_create".format(settings.BCDC_BASE_URL, settings.BCDC_API_PATH)
-   
-  headers = {
-    "Content-Type": "application/json",
-    "Authorization": api_key
-  }
-  r = requests.post(url, 
+  url = action_url("package_create")
+  r = _request("POST", url, 
     data=json.dumps(package_dict),
-    headers=headers
+    headers=request_headers(api_key)
     )
-  
+  return parse_package_create_response(r.status_code, r.text)
+
+def parse_package_create_response(status_code, text):
+  """
+  Interprets the response from BCDC's package_create action.  Returns the new package.
+  Raises ValueError if BCDC rejected the package because of the input data, or 
+  RuntimeError for other errors.
+  """
   #A list of http codes returned by BCDC's package_create resource which correspond to errors
   #in the input data
   USER_INPUT_ERROR_CODES = [400, 409]
 
-  if r.status_code >= 400 and r.status_code not in USER_INPUT_ERROR_CODES:
-    raise RuntimeError("Unable to create metadata record.  {}".format(r.text))
+  if status_code >= 400 and status_code not in USER_INPUT_ERROR_CODES:
+    raise RuntimeError("Unable to create metadata record.  {}".format(text))
 
   #get the response object
-  response_dict = json.loads(r.text)
+  response_dict = json.loads(text)
   
-  if r.status_code in USER_INPUT_ERROR_CODES:
+  if status_code in USER_INPUT_ERROR_CODES:
     error_msg = response_dict.get("error", {}).get("name")
     if isinstance(error_msg, list):
       error_msg = " ".join(error_msg)
+    #CKAN reports all validation errors with HTTP 409.  Only the error for a name in
+    #use means another name may succeed.
+    if status_code == 409 and error_msg and NAME_TAKEN_MESSAGE in error_msg.lower():
+      raise PackageNameTakenError("{}".format(error_msg))
     raise ValueError("{}".format(error_msg))
-#  r.raise_for_status()
-#  print(r.text)
   
   created_package = response_dict['result']
   return created_package
 
 
+def package_list(timeout=None):
+  """
+  Gets the names of all public packages in BCDC
+  """
+  r = _request("GET", action_url("package_list"), headers=request_headers(), timeout=timeout)
+  return parse_package_list_response(r.status_code, r.text)
+
+def parse_package_list_response(status_code, text):
+  """
+  Interprets the response from BCDC's package_list action.  Returns a list of package names.
+  """
+  if status_code >= 400:
+    raise RuntimeError("Unable to fetch list of packages from BCDC.  HTTP {}".format(status_code))
+
+  response_dict = json.loads(text)
+  assert response_dict['success'] is True
+  return response_dict['result']
+
+def status_show(timeout=None):
+  """
+  Gets BCDC's status (CKAN version and extensions).  A cheap request used to check
+  that BCDC is available.
+  :param timeout: the maximum number of seconds to wait for a response
+  """
+  r = _request("GET", action_url("status_show"), headers=request_headers(), timeout=timeout)
+  return parse_status_show_response(r.status_code, r.text)
+
+def parse_status_show_response(status_code, text):
+  """
+  Interprets the response from BCDC's status_show action.  Returns the status.
+  """
+  if status_code >= 400:
+    raise RuntimeError("Unable to fetch status from BCDC.  HTTP {}".format(status_code))
+
+  response_dict = json.loads(text)
+  assert response_dict['success'] is True
+  return response_dict['result']
+
 def package_delete(package, api_key):
   """
   deletes a package
   """
-  url = "{}{}/action/package_delete".format(settings.BCDC_BASE_URL, settings.BCDC_API_PATH)
-   
-  headers = {
-    "Content-Type": "application/json",
-    "Authorization": api_key
-  }
+  url = action_url("package_delete")
+  headers = request_headers(api_key)
   data={
     "id": package["id"]
   }
-  r = requests.post(url, 
+  r = _request("POST", url, 
     data=json.dumps(data),
     headers=headers
     )
@@ -97,31 +154,46 @@ def package_delete(package, api_key):
 def resource_create(resource_dict, api_key=None):
   """
   Creates a new resource associated with a given package
-  :param package_id: the id of the package to associate the resource with
-  :param url: the url of the resource
+  :param resource_dict: a dictionary with the resource properties (including package_id and url)
+  :param api_key: the BCDC API key to create the resource with
   """
-  url = "{}{}/action/resource_create".format(settings.BCDC_BASE_URL, settings.BCDC_API_PATH)
-   
-  headers = {
-    "Content-Type": "application/json",
-    "Authorization": api_key
-  }
-  r = requests.post(url, 
+  url = action_url("resource_create")
+  r = _request("POST", url, 
     data=json.dumps(resource_dict),
-    headers=headers
+    headers=request_headers(api_key)
     )
+  return parse_resource_create_response(r.status_code, r.text)
 
-  if r.status_code >= 400:
-    raise ValueError("{} {}".format(r.status_code, r.text))
-#  r.raise_for_status()
-#  print(r.text)
+def parse_resource_create_response(status_code, text):
+  """
+  Interprets the response from BCDC's resource_create action.  Returns the new resource.
+  """
+  if status_code >= 400:
+    raise ValueError("{} {}".format(status_code, text))
   
   #get the response object
-  response_dict = json.loads(r.text)
+  response_dict = json.loads(text)
   assert response_dict['success'] is True
-  created_package = response_dict['result']
+  created_resource = response_dict['result']
 
-  return created_package
+  return created_resource
+
+def action_url(action):
+  """
+  the url of a BCDC API action (e.g. "package_create")
+  """
+  return "{}{}/action/{}".format(settings.BCDC_BASE_URL, settings.BCDC_API_PATH, action)
+
+def request_headers(api_key=None):
+  """
+  the headers sent with each request to the BCDC API
+  """
+  headers = {
+    "Content-Type": "application/json",
+  }
+  if api_key:
+    headers["Authorization"] = api_key
+  return headers
 
 def package_id_to_web_url(package_id):
   """
@@ -138,4 +210,30 @@ def package_id_to_api_url(package_id):
 def prepare_package_name(s):
   s = s.lower()
   s = re.sub('[\W\s]+', '-', s)
-  return s
\ No newline at end of file
+  return s
+
+def package_name_candidates(name, count):
+  """
+  Alternative names to use if a package name is already taken, in order of 
+  preference: the name itself, then the name with the suffixes -2, -3, etc.  Names are 
+  shortened (if necessary) so that the suffix fits within MAX_PACKAGE_NAME_LENGTH.
+  :param name: the preferred name (see prepare_package_name)
+  :param count: the number of candidates
+  """
+  candidates = [name[:MAX_PACKAGE_NAME_LENGTH]]
+  for n in range(2, count + 1):
+    suffix = "-{}".format(n)
+    candidates.append(name[:MAX_PACKAGE_NAME_LENGTH - len(suffix)] + suffix)
+  return candidates
+
+def _request(method, url, timeout=None, **kwargs):
+  """
+  Sends a request to BCDC.  The timeout is the remaining budget of the current request
+  (see deadlines) unless one is given.  Raises RuntimeError if BCDC doesn't respond
+  in time.
+  """
+  timeout = timeout or deadlines.timeout(deadlines.BCDC)
+  try:
+    return requests.request(method, url, timeout=timeout, **kwargs)
+  except requests.exceptions.Timeout:
+    raise RuntimeError("BCDC did not respond within {:.1f} seconds. URL was: {}".format(timeout, url))
@@ -0,0 +1,239 @@
+"""
+Purpose: Renders captcha images.  Two renderers are available (see CAPTCHA_RENDERER):
+
+- ImageCaptcha (from the captcha package) rasterizes, rotates and warps every
+  character from TrueType fonts, then adds noise, with several PIL passes per image.
+- GlyphAtlasCaptcha does the expensive work once.  When it is first used, it renders
+  many randomly rotated and warped variants of each character of the secret alphabet
+  (an atlas).  Each captcha is then composed from randomly chosen variants with NumPy
+  array operations.  Random spacing, overlap, vertical jitter, colours, noise dots, a
+  noise curve and smoothing are applied per image, as ImageCaptcha does.
+
+GlyphAtlasCaptcha requires NumPy.  If NumPy is not installed, ImageCaptcha is used.
+"""
+import logging
+import secrets
+import threading
+from io import BytesIO
+from captcha.image import ImageCaptcha, DEFAULT_FONTS
+from PIL import Image, ImageDraw, ImageFont
+from . import settings
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+logger = logging.getLogger(__name__)
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+IMAGE_CAPTCHA = "imagecaptcha"
+GLYPH_ATLAS = "atlas"
+
+#distortion of each glyph variant (the same ranges as ImageCaptcha)
+ROTATE_DEGREES = (-30, 30)
+WARP_DX = (0.1, 0.3)
+WARP_DY = (0.2, 0.3)
+
+#composition of each image
+SPACE_PROBABILITY = 0.5
+MAX_OVERLAP = 0.25
+NOISE_DOTS = 30
+NOISE_CURVE_POINTS = 400
+
+#PIL's SMOOTH filter
+SMOOTH_CENTER_WEIGHT = 5
+SMOOTH_TOTAL_WEIGHT = 13
+
+class GlyphAtlasCaptcha(object):
+  """
+  Renders captcha images from pre-rendered glyph variants.  Has the same generate()
+  method as ImageCaptcha.  Thread safe.
+  """
+
+  def __init__(self, alphabet, width=160, height=60, fonts=None, font_sizes=None, variants=32, png_compress_level=1):
+    """
+    :param alphabet: the characters which are pre-rendered.  Other characters are
+      rendered when first needed.
+    :param variants: the number of distorted variants of each character
+    """
+    self._alphabet = alphabet
+    self._width = width
+    self._height = height
+    self._fonts = fonts or DEFAULT_FONTS
+    self._font_sizes = font_sizes or (42, 50, 56)
+    self._variants = variants
+    self._png_compress_level = png_compress_level
+    self._atlas = None
+    self._lock = threading.Lock()
+
+  @property
+  def atlas(self):
+    """
+    A dictionary which maps each character to a list of its variants.  Each variant
+    is a 2D uint8 array of coverage (0 to 255), cropped to the glyph.
+    """
+    if self._atlas is None:
+      with self._lock:
+        if self._atlas is None:
+          self._atlas = self._build_atlas(self._alphabet)
+    return self._atlas
+
+  def generate(self, chars, format="png"):
+    """
+    Renders an image of the given characters.  Returns a BytesIO with the encoded
+    image.
+    """
+    out = BytesIO()
+    Image.fromarray(self.generate_array(chars), "RGB").save(out, format=format, compress_level=self._png_compress_level)
+    out.seek(0)
+    return out
+
+  def generate_array(self, chars):
+    """
+    Renders an image of the given characters as a (height, width, 3) uint8 array
+    """
+    rng = numpy.random.default_rng(secrets.randbits(128))
+    mask = self._compose_text(chars, rng)
+    self._add_noise(mask, rng)
+    mask = _smooth(mask)
+
+    background = rng.integers(238, 256, size=3).astype(numpy.float32)
+    foreground = rng.integers(10, 201, size=3).astype(numpy.float32)
+    image = background + (foreground - background) * mask[:, :, None]
+    return image.astype(numpy.uint8)
+
+  def _compose_text(self, chars, rng):
+    """
+    Places a random variant of each character on a canvas.  Returns the coverage of
+    the text (0 to 1) as a float32 array of the image's size.
+    """
+    glyphs = [self._variants_of(c)[rng.integers(self._variants)] for c in chars]
+    average_width = sum(g.shape[1] for g in glyphs) // max(len(glyphs), 1)
+    max_overlap = int(MAX_OVERLAP * average_width)
+
+    positions = []
+    x = int(average_width * 0.1)
+    for g in glyphs:
+      if rng.random() < SPACE_PROBABILITY:
+        x += int(rng.integers(average_width // 4, average_width // 2 + 1))
+      positions.append(x)
+      x += g.shape[1] - int(rng.integers(max_overlap + 1))
+    canvas_width = max(x + max_overlap, self._width)
+
+    canvas = numpy.zeros((self._height, canvas_width), dtype=numpy.uint8)
+    for g, x in zip(glyphs, positions):
+      h, w = g.shape
+      w = min(w, canvas_width - x)
+      jitter = (self._height - h) // 4
+      y = (self._height - h) // 2 + int(rng.integers(-jitter, jitter + 1))
+      region = canvas[y:y + h, x:x + w]
+      numpy.maximum(region, g[:, :w], out=region)
+
+    #squeeze wide text into the image, as ImageCaptcha does
+    if canvas_width > self._width:
+      canvas = canvas[:, (numpy.arange(self._width) * canvas_width) // self._width]
+    return canvas.astype(numpy.float32) / 255
+
+  def _add_noise(self, mask, rng):
+    h, w = mask.shape
+    #dots of about 3x3 pixels
+    ys = rng.integers(0, h, size=NOISE_DOTS)
+    xs = rng.integers(0, w, size=NOISE_DOTS)
+    for dy in (-1, 0, 1):
+      for dx in (-1, 0, 1):
+        mask[numpy.clip(ys + dy, 0, h - 1), numpy.clip(xs + dx, 0, w - 1)] = 1
+
+    #an elliptical arc across the image
+    x1 = int(rng.integers(0, w // 5 + 1))
+    x2 = int(rng.integers(w // 5, w + 1))
+    y1 = int(rng.integers(h // 5, h - h // 5 + 1))
+    y2 = int(rng.integers(y1, max(y1, h - h // 5) + 1))
+    start = rng.integers(0, 21)
+    end = rng.integers(160, 201)
+    t = numpy.radians(numpy.linspace(start, end, NOISE_CURVE_POINTS))
+    xs = ((x1 + x2) / 2 + (x2 - x1) / 2 * numpy.cos(t)).astype(int)
+    ys = ((y1 + y2) / 2 + (y2 - y1) / 2 * numpy.sin(t)).astype(int)
+    mask[numpy.clip(ys, 0, h - 1), numpy.clip(xs, 0, w - 1)] = 1
+
+  def _variants_of(self, char):
+    variants = self.atlas.get(char)
+    if variants is None:
+      with self._lock:
+        variants = self._atlas.get(char)
+        if variants is None:
+          variants = self._build_atlas(char)[char]
+          self._atlas = dict(self._atlas, **{char: variants})
+    return variants
+
+  def _build_atlas(self, alphabet):
+    rng = numpy.random.default_rng(secrets.randbits(128))
+    fonts = [ImageFont.truetype(f, s) for f in self._fonts for s in self._font_sizes]
+    atlas = {}
+    for char in alphabet:
+      atlas[char] = [self._render_variant(char, fonts[rng.integers(len(fonts))], rng) for _ in range(self._variants)]
+    return atlas
+
+  def _render_variant(self, char, font, rng):
+    """
+    Rasterizes, rotates and warps one character (the same steps as ImageCaptcha)
+    """
+    left, top, right, bottom = font.getbbox(char)
+    im = Image.new("L", (right + 8, bottom + 8), 0)
+    ImageDraw.Draw(im).text((4, 4), char, font=font, fill=255)
+    im = im.crop(im.getbbox())
+    im = im.rotate(rng.uniform(*ROTATE_DEGREES), Image.BILINEAR, expand=True)
+
+    w, h = im.size
+    dx = w * rng.uniform(*WARP_DX)
+    dy = h * rng.uniform(*WARP_DY)
+    x1, x2 = [int(rng.uniform(-dx, dx)) for _ in range(2)]
+    y1, y2 = [int(rng.uniform(-dy, dy)) for _ in range(2)]
+    w2 = w + abs(x1) + abs(x2)
+    h2 = h + abs(y1) + abs(y2)
+    im = im.resize((w2, h2)).transform((w, h), Image.QUAD, (x1, y1, -x1, h2 - y2, w2 + x2, h2 + y2, w2 - x2, -y1))
+    im = im.crop(im.getbbox() or (0, 0, w, h))
+
+    #glyphs must fit within the image's height
+    if im.size[1] > self._height:
+      im = im.resize((max(1, im.size[0] * self._height // im.size[1]), self._height), Image.BILINEAR)
+    return numpy.asarray(im, dtype=numpy.uint8)
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+
+def create_renderer(alphabet):
+  """
+  The captcha renderer configured in the application settings
+  :param alphabet: the characters captchas are made of
+  """
+  if settings.CAPTCHA_RENDERER == GLYPH_ATLAS:
+    if numpy is not None:
+      return GlyphAtlasCaptcha(alphabet, variants=settings.CAPTCHA_ATLAS_VARIANTS)
+    logger.warning("NumPy is not installed.  Using ImageCaptcha to render captchas.")
+  return ImageCaptcha()
+
+def warm_up(renderer):
+  """
+  Loads the renderer's fonts (and builds its atlas) now, rather than when the first
+  captcha is rendered
+  """
+  if isinstance(renderer, GlyphAtlasCaptcha):
+    renderer.atlas
+  else:
+    renderer.truefonts
+
+def _smooth(mask):
+  """
+  Applies PIL's SMOOTH filter (a 3x3 kernel with centre weight 5) to a 2D array
+  """
+  padded = numpy.pad(mask, 1, mode="edge")
+  h, w = mask.shape
+  total = mask * (SMOOTH_CENTER_WEIGHT - 1)
+  for dy in (0, 1, 2):
+    for dx in (0, 1, 2):
+      total = total + padded[dy:dy + h, dx:dx + w]
+  return total / SMOOTH_TOTAL_WEIGHT
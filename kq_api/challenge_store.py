@@ -5,8 +5,15 @@ import json
 import uuid
 import string
 import random
-from captcha.image import ImageCaptcha
+import time
 from . import settings
+from . import captcha_renderer
+from . import challenge_tokens
+from . import redis_clients
+from .redis_clients import RedisProvider, ShardedRedis
+from . import storage
+from .storage import RedisBackend
+from . import deadlines
 
 #------------------------------------------------------------------------------
 # Constants
@@ -14,6 +21,11 @@ from . import settings
 
 MIN_CAPTCHA_TEXT_SIZE = 5
 MAX_CAPTCHA_TEXT_SIZE = 6
+SECRET_ALPHABET = string.ascii_uppercase + string.digits
+
+#challenge tokens which have been used are recorded under this prefix (followed by a
+#digest of the token) until they expire
+USED_TOKEN_KEY_PREFIX = "challenge_token_used:"
 
 class ChallengeStore(object):
   """
@@ -23,7 +35,13 @@ class ChallengeStore(object):
   user is human.
   """
 
-  def __init__(self, app, db_url=None, default_ttl_seconds=settings.SECONDS_PER_DAY):
+  def __init__(self, app, db_url=None, default_ttl_seconds=settings.SECONDS_PER_DAY, shard_urls=None, backend=None):
+    """
+    :param shard_urls: if given, challenges are spread across these Redis (or Sentinel)
+      URLs by consistent hashing instead of being stored in db_url
+    :param backend: the StorageBackend in which challenges are kept.  By default, the
+      Redis database at db_url (or the shards).
+    """
 
     self.app = app
     self.db_url = db_url
@@ -32,55 +50,51 @@ class ChallengeStore(object):
       app.config["REDIS_URL"] = db_url
 
     self._default_ttl_seconds = default_ttl_seconds
-    self._store = FlaskRedis(app)
-    self._imageCaptcha = ImageCaptcha()
-
+    if backend:
+      self._store = backend
+    elif shard_urls:
+      self._store = RedisBackend(ShardedRedis(shard_urls, socket_timeout=settings.OUTBOUND_TIMEOUT_SECONDS))
+    else:
+      self._store = RedisBackend(FlaskRedis.from_custom_provider(RedisProvider, app, socket_timeout=settings.OUTBOUND_TIMEOUT_SECONDS))
+    self._imageCaptcha = captcha_renderer.create_renderer(SECRET_ALPHABET)
+
+  def warm_up(self):
+    """
+    Loads the captcha fonts (or builds the glyph atlas) now, rather than when the first
+    captcha is generated
+    """
+    captcha_renderer.warm_up(self._imageCaptcha)
 
   def new_challenge(self):
-    #number of letters and digits in the captcha secret
-    secret_length = random.randint(MIN_CAPTCHA_TEXT_SIZE, MAX_CAPTCHA_TEXT_SIZE)
-
-    #random id
-    challenge_id = str(uuid.uuid4())
-
-    #random secret of the chosen length
-    secret = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(secret_length))
-
-    challenge = {
-      "challenge_id": challenge_id,
-      "secret": secret
-    }
+    challenge = generate_challenge()
+    challenge_id = challenge["challenge_id"]
+    secret = challenge["secret"]
 
     #save challenge to store
     try:
-      self._store.set(challenge_id, secret.encode('utf-8'), ex=self._default_ttl_seconds)
-    except redis.exceptions.ConnectionError as e:
-      self.app.logger.error("Unable to connect to Redis database: '{}'. {}".format(self.db_url, e))
+      self._store.set(challenge_id, secret.encode('utf-8'), self._default_ttl_seconds)
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+      self.app.logger.error("Unable to connect to Redis database: '%s'. %s", self.db_url, e)
       raise RuntimeError("Unable to connect to Redis database.")
     except redis.exceptions.ResponseError as e:
-      self.app.logger.error("Unable to save challenge to Redis database: {}.".format(e))
+      self.app.logger.error("Unable to save challenge to Redis database: %s.", e)
       raise RuntimeError("Unable to save challenge.")
 
     return challenge
 
   def is_valid(self, challenge_id, secret_to_check):
     secret = None
+    deadlines.check(deadlines.CAPTCHA_STORE)
     try:
-      secret = self._store.get(challenge_id).decode('utf-8')
-    except redis.exceptions.ConnectionError as e:
-      self.app.logger.error("Unable to connect to Redis database: '{}'.".format(self.db_url))
+      secret = self._store.get(challenge_id)
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+      self.app.logger.error("Unable to connect to Redis database: '%s'.", self.db_url)
       raise RuntimeError("Unable to connect to Redis database")
     except redis.exceptions.ResponseError as e:
-      self.app.logger.error("Unable to get challenge from Redis database: {}.".format(e))
+      self.app.logger.error("Unable to get challenge from Redis database: %s.", e)
       raise RuntimeError("Unable to get challenge.")
 
-    if not settings.CHALLENGE_SECRETS_CASE_SENSITIVE:
-      secret = secret.lower()
-      secret_to_check = secret_to_check.lower()
-
-    if secret == secret_to_check:
-      return True
-    return False
+    return secrets_match(secret, secret_to_check)
 
   def challenge_id_to_captcha(self, challenge_id):
     """
@@ -88,17 +102,136 @@ class ChallengeStore(object):
     to the specified challenge_id
     Returns a ByteIO object with the image content
     """
+    deadlines.check(deadlines.CAPTCHA_STORE)
     try:
-      secret = self._store.get(challenge_id).decode('utf-8')
-    except redis.exceptions.ConnectionError as e:
-      self.app.logger.error("Unable to connect to Redis database: '{}'.".format(self.db_url))
+      secret = self._store.get(challenge_id)
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+      self.app.logger.error("Unable to connect to Redis database: '%s'.", self.db_url)
       raise RuntimeError("Unable to connect to Redis database")
     except redis.exceptions.ResponseError as e:
-      self.app.logger.error("Unable to get challenge from Redis database: {}.".format(e))
+      self.app.logger.error("Unable to get challenge from Redis database: %s.", e)
       raise RuntimeError("Unable to get challenge.")
 
     if not secret:
       raise ValueError("No such challenge")
 
-    image_bytes = self._imageCaptcha.generate(secret)
+    image_bytes = self._imageCaptcha.generate(secret.decode('utf-8'))
     return image_bytes
+
+  def ping(self):
+    """
+    Checks that the store is available.  Returns a dictionary describing its state.
+    Raises a RedisError if the Redis database can't be reached.
+    """
+    return self._store.ping()
+
+class TokenChallengeStore(object):
+  """
+  A ChallengeStore which stores nothing when a challenge is created.  The challenge
+  id is a token containing the encrypted secret and an expiry time (see
+  challenge_tokens), so creating a challenge and rendering its captcha need no
+  storage.  A token which passes is_valid is recorded in Redis until it expires, so
+  that it cannot be used again.
+  """
+
+  def __init__(self, app, db_url=None, default_ttl_seconds=settings.SECONDS_PER_DAY, server_key=None):
+    """
+    :param db_url: the Redis database in which used tokens are recorded
+    :param server_key: the key with which tokens are encrypted and authenticated.  It
+      must be the same in every worker and replica.
+    """
+
+    self.app = app
+    self.db_url = db_url
+
+    if db_url:
+      app.config["REDIS_URL"] = db_url
+
+    self._default_ttl_seconds = int(default_ttl_seconds)
+    self._keys = challenge_tokens.TokenKeys(server_key)
+    self._store = FlaskRedis.from_custom_provider(RedisProvider, app, socket_timeout=settings.OUTBOUND_TIMEOUT_SECONDS)
+    self._imageCaptcha = captcha_renderer.create_renderer(SECRET_ALPHABET)
+
+  def warm_up(self):
+    captcha_renderer.warm_up(self._imageCaptcha)
+
+  def new_challenge(self):
+    challenge = generate_challenge()
+    challenge["challenge_id"] = challenge_tokens.seal(challenge["secret"], time.time() + self._default_ttl_seconds, self._keys)
+    return challenge
+
+  def is_valid(self, challenge_id, secret_to_check):
+    """
+    Checks the secret entered by the user.  A valid token can only be used once:
+    this returns False if it was already used successfully.  Raises RuntimeError if
+    the use of the token can't be recorded (the token is not accepted, because it
+    could otherwise be used again).
+    """
+    if not secrets_match(challenge_tokens.unseal(challenge_id, self._keys), secret_to_check):
+      return False
+    key, ttl_seconds = used_token_args(challenge_id)
+    deadlines.check(deadlines.CAPTCHA_STORE)
+    try:
+      first_use = self._store.set(key, 1, nx=True, ex=ttl_seconds)
+    except redis.exceptions.RedisError as e:
+      self.app.logger.error("Unable to record used challenge token in Redis database: '%s'. %s", self.db_url, e)
+      raise RuntimeError("Unable to record used challenge token.")
+    return bool(first_use)
+
+  def challenge_id_to_captcha(self, challenge_id):
+    secret = challenge_tokens.unseal(challenge_id, self._keys)
+    if not secret:
+      raise ValueError("No such challenge")
+    return self._imageCaptcha.generate(secret)
+
+  def ping(self):
+    return {"backend": storage.REDIS, "connections": redis_clients.ping(self._store)}
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+
+def generate_challenge():
+  """
+  Creates a new challenge with a random id and a random secret.  The challenge is
+  not saved.
+  """
+  #number of letters and digits in the captcha secret
+  secret_length = random.randint(MIN_CAPTCHA_TEXT_SIZE, MAX_CAPTCHA_TEXT_SIZE)
+
+  #random id
+  challenge_id = str(uuid.uuid4())
+
+  #random secret of the chosen length
+  secret = ''.join(random.choice(SECRET_ALPHABET) for _ in range(secret_length))
+
+  return {
+    "challenge_id": challenge_id,
+    "secret": secret
+  }
+
+def secrets_match(secret, secret_to_check):
+  """
+  Checks whether the secret a user entered matches the challenge secret.
+  :param secret: the challenge secret (str or bytes), or None if the challenge
+    does not exist
+  :param secret_to_check: the secret entered by the user
+  """
+  if not secret or not secret_to_check:
+    return False
+  if isinstance(secret, bytes):
+    secret = secret.decode('utf-8')
+
+  if not settings.CHALLENGE_SECRETS_CASE_SENSITIVE:
+    secret = secret.lower()
+    secret_to_check = secret_to_check.lower()
+
+  return secret == secret_to_check
+
+def used_token_args(token):
+  """
+  The Redis key which records that a (valid) challenge token was used, and the
+  number of seconds it must be kept (until the token expires)
+  """
+  ttl_seconds = max(1, int(challenge_tokens.expiry(token) - time.time()) + 1)
+  return (USED_TOKEN_KEY_PREFIX + challenge_tokens.token_digest(token), ttl_seconds)
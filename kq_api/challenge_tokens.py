@@ -0,0 +1,129 @@
+"""
+Purpose: Self-contained challenge tokens.  A token holds the challenge secret,
+encrypted, and its expiry time, authenticated with a server key.  The server can
+recover the secret from the token alone, so challenges need not be stored.
+
+Token layout (before base64url encoding):
+  version (1 byte) | expiry (4 bytes, seconds since the epoch) | nonce (12 bytes) |
+  encrypted secret | tag (16 bytes)
+
+The secret is encrypted with a keystream of HMAC-SHA256(encryption key, nonce |
+counter) blocks, and the tag is a truncated HMAC-SHA256(authentication key, everything
+before the tag).  Both keys are derived from the configured server key.  Only the
+standard library is needed.
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import os
+import re
+import struct
+import time
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+TOKEN_VERSION = 1
+NONCE_BYTES = 12
+TAG_BYTES = 16
+DIGEST_BYTES = hashlib.sha256().digest_size
+HEADER_FORMAT = ">BI"
+HEADER_BYTES = struct.calcsize(HEADER_FORMAT) + NONCE_BYTES
+#base64url, optionally padded.  (The decoder would also accept the standard alphabet
+#and skip other characters, so that several strings would be the same token.)
+TOKEN_PATTERN = re.compile(r"[A-Za-z0-9_-]+={0,2}")
+
+class TokenKeys(object):
+  """
+  The encryption and authentication keys derived from a server key
+  """
+
+  def __init__(self, server_key):
+    if isinstance(server_key, str):
+      server_key = server_key.encode("utf-8")
+    if not server_key:
+      raise ValueError("A server key is required for challenge tokens")
+    self.encryption_key = hmac.new(server_key, b"kq-challenge-token-encryption", hashlib.sha256).digest()
+    self.authentication_key = hmac.new(server_key, b"kq-challenge-token-authentication", hashlib.sha256).digest()
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+
+def seal(secret, expires, keys):
+  """
+  Creates a token for the given secret
+  :param secret: the challenge secret (str)
+  :param expires: the time (seconds since the epoch) after which the token is invalid
+  :param keys: TokenKeys
+  """
+  nonce = os.urandom(NONCE_BYTES)
+  header = struct.pack(HEADER_FORMAT, TOKEN_VERSION, int(expires)) + nonce
+  plaintext = secret.encode("utf-8")
+  ciphertext = _xor(plaintext, _keystream(keys.encryption_key, nonce, len(plaintext)))
+  tag = _tag(keys.authentication_key, header + ciphertext)
+  return base64.urlsafe_b64encode(header + ciphertext + tag).rstrip(b"=").decode("ascii")
+
+def unseal(token, keys, now=None):
+  """
+  Returns the secret in a token, or None if the token is malformed, has been altered,
+  was sealed with another key, or has expired
+  """
+  data = _decode(token)
+  if not data:
+    return None
+
+  header, ciphertext, tag = data[:HEADER_BYTES], data[HEADER_BYTES:-TAG_BYTES], data[-TAG_BYTES:]
+  if not hmac.compare_digest(tag, _tag(keys.authentication_key, header + ciphertext)):
+    return None
+  version, expires = struct.unpack(HEADER_FORMAT, header[:-NONCE_BYTES])
+  if version != TOKEN_VERSION or expires <= (now or time.time()):
+    return None
+
+  nonce = header[-NONCE_BYTES:]
+  try:
+    return _xor(ciphertext, _keystream(keys.encryption_key, nonce, len(ciphertext))).decode("utf-8")
+  except UnicodeDecodeError:
+    return None
+
+def expiry(token):
+  """
+  The expiry time in a token (which must already have been unsealed)
+  """
+  return struct.unpack(HEADER_FORMAT, _decode(token)[:struct.calcsize(HEADER_FORMAT)])[1]
+
+def token_digest(token):
+  """
+  A short, fixed-length identifier of a token (e.g. for the replay set).  It is
+  computed from the decoded token, because several strings (with different unused
+  base64 bits or padding) decode to the same token.
+  """
+  return hashlib.sha1(_decode(token)).hexdigest()
+
+def _decode(token):
+  """
+  The bytes of a token, or None if it isn't valid base64url or is too short
+  """
+  if not token or not isinstance(token, str) or not TOKEN_PATTERN.fullmatch(token):
+    return None
+  try:
+    data = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+  except (ValueError, binascii.Error):
+    return None
+  if len(data) <= HEADER_BYTES + TAG_BYTES:
+    return None
+  return data
+
+def _keystream(key, nonce, length):
+  blocks = []
+  for counter in range((length + DIGEST_BYTES - 1) // DIGEST_BYTES):
+    blocks.append(hmac.new(key, nonce + struct.pack(">I", counter), hashlib.sha256).digest())
+  return b"".join(blocks)[:length]
+
+def _tag(key, data):
+  return hmac.new(key, data, hashlib.sha256).digest()[:TAG_BYTES]
+
+def _xor(a, b):
+  return bytes(x ^ y for x, y in zip(a, b))
@@ -0,0 +1,158 @@
+"""
+Purpose: Helpers to negotiate and produce compressed HTTP response bodies.
+Brotli support is optional.  If the 'brotli' package is not installed only
+gzip is offered.
+"""
+import gzip
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+GZIP = "gzip"
+BROTLI = "br"
+IDENTITY = "identity"
+
+#compression levels used for responses which are compressed on the fly
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+#compression levels used for static content which is compressed once
+GZIP_LEVEL_STATIC = 9
+BROTLI_QUALITY_STATIC = 11
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+
+def available_encodings():
+  """
+  Returns the list of content codings this server can produce, in order of
+  preference (best compression first).
+  """
+  if brotli:
+    return [BROTLI, GZIP]
+  return [GZIP]
+
+def parse_accept_encoding(accept_encoding):
+  """
+  Parses the value of an Accept-Encoding header into a dictionary which maps
+  each content coding to its quality value (a float between 0 and 1).
+  :param accept_encoding: the raw header value (may be None)
+  """
+  codings = {}
+  if not accept_encoding:
+    return codings
+  for item in accept_encoding.split(","):
+    parts = item.strip().split(";")
+    coding = parts[0].strip().lower()
+    if not coding:
+      continue
+    q = 1.0
+    for param in parts[1:]:
+      name, _, value = param.strip().partition("=")
+      if name.strip().lower() == "q":
+        try:
+          q = float(value)
+        except ValueError:
+          q = 0.0
+    codings[coding] = q
+  return codings
+
+def choose_encoding(accept_encoding, available=None):
+  """
+  Chooses the best content coding given a client's Accept-Encoding header.
+  Returns one of the available codings, or None if the response should not
+  be compressed.
+  :param accept_encoding: the raw Accept-Encoding header value
+  :param available: the codings the caller is able to produce, in order of
+    preference.  Defaults to available_encodings().
+  """
+  if available is None:
+    available = available_encodings()
+  accepted = parse_accept_encoding(accept_encoding)
+  if not accepted:
+    return None
+
+  best = None
+  best_q = 0.0
+  for coding in available:
+    q = accepted.get(coding, accepted.get("*", 0.0))
+    if q > best_q:
+      best = coding
+      best_q = q
+  return best
+
+def compress(data, encoding, static=False):
+  """
+  Compresses the given bytes with the given content coding.
+  :param data: bytes to compress
+  :param encoding: one of GZIP or BROTLI
+  :param static: if True, use the (slower) maximum compression level
+  """
+  if encoding == GZIP:
+    level = GZIP_LEVEL_STATIC if static else GZIP_LEVEL
+    return gzip.compress(data, compresslevel=level)
+  if encoding == BROTLI and brotli:
+    quality = BROTLI_QUALITY_STATIC if static else BROTLI_QUALITY
+    return brotli.compress(data, quality=quality)
+  raise ValueError("Unsupported content coding: '{}'".format(encoding))
+
+def precompress(data):
+  """
+  Compresses the given bytes with every available content coding.
+  Returns a dictionary which maps content coding to compressed bytes.
+  Intended for static content which is compressed once and served many times.
+  """
+  variants = {}
+  for encoding in available_encodings():
+    variants[encoding] = compress(data, encoding, static=True)
+  return variants
+
+def encoded_etag(etag, encoding):
+  """
+  The ETag of a compressed variant: the ETag of the uncompressed content suffixed
+  with the content coding, so that each variant has its own ETag
+  """
+  return "{}-{}".format(etag, encoding)
+
+def etag_header_with_encoding(etag_header, encoding):
+  """
+  The value of an ETag header (e.g. 'W/"abc"') changed to that of the variant
+  compressed with the given content coding (e.g. 'W/"abc-br"')
+  """
+  weak = etag_header.startswith("W/")
+  tag = etag_header[2:] if weak else etag_header
+  return '{}"{}"'.format("W/" if weak else "", encoded_etag(tag.strip('"'), encoding))
+
+def base_etag(etag):
+  """
+  The ETag of the uncompressed content, given the ETag of any variant (quoted or
+  not, weak or strong).  Returned unquoted.
+  """
+  etag = etag.strip()
+  if etag.startswith("W/"):
+    etag = etag[2:]
+  etag = etag.strip('"')
+  for encoding in [GZIP, BROTLI]:
+    suffix = "-{}".format(encoding)
+    if etag.endswith(suffix):
+      return etag[:-len(suffix)]
+  return etag
+
+def etags_match(if_none_match, etag):
+  """
+  True if an If-None-Match header value lists the given ETag, or the ETag of another
+  variant of the same content (the variants differ only in their content coding)
+  """
+  if not if_none_match or not etag:
+    return False
+  tags = [tag for tag in if_none_match.split(",") if tag.strip()]
+  if any(tag.strip() == "*" for tag in tags):
+    return True
+  return base_etag(etag) in [base_etag(tag) for tag in tags]
@@ -0,0 +1,218 @@
+"""
+Purpose: End-to-end deadlines for requests.  Each request gets a time budget
+(REQUEST_DEADLINE_* settings) when it starts.  Every outbound call made while it is
+processed (BCDC, the app URL probe, SMTP) uses the remaining budget as its timeout,
+so the request's worst-case latency is bounded by its deadline rather than by the
+sum of its calls' timeouts.
+
+- timeout(step) is the timeout for a required step.  It raises DeadlineExceeded (a
+  RuntimeError, i.e. a system error) if the budget is already spent.
+- optional_timeout(step, ...) is the timeout for an optional step (e.g. the content
+  type probe).  It returns None when running the step would leave too little of the
+  budget for the required steps that follow, and the step should be skipped.
+- Outside a request (e.g. in background threads) there is no deadline, and calls use
+  OUTBOUND_TIMEOUT_SECONDS.
+- lift() ends the budget of the current request, for steps which must run to
+  completion once a side effect has been made (e.g. after a BCDC package was created
+  by GET /verify_key_request).  They use OUTBOUND_TIMEOUT_SECONDS as well.
+
+The current request's deadline is found with a getter function (see
+set_deadline_getter), so the Flask and ASGI applications can each keep it in their
+own request context.  Overruns, skipped steps and steps which found the budget spent
+are counted per route by DeadlineStats.
+"""
+import logging
+import threading
+import time
+from . import settings
+
+logger = logging.getLogger(__name__)
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+#names of the outbound steps (used in metrics and error messages)
+BCDC = "bcdc"
+APP_URL_PROBE = "app_url_probe"
+SMTP = "smtp"
+KQ_STORE = "kq_store"
+CAPTCHA_STORE = "captcha_store"
+
+_get_deadline = lambda: None
+
+class DeadlineExceeded(RuntimeError):
+  """
+  Raised when a step of a request is about to start after the request's deadline
+  """
+
+  def __init__(self, step):
+    super(DeadlineExceeded, self).__init__("The request's deadline passed before '{}'.".format(step))
+    self.step = step
+
+class Deadline(object):
+  """
+  The time budget of one request
+  """
+
+  def __init__(self, route, seconds):
+    self.route = route
+    self.seconds = seconds
+    self.started = time.monotonic()
+    self.expires = self.started + seconds
+    self.skipped = []
+    self.exceeded = []
+    self.lifted = False
+
+  def remaining(self):
+    return max(self.expires - time.monotonic(), 0)
+
+  def elapsed(self):
+    return time.monotonic() - self.started
+
+  def timeout(self, step, maximum):
+    """
+    The timeout for a required step: the remaining budget, at most 'maximum' seconds.
+    Raises DeadlineExceeded if no budget remains.
+    """
+    remaining = self.remaining()
+    if remaining <= 0:
+      self.exceeded.append(step)
+      raise DeadlineExceeded(step)
+    return min(remaining, maximum)
+
+  def optional_timeout(self, step, maximum, reserve_seconds):
+    """
+    The timeout for an optional step, which leaves reserve_seconds of the budget for
+    the steps which follow it.  Returns None (and records the step as skipped) if
+    there is no time for it.
+    """
+    available = self.remaining() - reserve_seconds
+    if available <= 0:
+      self.skipped.append(step)
+      return None
+    return min(available, maximum)
+
+class RouteDeadlineStats(object):
+
+  def __init__(self):
+    self.requests = 0
+    self.overruns = 0
+    self.max_overrun_ms = 0
+    self.exceeded = {}
+    self.skipped = {}
+
+  def stats(self):
+    return {
+      "requests": self.requests,
+      "overruns": self.overruns,
+      "max_overrun_ms": self.max_overrun_ms,
+      "exceeded": dict(self.exceeded),
+      "skipped": dict(self.skipped)
+    }
+
+class DeadlineStats(object):
+  """
+  Counts, per route, the requests which finished after their deadline (overruns),
+  the steps which found the budget spent, and the optional steps skipped.  Thread
+  safe.
+  """
+
+  def __init__(self):
+    self._routes = {}
+    self._lock = threading.Lock()
+
+  def record(self, deadline):
+    """
+    Records a finished request
+    """
+    if deadline is None:
+      return
+    #requests whose deadline was lifted are expected to run longer
+    overrun_ms = 0 if deadline.lifted else int((deadline.elapsed() - deadline.seconds) * 1000)
+    if overrun_ms > 0:
+      logger.warning("Request to '%s' finished %s ms after its deadline (%s s).", deadline.route, overrun_ms, deadline.seconds)
+    with self._lock:
+      route = self._routes.setdefault(deadline.route or "unknown", RouteDeadlineStats())
+      route.requests += 1
+      if overrun_ms > 0:
+        route.overruns += 1
+        route.max_overrun_ms = max(route.max_overrun_ms, overrun_ms)
+      for step in deadline.exceeded:
+        route.exceeded[step] = route.exceeded.get(step, 0) + 1
+      for step in deadline.skipped:
+        route.skipped[step] = route.skipped.get(step, 0) + 1
+
+  def stats(self):
+    with self._lock:
+      return dict((name, route.stats()) for name, route in self._routes.items())
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+
+def set_deadline_getter(get_deadline):
+  """
+  Sets the function which returns the Deadline of the request being processed (or
+  None)
+  """
+  global _get_deadline
+  _get_deadline = get_deadline
+
+def current():
+  """
+  The deadline of the request being processed, or None (also if it was lifted)
+  """
+  deadline = _get_deadline()
+  if deadline is None or deadline.lifted:
+    return None
+  return deadline
+
+def lift():
+  """
+  Ends the budget of the current request: the steps which follow are not bounded by
+  its deadline (each outbound call still has its own timeout)
+  """
+  deadline = _get_deadline()
+  if deadline is not None:
+    deadline.lifted = True
+
+def timeout(step, maximum=None):
+  """
+  The timeout (in seconds) for a required outbound step: the remaining budget of the
+  current request, at most 'maximum' (default OUTBOUND_TIMEOUT_SECONDS).  Raises
+  DeadlineExceeded if the budget is spent.
+  """
+  maximum = maximum or settings.OUTBOUND_TIMEOUT_SECONDS
+  deadline = current()
+  if deadline is None:
+    return maximum
+  return deadline.timeout(step, maximum)
+
+def optional_timeout(step, maximum, reserve_seconds=None):
+  """
+  The timeout (in seconds) for an optional outbound step, or None if it should be
+  skipped to leave reserve_seconds (default DEADLINE_RESERVE_SECONDS) of the current
+  request's budget for the steps which follow
+  """
+  if reserve_seconds is None:
+    reserve_seconds = settings.DEADLINE_RESERVE_SECONDS
+  deadline = current()
+  if deadline is None:
+    return maximum
+  return deadline.optional_timeout(step, maximum, reserve_seconds)
+
+def check(step):
+  """
+  Raises DeadlineExceeded if the current request's budget is spent.  For steps whose
+  client can't take a per-call timeout.
+  """
+  timeout(step)
+
+def seconds_for_route(route):
+  """
+  The deadline (in seconds) configured for a route (the name of its view function),
+  or None if it has no deadline
+  """
+  seconds = settings.REQUEST_DEADLINES.get(route, settings.REQUEST_DEADLINE_SECONDS)
+  return seconds or None
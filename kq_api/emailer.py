@@ -3,7 +3,7 @@ from email.mime.text import MIMEText
 
 SECURE_PORTS = [465, 587]
 
-def send_email(to, bcc=None, email_subject="", email_body="", smtp_server=None, smtp_port=587, from_email_address=None, from_password=None):
+def send_email(to, bcc=None, email_subject="", email_body="", smtp_server=None, smtp_port=587, from_email_address=None, from_password=None, timeout=None):
   """
   Sends an email
   :param to: a list of email addresses to send to
@@ -13,37 +13,100 @@ def send_email(to, bcc=None, email_subject="", email_body="", smtp_server=None,
   :smtp_server: the SMTP server to use
   :from_email_address: the email address to send from
   :from_password: the password of the email account to send from
+  :timeout: the timeout (in seconds) of each operation on the connection.  By default,
+    the socket module's default timeout.
   """
+  msg, recipients = _prepare_email(to, bcc, email_subject, email_body, smtp_server, from_email_address)
+  smtp_port = int(smtp_port)
+  timeout_args = {"timeout": timeout} if timeout else {}
+
+  s = None
+  if smtp_port in SECURE_PORTS:
+    s = smtplib.SMTP_SSL(smtp_server, smtp_port, **timeout_args)
+    try:
+      s.login(from_email_address, from_password)
+    except smtplib.SMTPAuthenticationError as e:
+      raise ValueError("Unable to login to SMPT server.  Invalid credentials.")
+  else:
+    s = smtplib.SMTP(smtp_server, smtp_port, **timeout_args)
+
+  try:
+    s.sendmail(from_email_address, recipients, msg.as_string())
+  except smtplib.SMTPRecipientsRefused as e:
+    raise ValueError(e)
+  s.quit()
+
+async def send_email_async(to, bcc=None, email_subject="", email_body="", smtp_server=None, smtp_port=587, from_email_address=None, from_password=None, timeout=None):
+  """
+  Sends an email without blocking the event loop.  Accepts the same parameters as
+  send_email.  Requires the 'aiosmtplib' package.
+  """
+  import aiosmtplib
+
+  msg, recipients = _prepare_email(to, bcc, email_subject, email_body, smtp_server, from_email_address)
+  smtp_port = int(smtp_port)
+
+  login = {}
+  if smtp_port in SECURE_PORTS:
+    login = {"username": from_email_address, "password": from_password}
+
+  try:
+    await aiosmtplib.send(msg, sender=from_email_address, recipients=recipients, \
+      hostname=smtp_server, port=smtp_port, use_tls=smtp_port in SECURE_PORTS, timeout=timeout, **login)
+  except aiosmtplib.SMTPAuthenticationError as e:
+    raise ValueError("Unable to login to SMPT server.  Invalid credentials.")
+  except aiosmtplib.SMTPRecipientsRefused as e:
+    raise ValueError(e)
+
+def check_smtp_server(smtp_server, smtp_port=587, timeout=None):
+  """
+  Checks that the SMTP server accepts connections: connects, sends NOOP, and
+  disconnects without logging in or sending anything.  Raises an error (e.g.
+  OSError or SMTPException) if the server is not available.
+  """
+  smtp_port = int(smtp_port)
+  smtp_class = smtplib.SMTP_SSL if smtp_port in SECURE_PORTS else smtplib.SMTP
+  s = smtp_class(smtp_server, smtp_port, timeout=timeout)
+  try:
+    code, message = s.noop()
+    if code != 250:
+      raise smtplib.SMTPResponseException(code, message)
+  finally:
+    s.close()
 
+async def check_smtp_server_async(smtp_server, smtp_port=587, timeout=None):
+  """
+  Checks that the SMTP server accepts connections, without blocking the event loop.
+  See check_smtp_server.  Requires the 'aiosmtplib' package.
+  """
+  import aiosmtplib
+
+  smtp_port = int(smtp_port)
+  s = aiosmtplib.SMTP(hostname=smtp_server, port=smtp_port, use_tls=smtp_port in SECURE_PORTS, timeout=timeout)
+  await s.connect()
+  try:
+    await s.noop()
+  finally:
+    s.close()
+
+def _prepare_email(to, bcc, email_subject, email_body, smtp_server, from_email_address):
+  """
+  Checks the preconditions for sending an email, and creates the message.
+  Returns a tuple: (message, list of all recipients)
+  """
   if not to:
     raise ValueError("precondition failed.  'to' must not be None")
   if not from_email_address:
     raise ValueError("precondition failed.  'from_email_address' must not be None")
   if not smtp_server:
     raise ValueError("precondition failed.  'smtp_server' must not be None")
-  
+
   if not bcc:
     bcc = []
 
-  smtp_port = int(smtp_port)
-
   msg = MIMEText(email_body, "html")
   msg["From"] = from_email_address
   msg["To"] = ",".join(to)
   msg["Subject"] = email_subject
 
-  s = None
-  if smtp_port in SECURE_PORTS:
-    s = smtplib.SMTP_SSL(smtp_server, smtp_port)
-    try:
-      s.login(from_email_address, from_password)
-    except smtplib.SMTPAuthenticationError as e:
-      raise ValueError("Unable to login to SMPT server.  Invalid credentials.")
-  else:
-    s = smtplib.SMTP(smtp_server, smtp_port)
-
-  try:
-    s.sendmail(from_email_address, to + bcc, msg.as_string())
-  except smtplib.SMTPRecipientsRefused as e:
-    raise ValueError(e)
-  s.quit()
\ No newline at end of file
+  return (msg, to + bcc)
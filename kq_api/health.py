@@ -0,0 +1,167 @@
+"""
+Purpose: Dependency health for the readiness probe (GET /readyz).  A background checker
+in each worker process checks the Redis stores, BCDC and the SMTP server every
+HEALTH_CHECK_INTERVAL_SECONDS and keeps the results.  Probes only read the latest
+results, so they answer immediately and never add load to the dependencies, however
+often they are sent.
+
+The process is ready when every required check (HEALTH_REQUIRED_CHECKS) passed in
+the latest round, and that round is recent.  If the checker itself stops (e.g. a
+check hangs), its results become stale and the process reports itself not ready.
+The other checks are reported but do not affect readiness.  By default BCDC and SMTP
+are not required: if they fail, every replica fails at once, and taking all of them
+out of service would not help.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+#names of the checks
+KQ_STORE = "kq_store"
+CAPTCHA_STORE = "captcha_store"
+BCDC = "bcdc"
+SMTP = "smtp"
+
+#results are stale (and the process not ready) after this many intervals without a
+#completed round of checks
+STALE_AFTER_INTERVALS = 3
+
+class HealthChecker(object):
+  """
+  Runs named checks periodically in a background thread and keeps the latest result
+  of each.  A check is a function which returns details of the dependency's state (a
+  dictionary, or None) or raises an error if the dependency is not available.
+  """
+
+  def __init__(self, checks, required=None, interval_seconds=15, timeout_seconds=5):
+    """
+    :param checks: a list of (name, function) tuples
+    :param required: the names of the checks which must pass for the process to be
+      ready.  By default, all of them.
+    :param timeout_seconds: how long each check may take.  Checks which can't be
+      interrupted (e.g. a Redis command) are only detected when the results go stale.
+    """
+    self.checks = checks
+    self.required = set(required if required is not None else [name for name, _ in checks])
+    self.interval_seconds = interval_seconds
+    self.timeout_seconds = timeout_seconds
+    self.results = {}
+    self.checked_at = None
+    self._checker_pid = None
+
+  def start(self):
+    """
+    Starts the checker thread of this process (once per process).  Safe to call on
+    every request.
+    """
+    if self._checker_pid == os.getpid():
+      return
+    self._checker_pid = os.getpid()
+    t = threading.Thread(target=self._check_periodically, name="health-checker")
+    t.daemon = True
+    t.start()
+
+  def refresh(self):
+    """
+    Runs every check once and saves the results
+    """
+    results = {}
+    for name, check in self.checks:
+      start = time.time()
+      try:
+        results[name] = check_result(start, details=check())
+      except Exception as e:
+        results[name] = check_result(start, error=e)
+    self._save(results)
+
+  def readiness(self):
+    """
+    Returns a tuple: (whether the process is ready, a description of each check)
+    """
+    results = self.results
+    checked_at = self.checked_at
+    ready = checked_at is not None
+    if ready and time.time() - checked_at > STALE_AFTER_INTERVALS * self.interval_seconds + self.timeout_seconds:
+      ready = False
+    for name in self.required:
+      if not results.get(name, {}).get("ok"):
+        ready = False
+
+    checks = {}
+    for name, result in results.items():
+      checks[name] = dict(result, required=name in self.required)
+    return (ready, {
+      "ready": ready,
+      "checked_at": checked_at,
+      "checks": checks
+    })
+
+  def _save(self, results):
+    for name, result in results.items():
+      previous = self.results.get(name)
+      if result["ok"] and previous and not previous["ok"]:
+        logger.info("Health check '%s' recovered.", name)
+      elif not result["ok"] and (not previous or previous["ok"]):
+        logger.warning("Health check '%s' failed: %s", name, result["error"])
+    #replaced as a whole so that readers never see a partial round
+    self.results = results
+    self.checked_at = time.time()
+
+  def _check_periodically(self):
+    while True:
+      self.refresh()
+      time.sleep(self.interval_seconds)
+
+class AsyncHealthChecker(HealthChecker):
+  """
+  A HealthChecker whose checks are coroutine functions, run by a task on the event
+  loop.  Each check is cancelled if it takes longer than timeout_seconds.
+  """
+
+  async def refresh(self):
+    results = {}
+    for name, check in self.checks:
+      start = time.time()
+      try:
+        details = await asyncio.wait_for(check(), self.timeout_seconds)
+        results[name] = check_result(start, details=details)
+      except asyncio.TimeoutError:
+        results[name] = check_result(start, error="Timed out after {} seconds".format(self.timeout_seconds))
+      except Exception as e:
+        results[name] = check_result(start, error=e)
+    self._save(results)
+
+  async def check_periodically(self):
+    """
+    Runs the checks every interval_seconds.  Run it as a task for the lifetime of
+    the application.
+    """
+    while True:
+      await self.refresh()
+      await asyncio.sleep(self.interval_seconds)
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+
+def check_result(start, details=None, error=None):
+  """
+  The result of a check which started at the given time
+  """
+  result = {
+    "ok": error is None,
+    "latency_ms": round((time.time() - start) * 1000, 1)
+  }
+  if details is not None:
+    result["details"] = details
+  if error is not None:
+    result["error"] = str(error) or error.__class__.__name__
+  return result
@@ -1,5 +1,6 @@
 from jinja2 import Template
 from . import settings
+from .static_assets import StaticAsset
 
 
 # -----------------------------------------------------------------------------
@@ -8,6 +9,64 @@ from . import settings
 
 STATUS_KEY = "kq_status"
 CSS_FILENAME = "css/bootstrap.css"
+STATIC_PATH = "/static"
+
+_bootstrap_css = None
+_templates = {}
+
+# -----------------------------------------------------------------------------
+# Stylesheets
+# -----------------------------------------------------------------------------
+
+def get_bootstrap_css():
+  """
+  Gets the Bootstrap CSS as a StaticAsset.  The file is read on first use only.
+  """
+  global _bootstrap_css
+  if not _bootstrap_css:
+    _bootstrap_css = StaticAsset(CSS_FILENAME, "bootstrap", "css", "text/css")
+  return _bootstrap_css
+
+def get_page_stylesheet():
+  """
+  Gets the html which applies the Bootstrap CSS to a web page.  If the LINK_PAGE_CSS
+  setting is enabled this is a <link> to the fingerprinted stylesheet served by this 
+  API, otherwise the CSS is inlined in a <style> element.
+  Emails should not use this function.  They always inline the CSS.
+  """
+  css = get_bootstrap_css()
+  if settings.LINK_PAGE_CSS:
+    return "<link rel=\"stylesheet\" href=\"{}{}/{}\">".format(settings.KQ_API_URL, STATIC_PATH, css.published_name)
+  return "<style>\n{}\n</style>".format(css.text)
+
+# -----------------------------------------------------------------------------
+# Templates
+# -----------------------------------------------------------------------------
+
+def _compiled(name, make_source):
+  """
+  Gets a compiled template.  Each template is compiled on first use only
+  (make_source is not called after that).
+  """
+  template = _templates.get(name)
+  if template is None:
+    template = Template(make_source())
+    _templates[name] = template
+  return template
+
+def compile_templates():
+  """
+  Compiles all templates and loads the CSS now, rather than on first use.  Used to
+  build this state once before worker processes are forked (see gunicorn.conf.py).
+  """
+  req_data = {
+    "api": {}, "app": {"owner": {"contact_person": {}}}, "submitted_by_person": {}, "validated": {}
+  }
+  get_verify_key_request_success(req_data)
+  get_verification_email_body(req_data, "")
+  get_notification_email_body(req_data)
+  get_admin_digest_email_body([])
+  _general_msg_head()
 
 # -----------------------------------------------------------------------------
 # Verify API Key - Success
@@ -22,16 +81,13 @@ def get_verify_key_request_success(req_data):
   include_new_metadata_url = False
   request_summary = get_request_data_summary_html(req_data, include_new_metadata_url)
 
-  with open(CSS_FILENAME, 'r') as css_file:
-    css=css_file.read() #.replace('\n', '')  
-
-  template = Template("""
+  template = _compiled("verify_key_request_success", lambda: """
   <html>
   <head>
-  <style>
   """
-  +css+
+  +get_page_stylesheet()+
   """
+  <style>
   .table-condensed {font-size: 12px;}
   </style>
   </head>
@@ -62,21 +118,27 @@ def get_verify_key_request_success(req_data):
 # Verify API Key - Errors
 # -----------------------------------------------------------------------------
 
-def _general_msg(msg, is_err=False):
-  with open(CSS_FILENAME, 'r') as css_file:
-    css=css_file.read() #.replace('\n', '')  
+def _general_msg_head():
+  """
+  The start of a general message page, up to the message.  It includes the CSS, so it
+  is built once only.
+  """
+  head = _templates.get("general_msg_head")
+  if head is None:
+    head = """
+  <html>
+  <head>
+  {}
+  </head>""".format(get_page_stylesheet())
+    _templates["general_msg_head"] = head
+  return head
 
+def _general_msg(msg, is_err=False):
   alert_class = "alert-info"
   if is_err:
     alert_class = "alert-danger"
 
-  html = """
-  <html>
-  <head>
-  <style>
-  {}
-  </style>
-  </head>
+  html = _general_msg_head() + """
   <title>API Key Request</title>
   <body>
   <div class="container">
@@ -85,7 +147,7 @@ def _general_msg(msg, is_err=False):
   </div>
   </body>
   </html>  
-  """.format(css, alert_class, msg)
+  """.format(alert_class, msg)
   return html
 
 def get_err_verify_key_request_general():
@@ -118,8 +180,7 @@ def get_verification_email_body(req_data, verification_code):
     they verify the request
   """
 
-  with open(CSS_FILENAME, 'r') as css_file:
-    css=css_file.read() #.replace('\n', '')  
+  css = get_bootstrap_css().text
 
   request_summary = get_request_data_summary_html(req_data)
 
@@ -128,7 +189,7 @@ def get_verification_email_body(req_data, verification_code):
   verification_link = "<a href='{}'>{}</a>".format(verification_url, verification_url)
 
 
-  template = Template("""
+  template = _compiled("verification_email", lambda: """
   <html>
   <head>
   <style>
@@ -177,10 +238,9 @@ def get_notification_email_body(req_data, include_new_metadata_url=False, includ
   if include_msg:
     msg = "<div class='alert alert-info' role='alert'>This request will be submitted to the API owner for review and approval.</div><br/>"
 
-  with open(CSS_FILENAME, 'r') as css_file:
-    css=css_file.read() #.replace('\n', '')  
+  css = get_bootstrap_css().text
 
-  template = Template("""
+  template = _compiled("notification_email", lambda: """
   <html>
   <head>
   <style>
@@ -218,7 +278,7 @@ def get_notification_email_body(req_data, include_new_metadata_url=False, includ
 # -----------------------------------------------------------------------------
 
 def get_request_data_summary_html(req_data, include_new_metadata_url=False):
-  template = Template("""
+  template = _compiled("request_data_summary", lambda: """
   <table class="table table-condensed">
     <tr>
       <th>API for which a key is requested</th>
@@ -280,4 +340,61 @@ def get_request_data_summary_html(req_data, include_new_metadata_url=False):
     "include_new_metadata_url": include_new_metadata_url
   }
   html = template.render(params)
-  return html
\ No newline at end of file
+  return html
+# -----------------------------------------------------------------------------
+# Admin digest email
+# -----------------------------------------------------------------------------
+
+def get_admin_digest_email_body(summaries):
+  """
+  Creates the body of the digest email which lists several verified requests.  The
+  layout is compact and does not include the Bootstrap CSS.
+  :param summaries: a list of request summaries (see key_requests.admin_digest_summary)
+  """
+  template = _compiled("admin_digest_email", lambda: """
+  <html>
+  <head>
+  <style>
+  body {font-family: sans-serif; font-size: 13px;}
+  table {border-collapse: collapse;}
+  th, td {border: 1px solid #ddd; padding: 4px 6px; text-align: left; vertical-align: top;}
+  th {background: #f5f5f5;}
+  </style>
+  </head>
+  <title>API Key Requests - {{summaries|length}} verified</title>
+  <body>
+  <h3>API Key Requests - {{summaries|length}} verified</h3>
+  <table>
+    <tr>
+      <th>Verified</th>
+      <th>API</th>
+      <th>Application</th>
+      <th>API owner</th>
+      <th>Submitted by</th>
+    </tr>
+    {% for s in summaries %}
+    <tr>
+      <td>{{s["verified"]}}</td>
+      <td>{{s["api_title"]}}</td>
+      <td>
+        {{s["app_title"]}}<br/>
+        {{s["app_url"]}}
+        {% if s["metadata_url"] %}<br/><a href="{{s["metadata_url"]}}">Metadata Record</a>{% endif %}
+      </td>
+      <td>
+        {{s["owner_org_name"]}}<br/>
+        {{s["owner_contact_name"]}} ({{s["owner_contact_email"]}})
+      </td>
+      <td>
+        {{s["submitted_by_name"]}} ({{s["submitted_by_email"]}})<br/>
+        {{s["submitted_by_org_name"]}}
+      </td>
+    </tr>
+    {% endfor %}
+  </table>
+  </body>
+  </html>
+  """
+  )
+
+  return template.render({"summaries": summaries})
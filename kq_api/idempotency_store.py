@@ -0,0 +1,178 @@
+from flask_redis import FlaskRedis
+import redis
+import json
+import hashlib
+from . import settings
+from .key_requests import submitter_email
+from .redis_clients import RedisProvider
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+KEY_PREFIX = "request_key"
+
+#how long a submission may be "in progress" before its claim expires (in case the
+#worker processing it dies)
+PENDING_TTL_SECONDS = 60
+
+#possible outcomes of IdempotencyStore.begin
+NEW = "new"
+REPLAY = "replay"
+IN_PROGRESS = "in_progress"
+MISMATCH = "mismatch"
+
+#Atomically checks a list of keys and, if none of them exist, claims them all.
+#KEYS: the keys.  ARGV[1]: the value to claim them with.  ARGV[2]: the claim's ttl.
+#Returns {0} if the keys were claimed, otherwise {index of the first existing key, its value}.
+CLAIM_SCRIPT = """
+for i, key in ipairs(KEYS) do
+  local value = redis.call('GET', key)
+  if value then
+    return {i, value}
+  end
+end
+for i, key in ipairs(KEYS) do
+  redis.call('SET', key, ARGV[1], 'EX', ARGV[2])
+end
+return {0}
+"""
+
+class IdempotencyStore(object):
+  """
+  Suppresses duplicate submissions of API key requests.  A submission is a duplicate
+  if it has the same Idempotency-Key header as an earlier one, or if the same
+  submitter sent an identical request body within a configurable window.  The
+  response to the original submission is stored so it can be sent again.
+  """
+
+  def __init__(self, app, db_url=None, key_ttl_seconds=settings.SECONDS_PER_DAY, window_seconds=600):
+    """
+    :param key_ttl_seconds: how long an Idempotency-Key is remembered
+    :param window_seconds: how long identical bodies from the same submitter are
+      treated as duplicates
+    """
+    self.app = app
+    self.db_url = db_url
+
+    if db_url:
+      app.config["REDIS_URL"] = db_url
+
+    self._key_ttl_seconds = key_ttl_seconds
+    self._window_seconds = window_seconds
+    self._store = FlaskRedis.from_custom_provider(RedisProvider, app)
+    self._claim_script = self._store.register_script(CLAIM_SCRIPT)
+
+  def begin(self, idempotency_key, req_data):
+    """
+    Records the start of a submission, unless it duplicates an earlier one.
+    Returns a dictionary with these keys:
+      outcome: NEW if the submission should be processed.  REPLAY if it duplicates a
+        completed submission.  IN_PROGRESS if it duplicates one which is still being
+        processed.  MISMATCH if the Idempotency-Key was used before with a different
+        request body.
+      response: the stored response (REPLAY only)
+      claim: pass to complete() or release() when the outcome is NEW
+    """
+    claim = make_claim(idempotency_key, req_data, self._key_ttl_seconds, self._window_seconds)
+    if not claim["keys"]:
+      return {"outcome": NEW, "claim": claim}
+
+    try:
+      result = self._claim_script(keys=claim["keys"], args=[pending_value(claim), PENDING_TTL_SECONDS])
+    except redis.exceptions.ConnectionError as e:
+      self.app.logger.error("Unable to connect to Redis database: '%s'.", self.db_url)
+      raise RuntimeError("Unable to connect to Redis database.")
+
+    return claim_outcome(claim, result)
+
+  def complete(self, claim, response):
+    """
+    Records the response to a submission, so that duplicates receive the same response.
+    If it can't be recorded, the claim is released instead (so that retries aren't
+    rejected as in progress until the claim expires).  Never raises: the submission
+    has already been processed.
+    :param claim: the claim returned by begin()
+    :param response: a JSON-serializable response body
+    """
+    if not claim["keys"]:
+      return
+    try:
+      value = completed_value(claim, response)
+      pipe = self._store.pipeline()
+      for key, ttl in zip(claim["keys"], claim["ttls"]):
+        pipe.set(key, value, ex=ttl)
+      pipe.execute()
+    except (TypeError, ValueError) as e:
+      self.app.logger.error("Unable to encode the response to a submission. %s", e)
+      self.release(claim)
+    except redis.exceptions.RedisError as e:
+      self.app.logger.error("Unable to record the response to a submission in Redis database: '%s'. %s", self.db_url, e)
+      self.release(claim)
+
+  def release(self, claim):
+    """
+    Forgets a submission which was not successful, so that it may be retried.
+    :param claim: the claim returned by begin()
+    """
+    if not claim["keys"]:
+      return
+    try:
+      self._store.delete(*claim["keys"])
+    except redis.exceptions.RedisError as e:
+      self.app.logger.error("Unable to connect to Redis database: '%s'.", self.db_url)
+
+#------------------------------------------------------------------------------
+# Functions shared with AsyncIdempotencyStore
+#------------------------------------------------------------------------------
+
+def make_claim(idempotency_key, req_data, key_ttl_seconds, window_seconds):
+  """
+  Determines which Redis keys identify a submission, and how long each is kept.
+  :param idempotency_key: the value of the Idempotency-Key header (may be None)
+  :param req_data: the request body as a dictionary
+  """
+  fingerprint = _fingerprint(req_data)
+  keys = []
+  ttls = []
+  if idempotency_key:
+    keys.append("{}:idempotency_key:{}".format(KEY_PREFIX, _hash(idempotency_key)))
+    ttls.append(key_ttl_seconds)
+  submitter = submitter_email(req_data)
+  if submitter and window_seconds:
+    keys.append("{}:content:{}".format(KEY_PREFIX, _hash(submitter + fingerprint)))
+    ttls.append(window_seconds)
+  return {"keys": keys, "ttls": ttls, "fingerprint": fingerprint}
+
+def pending_value(claim):
+  return json.dumps({"fingerprint": claim["fingerprint"]})
+
+def completed_value(claim, response):
+  return json.dumps({"fingerprint": claim["fingerprint"], "response": response})
+
+def claim_outcome(claim, result):
+  """
+  Interprets the result of CLAIM_SCRIPT.  See IdempotencyStore.begin.
+  """
+  if result[0] == 0:
+    return {"outcome": NEW, "claim": claim}
+
+  existing = json.loads(result[1])
+  if existing.get("fingerprint") != claim["fingerprint"]:
+    return {"outcome": MISMATCH}
+  if "response" not in existing:
+    return {"outcome": IN_PROGRESS}
+  return {"outcome": REPLAY, "response": existing["response"]}
+
+#------------------------------------------------------------------------------
+# Helper functions
+#------------------------------------------------------------------------------
+
+def _hash(s):
+  return hashlib.sha256(s.encode("utf-8")).hexdigest()
+
+def _fingerprint(req_data):
+  """
+  A hash of the request body which does not depend on the order of its keys
+  """
+  return _hash(json.dumps(req_data, sort_keys=True, separators=(",", ":")))
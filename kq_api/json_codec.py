@@ -0,0 +1,161 @@
+"""
+Purpose: The JSON codec used on the hot paths: parsing request bodies, encoding
+responses (jsonify) and saving and loading requests in the stores.  orjson is used if
+it is installed (see the JSON_CODEC setting), otherwise the standard library's json
+module.
+
+Both codecs produce JSON the other can read, so applications using different codecs
+can share the same stores.  The output is not byte-for-byte identical (orjson writes
+no spaces and does not escape non-ASCII characters), so values which are hashed
+(ETags, idempotency fingerprints) are still encoded with the json module.  orjson
+rejects a few documents the json module accepts (e.g. integers larger than 64 bits,
+NaN), and these fall back to the json module rather than failing.
+
+install(app) makes a Flask application use the codec for request.get_json() and
+jsonify().
+"""
+import json
+import logging
+from . import settings
+try:
+  import orjson
+except ImportError:
+  orjson = None
+try:
+  #Flask 2.2 and later
+  from flask.json.provider import DefaultJSONProvider
+except ImportError:
+  DefaultJSONProvider = None
+
+logger = logging.getLogger(__name__)
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+ORJSON = "orjson"
+STDLIB = "json"
+
+class StdlibCodec(object):
+  """
+  Encodes and decodes JSON with the standard library's json module
+  """
+  name = STDLIB
+
+  def dumps(self, obj, default=None, sort_keys=False):
+    """
+    Encodes obj as a JSON string
+    :param default: a function which converts objects json can't encode
+    """
+    return json.dumps(obj, default=default, sort_keys=sort_keys)
+
+  def dumps_bytes(self, obj, default=None, sort_keys=False):
+    """
+    Encodes obj as UTF-8 JSON
+    """
+    return self.dumps(obj, default=default, sort_keys=sort_keys).encode("utf-8")
+
+  def loads(self, s):
+    """
+    Decodes a JSON document (str or bytes).  Raises ValueError if it is not valid.
+    """
+    return json.loads(s)
+
+class OrjsonCodec(StdlibCodec):
+  """
+  Encodes and decodes JSON with orjson
+  """
+  name = ORJSON
+
+  def dumps(self, obj, default=None, sort_keys=False):
+    return self.dumps_bytes(obj, default=default, sort_keys=sort_keys).decode("utf-8")
+
+  def dumps_bytes(self, obj, default=None, sort_keys=False):
+    option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+    try:
+      return orjson.dumps(obj, default=default, option=option)
+    except orjson.JSONEncodeError:
+      return super(OrjsonCodec, self).dumps_bytes(obj, default=default, sort_keys=sort_keys)
+
+  def loads(self, s):
+    try:
+      return orjson.loads(s)
+    except orjson.JSONDecodeError:
+      #raises ValueError if the document is not valid
+      return json.loads(s)
+
+if DefaultJSONProvider is not None:
+  class CodecJSONProvider(DefaultJSONProvider):
+    """
+    A Flask JSON provider which uses the codec (Flask 2.2 and later).  Pretty-printed
+    responses (debug mode) are still encoded by Flask's default provider.
+    """
+
+    def dumps(self, obj, **kwargs):
+      if kwargs.get("indent") is not None or kwargs.get("cls"):
+        return super(CodecJSONProvider, self).dumps(obj, **kwargs)
+      return codec.dumps(obj, default=kwargs.get("default", self.default), sort_keys=kwargs.get("sort_keys", self.sort_keys))
+
+    def loads(self, s, **kwargs):
+      if kwargs:
+        return super(CodecJSONProvider, self).loads(s, **kwargs)
+      return codec.loads(s)
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+
+def create_codec(name):
+  """
+  The codec with the given name (see the JSON_CODEC setting).  If orjson is
+  requested but not installed, the json module is used.
+  """
+  if name == ORJSON:
+    if orjson is not None:
+      return OrjsonCodec()
+    logger.warning("orjson is not installed.  Using the json module to encode and decode JSON.")
+  return StdlibCodec()
+
+def install(app):
+  """
+  Makes a Flask application use the codec to parse request bodies and encode
+  responses
+  """
+  if DefaultJSONProvider is not None:
+    app.json = CodecJSONProvider(app)
+    return
+  #before Flask 2.2, the encoder and decoder classes are passed to the json module
+  app.json_encoder = make_encoder_class(app.json_encoder)
+  app.json_decoder = make_decoder_class(app.json_decoder)
+
+def make_encoder_class(base):
+  """
+  A subclass of Flask's JSONEncoder whose encode() uses the codec
+  """
+  class CodecJSONEncoder(base):
+    def encode(self, obj):
+      if self.indent is not None:
+        return super(CodecJSONEncoder, self).encode(obj)
+      return codec.dumps(obj, default=self.default, sort_keys=self.sort_keys)
+  return CodecJSONEncoder
+
+def make_decoder_class(base):
+  """
+  A subclass of Flask's JSONDecoder whose decode() uses the codec
+  """
+  class CodecJSONDecoder(base):
+    def decode(self, s, *args, **kwargs):
+      return codec.loads(s)
+  return CodecJSONDecoder
+
+#the codec configured in the application settings
+codec = create_codec(settings.JSON_CODEC)
+
+def dumps(obj):
+  return codec.dumps(obj)
+
+def dumps_bytes(obj):
+  return codec.dumps_bytes(obj)
+
+def loads(s):
+  return codec.loads(s)
@@ -0,0 +1,248 @@
+"""
+Purpose: The parts of processing an API key request which do not depend on how
+requests are served.  These are shared by the Flask application (main.py) and the
+ASGI application (asgi.py).
+"""
+import collections
+import time
+from . import settings
+from . import bcdc
+from . import html_templates as html
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+STATUS_KEY = "kq_status"
+#when the request was submitted (seconds since the epoch)
+SUBMITTED_AT_KEY = "kq_submitted_at"
+PROCESSING_STATES = {
+  "AWAITING_VERIFICATION": "awaiting verification",
+  "VERIFIED": "verified"
+}
+
+#------------------------------------------------------------------------------
+# Status
+#------------------------------------------------------------------------------
+
+def add_initial_status(req_data):
+  """
+  Adds a "status" attribute to the request data (if it doesn't have one already)
+  to track progress of the request.
+  """
+  if not STATUS_KEY in req_data:
+    req_data[STATUS_KEY] = {
+      "state": PROCESSING_STATES["AWAITING_VERIFICATION"]
+    }
+    req_data[SUBMITTED_AT_KEY] = int(time.time())
+  return req_data
+
+def is_awaiting_verification(req_data):
+  return req_data[STATUS_KEY]["state"] == PROCESSING_STATES["AWAITING_VERIFICATION"]
+
+def parse_status_batch(body, max_codes):
+  """
+  The verification codes in the body of a POST /status/batch request (duplicates
+  removed, in order).  Raises ValueError if the body is not an object with a list of
+  1 to max_codes strings in "verification_codes".
+  """
+  codes = body.get("verification_codes") if isinstance(body, dict) else None
+  if not isinstance(codes, list) or not codes or not all(isinstance(c, str) for c in codes):
+    raise ValueError("Expecting a body with 'verification_codes': a list of verification codes.")
+  codes = list(collections.OrderedDict.fromkeys(codes))
+  if len(codes) > max_codes:
+    raise ValueError("Too many verification codes.  At most {} may be requested at once.".format(max_codes))
+  return codes
+
+def status_batch_response(statuses):
+  """
+  The body of a POST /status/batch response
+  :param statuses: a dictionary which maps verification codes to statuses (or None)
+  """
+  results = {}
+  for code, status in statuses.items():
+    results[code] = {"status": status} if status is not None else {"msg": "Unknown verification code"}
+  return {"results": results}
+
+def submitter_email(req_data):
+  """
+  The submitter's business email address (normalized to lower case), or None if the 
+  request data doesn't have one.  The request data need not have been validated.
+  """
+  try:
+    return req_data["submitted_by_person"]["business_email"].strip().lower()
+  except (KeyError, TypeError, AttributeError):
+    return None
+
+def owner_org_id(req_data):
+  """
+  The id of the organization which owns the application (the organization the
+  request's statistics are counted under)
+  """
+  return req_data["app"]["owner"]["org_id"]
+
+def has_new_metadata_record(req_data):
+  """
+  True if a metadata record was already created for the request (by an earlier attempt
+  to verify it)
+  """
+  return bool(req_data[STATUS_KEY].get("new_metadata_record"))
+
+def new_metadata_record_details(package):
+  """
+  Summarizes a newly created BCDC package for the request's status object
+  """
+  return {
+    "package_id": package["id"],
+    "metadata_web_url": bcdc.package_id_to_web_url(package["id"]),
+    "metadata_api_url": bcdc.package_id_to_api_url(package["id"])
+  }
+
+#------------------------------------------------------------------------------
+# BCDC
+#------------------------------------------------------------------------------
+
+def make_package_dict(req_data):
+  """
+  Creates the package_dict for a new BCDC package (metadata record) which
+  describes the application in the given request
+  :param req_data: the req_data of the http request to the /request_key resource
+  """
+  groups = None
+  if req_data["app"]["group"].get("id"):
+    groups = [{"id" : req_data["app"]["group"].get("id")}]
+  package_dict = {
+    "title": req_data["app"].get("title"),
+    "name": bcdc.prepare_package_name(req_data["app"].get("title")),
+    "org": settings.BCDC_PACKAGE_OWNER_ORG_ID,
+    "sub_org": settings.BCDC_PACKAGE_OWNER_SUB_ORG_ID,
+    "owner_org": settings.BCDC_PACKAGE_OWNER_SUB_ORG_ID,
+    "notes": req_data["app"].get("description"),
+    "groups": groups,
+    "state": "active",
+    "resource_status": req_data["app"].get("status", "completed"),
+    "type": "WebService",
+    "tag_string": "API",
+    "tags": [{"name": "TODO"}],
+    "sector": "Service",
+    "edc_state": "DRAFT",
+    "download_audience": req_data["app"]["security"].get("download_audience"),
+    "view_audience":  req_data["app"]["security"].get("view_audience"),
+    "metadata_visibility": req_data["app"]["security"].get("metadata_visibility"),
+    "security_class": req_data["app"]["security"].get("security_class"),
+    "license_id": settings.BCDC_LICENSE_ID_FOR_NEW_METADATA,
+    "contacts": [
+      {
+        "name": req_data["app"]["owner"]["contact_person"].get("name"),
+        "organization": req_data["app"]["owner"]["contact_person"].get("org_id", settings.BCDC_PACKAGE_OWNER_ORG_ID),
+        "branch": req_data["app"]["owner"]["contact_person"].get("sub_org_id", settings.BCDC_PACKAGE_OWNER_SUB_ORG_ID),
+        "email": req_data["app"]["owner"]["contact_person"].get("business_email"),
+        "role": req_data["app"]["owner"]["contact_person"].get("role", "pointOfContact"),
+        "private": req_data["app"]["owner"]["contact_person"].get("private", "Display")
+      }
+    ]
+  }
+  return package_dict
+
+def make_app_resource_dict(package_id, req_data, format="text"):
+  """
+  Creates the resource_dict for a new resource which represents the URL of the app.
+  :param package_id: the id of the package to add the resource to.
+  :param req_data: the req_data of the request to /request_key as a dictionary
+  :param format: the ckan resource format of the app's URL (see content_type_to_format)
+  """
+  return {
+    "package_id": package_id,
+    "url": req_data["app"]["url"],
+    "format": format,
+    "name": "Application home"
+  }
+
+def content_type_to_format(content_type, default=None):
+  """
+  Converts a content type (aka mine type, as would appear in the Content-Type header
+  of an HTTP request or response) into corresponding ckan resource string (html, json, xml, etc.)
+  """
+  if content_type.startswith("text/html"):
+    return "html"
+  if content_type.startswith("application/json"):
+    return "json"
+  if "xml" in content_type:
+    return "xml"
+  return default
+
+#------------------------------------------------------------------------------
+# Emails
+#------------------------------------------------------------------------------
+
+def verification_email(req_data, verification_code):
+  """
+  The email with a link to verify the API key request.
+  Returns a tuple: (to, subject, body)
+  """
+  to = [req_data["submitted_by_person"]["business_email"]]
+  subject = "Verify API Key Request - {}".format(req_data["api"]["title"])
+  body = html.get_verification_email_body(req_data, verification_code)
+  return (to, subject, body)
+
+def submitter_notification_email(req_data):
+  """
+  The email which tells the submitter that a verified request is under review.
+  Returns a tuple: (to, subject, body)
+  """
+  to = [req_data["submitted_by_person"]["business_email"]]
+  subject = "API Key Request - {}".format(req_data["api"]["title"])
+  body = html.get_notification_email_body(req_data, include_new_metadata_url=False, include_msg=True)
+  return (to, subject, body)
+
+def admin_notification_email(req_data):
+  """
+  The email which notifies the administrators (TARGET_EMAIL_ADDRESSES) of a verified request.
+  Returns a tuple: (to, subject, body)
+  """
+  to = settings.TARGET_EMAIL_ADDRESSES.split(",")
+  subject = "API Key Request - {}".format(req_data["api"]["title"])
+  body = html.get_notification_email_body(req_data, include_new_metadata_url=True, include_msg=False)
+  return (to, subject, body)
+
+def is_urgent(req_data):
+  """
+  Urgent requests are sent to the administrators immediately, even in digest mode.
+  A request is urgent if its owner organization or its security class is configured
+  as urgent (ADMIN_EMAIL_URGENT_ORG_IDS, ADMIN_EMAIL_URGENT_SECURITY_CLASSES).  The
+  submitter can't make a request urgent.
+  """
+  app = req_data["app"]
+  if app["owner"].get("org_id") in settings.ADMIN_EMAIL_URGENT_ORG_IDS:
+    return True
+  return app["security"].get("security_class") in settings.ADMIN_EMAIL_URGENT_SECURITY_CLASSES
+
+def admin_digest_summary(req_data):
+  """
+  The details of a verified request which are listed in the admin digest email
+  """
+  validated = req_data.get("validated", {})
+  new_metadata_record = req_data.get(STATUS_KEY, {}).get("new_metadata_record") or {}
+  return {
+    "verified": time.strftime("%Y-%m-%d %H:%M", time.localtime()),
+    "api_title": req_data["api"].get("title"),
+    "app_title": req_data["app"].get("title"),
+    "app_url": req_data["app"].get("url"),
+    "metadata_url": req_data["app"].get("metadata_url") or new_metadata_record.get("metadata_web_url"),
+    "owner_org_name": ", ".join(n for n in [validated.get("owner_sub_org_name"), validated.get("owner_org_name")] if n),
+    "owner_contact_name": req_data["app"]["owner"]["contact_person"].get("name"),
+    "owner_contact_email": req_data["app"]["owner"]["contact_person"].get("business_email"),
+    "submitted_by_name": req_data["submitted_by_person"].get("name"),
+    "submitted_by_email": req_data["submitted_by_person"].get("business_email"),
+    "submitted_by_org_name": ", ".join(n for n in [validated.get("submitted_by_person_sub_org_name"), validated.get("submitted_by_person_org_name")] if n)
+  }
+
+def admin_digest_email(summaries):
+  """
+  The email which notifies the administrators of several verified requests.
+  Returns a tuple: (to, subject, body)
+  """
+  to = settings.TARGET_EMAIL_ADDRESSES.split(",")
+  subject = "API Key Requests - {} verified".format(len(summaries))
+  body = html.get_admin_digest_email_body(summaries)
+  return (to, subject, body)
@@ -0,0 +1,305 @@
+"""
+Purpose: Lifecycle events and statistics of API key requests.  Each event (a request
+submitted, verified or expired; a challenge created; a captcha served) is appended to
+a capped Redis Stream (STREAM_KEY), and counted in a hash per day at the same time:
+
+  kq_stats:day:<days since the epoch (UTC)>
+    <event>                      the number of events of the day
+    org:<org id>:<event>         the same, per owner organization (request events only)
+    verify_seconds_count         time from submission to verification: the number of
+    verify_seconds_sum           requests verified, the total seconds, and the number
+    verify_seconds_le_<seconds>  in each bucket of the histogram (not cumulative)
+
+The admin statistics (GET /admin/stats) read one hash per day, so their cost does not
+depend on the number of requests, and no keys are ever scanned.  Requests which are
+submitted but never verified are counted as expired on the day they expire: each
+submitted request is kept in a sorted set (PENDING_KEY) by its expiry time until it is
+verified, and every event recorded (and every read of the statistics) moves a batch of
+the expired ones to the counters.
+
+Events and statistics are not needed to process requests, so Redis errors are logged
+and otherwise ignored.
+"""
+from flask_redis import FlaskRedis
+import datetime
+import redis
+import time
+from .redis_clients import RedisProvider
+from .key_requests import SUBMITTED_AT_KEY, owner_org_id
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+STREAM_KEY = "kq_events"
+PENDING_KEY = "kq_stats:pending"
+DAY_KEY_PREFIX = "kq_stats:day:"
+
+SECONDS_PER_DAY = 24*60*60
+
+#events
+SUBMITTED = "submitted"
+VERIFIED = "verified"
+EXPIRED = "expired"
+CHALLENGE_CREATED = "challenge_created"
+CAPTCHA_SERVED = "captcha_served"
+EVENTS = [SUBMITTED, VERIFIED, EXPIRED, CHALLENGE_CREATED, CAPTCHA_SERVED]
+#the events which are also counted per owner organization
+REQUEST_EVENTS = [SUBMITTED, VERIFIED, EXPIRED]
+
+#the upper bounds (in seconds) of the buckets of the time-to-verify histogram.  a last
+#bucket, "+Inf", counts the rest.
+VERIFY_SECONDS_BUCKETS = [60, 5*60, 15*60, 60*60, 4*60*60, 12*60*60, SECONDS_PER_DAY, 2*SECONDS_PER_DAY]
+
+#the most expired requests moved to the counters by each call to the script
+REAP_BATCH_SIZE = 100
+
+#Counts expired requests, then (if ARGV[6] is not empty) records one event.  Every
+#event is added to the stream (trimmed to about ARGV[4] entries) and counted in the
+#hash of its day, which expires ARGV[3] seconds after its last update.
+#KEYS[1]: the stream.  KEYS[2]: the pending requests (member "<org>|<code>", scored
+#by expiry time).
+#ARGV[1]: the time.  ARGV[2]: the prefix of the day keys.  ARGV[3]: the TTL of the
+#day keys.  ARGV[4]: the stream's length.  ARGV[5]: the most expired requests to count.
+#ARGV[6]: the event ('' for none).  ARGV[7]: the owner org id ('' if none).  ARGV[8]:
+#the verification code ('' if none).  ARGV[9]: the expiry time of a submitted request
+#('' if not pending).  ARGV[10]: the seconds from submission to verification ('' if
+#unknown).  ARGV[11]: the histogram field of ARGV[10].
+#Returns the number of expired requests counted.
+RECORD_SCRIPT = """
+--XADD generates its id from the clock, so the script's effects are replicated rather than
+--the script itself (the default from Redis 5; required before it)
+if redis.replicate_commands then
+  redis.replicate_commands()
+end
+local now = tonumber(ARGV[1])
+
+local function count(day, event, org)
+  local key = ARGV[2] .. day
+  redis.call('HINCRBY', key, event, 1)
+  if org ~= '' then
+    redis.call('HINCRBY', key, 'org:' .. org .. ':' .. event, 1)
+  end
+  redis.call('EXPIRE', key, ARGV[3])
+  return key
+end
+
+local function append(event, org, code)
+  redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[4], '*', 'event', event, 'org', org, 'code', code)
+end
+
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now, 'WITHSCORES', 'LIMIT', 0, ARGV[5])
+for i = 1, #expired, 2 do
+  local member = expired[i]
+  local sep = string.find(member, '|', 1, true)
+  local org, code = string.sub(member, 1, sep - 1), string.sub(member, sep + 1)
+  count(math.floor(tonumber(expired[i + 1]) / 86400), 'expired', org)
+  append('expired', org, code)
+  redis.call('ZREM', KEYS[2], member)
+end
+
+local event, org, code = ARGV[6], ARGV[7], ARGV[8]
+if event ~= '' then
+  local key = count(math.floor(now / 86400), event, org)
+  append(event, org, code)
+  if ARGV[9] ~= '' then
+    redis.call('ZADD', KEYS[2], ARGV[9], org .. '|' .. code)
+  end
+  if event == 'verified' then
+    redis.call('ZREM', KEYS[2], org .. '|' .. code)
+    if ARGV[10] ~= '' then
+      redis.call('HINCRBY', key, 'verify_seconds_count', 1)
+      redis.call('HINCRBYFLOAT', key, 'verify_seconds_sum', ARGV[10])
+      redis.call('HINCRBY', key, ARGV[11], 1)
+    end
+  end
+end
+return #expired / 2
+"""
+
+class LifecycleEvents(object):
+  """
+  Records lifecycle events of API key requests and challenges, and reads the daily
+  statistics.  When not enabled, nothing is recorded.
+  """
+
+  def __init__(self, app, db_url=None, enabled=True, stream_max_length=100000, retention_days=400):
+    """
+    :param stream_max_length: the (approximate) number of events kept in the stream
+    :param retention_days: how long the daily statistics are kept
+    """
+    self.app = app
+    self.db_url = db_url
+
+    if db_url:
+      app.config["REDIS_URL"] = db_url
+
+    self.enabled = enabled
+    self.stream_max_length = stream_max_length
+    self.retention_days = retention_days
+    self._store = FlaskRedis.from_custom_provider(RedisProvider, app)
+    self._record_script = self._store.register_script(RECORD_SCRIPT)
+
+  def submitted(self, req_data, verification_code, ttl_seconds):
+    """
+    Records a request which was saved, and which expires in ttl_seconds unless it is
+    verified
+    """
+    self.record(SUBMITTED, org=owner_org_id(req_data), code=verification_code, expires=time.time() + int(ttl_seconds))
+
+  def verified(self, req_data, verification_code):
+    submitted_at = req_data.get(SUBMITTED_AT_KEY)
+    verify_seconds = max(time.time() - submitted_at, 0) if submitted_at else None
+    self.record(VERIFIED, org=owner_org_id(req_data), code=verification_code, verify_seconds=verify_seconds)
+
+  def challenge_created(self):
+    self.record(CHALLENGE_CREATED)
+
+  def captcha_served(self):
+    self.record(CAPTCHA_SERVED)
+
+  def record(self, event, org=None, code=None, expires=None, verify_seconds=None):
+    """
+    Appends an event to the stream and counts it.  Errors are logged, not raised.
+    """
+    if not self.enabled:
+      return
+    try:
+      self._record_script(keys=[STREAM_KEY, PENDING_KEY], args=script_args(self, event, org, code, expires, verify_seconds))
+    except redis.exceptions.RedisError as e:
+      self.app.logger.error("Unable to record '%s' event in Redis database: '%s'. %s", event, self.db_url, e)
+
+  def stats(self, days=7):
+    """
+    The statistics of the last 'days' days (UTC), newest first.  Raises RuntimeError if
+    they can't be read.
+    """
+    dates = recent_dates(days)
+    try:
+      self._record_script(keys=[STREAM_KEY, PENDING_KEY], args=script_args(self, None))
+      pipe = self._store.pipeline()
+      for date in dates:
+        pipe.hgetall(day_key(date))
+      hashes = pipe.execute()
+    except redis.exceptions.RedisError as e:
+      self.app.logger.error("Unable to read statistics from Redis database: '%s'. %s", self.db_url, e)
+      raise RuntimeError("Unable to read statistics.")
+    return summarize(dates, hashes)
+
+#------------------------------------------------------------------------------
+# Functions shared with the ASGI application
+#------------------------------------------------------------------------------
+
+def script_args(events, event, org=None, code=None, expires=None, verify_seconds=None):
+  """
+  The ARGV of RECORD_SCRIPT
+  :param events: a LifecycleEvents (or its asynchronous version)
+  :param event: the event to record, or None to only count expired requests
+  """
+  return [
+    time.time(),
+    DAY_KEY_PREFIX,
+    events.retention_days * SECONDS_PER_DAY,
+    events.stream_max_length,
+    REAP_BATCH_SIZE,
+    event or "",
+    (org or "").replace("|", ""),
+    code or "",
+    expires or "",
+    "" if verify_seconds is None else round(verify_seconds, 3),
+    "" if verify_seconds is None else verify_seconds_field(verify_seconds)
+  ]
+
+def parse_days(value, max_days):
+  """
+  Parses the 'days' parameter of GET /admin/stats.  Returns the number of days to
+  report (7 if the value is empty, at most max_days).  Raises ValueError if the value
+  is not a positive integer.
+  """
+  if not value:
+    return min(7, max_days)
+  try:
+    days = int(value)
+  except ValueError:
+    raise ValueError("Invalid 'days' parameter.  Expecting a positive integer.")
+  if days < 1:
+    raise ValueError("Invalid 'days' parameter.  Expecting a positive integer.")
+  return min(days, max_days)
+
+def verify_seconds_field(seconds):
+  """
+  The name of the histogram field which counts the given time to verify
+  """
+  for bound in VERIFY_SECONDS_BUCKETS:
+    if seconds <= bound:
+      return "verify_seconds_le_{}".format(bound)
+  return "verify_seconds_le_inf"
+
+def recent_dates(days):
+  """
+  The last 'days' dates (UTC), newest first
+  """
+  today = datetime.datetime.utcfromtimestamp(time.time()).date()
+  return [today - datetime.timedelta(days=i) for i in range(days)]
+
+def day_key(date):
+  return "{}{}".format(DAY_KEY_PREFIX, (date - datetime.date(1970, 1, 1)).days)
+
+def summarize(dates, hashes):
+  """
+  The statistics response: the counts of each day, and the totals of all of them
+  :param dates: a list of dates
+  :param hashes: the day hash of each date (field names and values as bytes or str)
+  """
+  days = []
+  totals = new_summary()
+  for date, h in zip(dates, hashes):
+    day = new_summary()
+    for field, value in h.items():
+      field = field.decode("utf-8") if isinstance(field, bytes) else field
+      add_field(day, field, float(value))
+      add_field(totals, field, float(value))
+    days.append(dict(finish_summary(day), date=date.isoformat()))
+  return {
+    "days": days,
+    "totals": finish_summary(totals)
+  }
+
+def new_summary():
+  return {
+    "events": dict((event, 0) for event in EVENTS),
+    "orgs": {},
+    "verify_seconds": {"count": 0, "sum": 0.0, "buckets": {}}
+  }
+
+def add_field(summary, field, value):
+  if field in EVENTS:
+    summary["events"][field] += int(value)
+  elif field.startswith("org:"):
+    org, _, event = field[len("org:"):].rpartition(":")
+    counts = summary["orgs"].setdefault(org, dict((e, 0) for e in REQUEST_EVENTS))
+    counts[event] = counts.get(event, 0) + int(value)
+  elif field == "verify_seconds_count":
+    summary["verify_seconds"]["count"] += int(value)
+  elif field == "verify_seconds_sum":
+    summary["verify_seconds"]["sum"] += value
+  elif field.startswith("verify_seconds_le_"):
+    bound = field[len("verify_seconds_le_"):]
+    buckets = summary["verify_seconds"]["buckets"]
+    buckets[bound] = buckets.get(bound, 0) + int(value)
+
+def finish_summary(summary):
+  """
+  Converts the histogram buckets to cumulative counts (as in Prometheus histograms)
+  and adds the mean
+  """
+  histogram = summary["verify_seconds"]
+  cumulative = []
+  total = 0
+  for bound in VERIFY_SECONDS_BUCKETS + ["inf"]:
+    total += histogram["buckets"].get(str(bound), 0)
+    cumulative.append({"le": "+Inf" if bound == "inf" else bound, "count": total})
+  histogram["buckets"] = cumulative
+  histogram["sum"] = round(histogram["sum"], 3)
+  histogram["mean"] = round(histogram["sum"] / histogram["count"], 3) if histogram["count"] else None
+  return summary
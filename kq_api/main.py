@@ -1,14 +1,43 @@
-from flask import Flask, Response, jsonify, request, redirect, url_for, g, send_file
+from flask import Flask, Response, jsonify, request, g, send_file, has_request_context
+from flask.logging import default_handler
 from . import settings
 from . import bcdc
 from . import html_templates as html
-from .emailer import send_email
-from .challenge_store import ChallengeStore
+from .emailer import send_email, check_smtp_server
+from .challenge_store import ChallengeStore, TokenChallengeStore
 from .request_store import RequestStore
+from .idempotency_store import IdempotencyStore
+from . import idempotency_store
+from .rate_limiter import RateLimiter
+from . import rate_limiter
+from .admission import AdmissionController
+from .package_names import PackageNameRegistry
+from .admin_digest import AdminDigest
+from .lifecycle_events import LifecycleEvents
+from . import lifecycle_events
+from . import precompute
+from .precompute import Precomputer
+from .status_watcher import StatusWatcher, status_etag, parse_wait_seconds
+from . import admission
+from .api_spec import ApiSpec
+from .profanity import ProfanityMatcher
+from .validation import RequestValidator, ValidationError, REQUEST_SCHEMA
+from . import key_requests
+from .key_requests import STATUS_KEY, PROCESSING_STATES
+from . import compression
+from . import structured_logging
+from . import storage
+from . import deadlines
+from . import json_codec
+from .allocation_profiler import AllocationProfiler
+from . import health
+from .health import HealthChecker
+from . import admin_auth
+from . import url_probe
 from profanityfilter import ProfanityFilter
 import os
-import json
-import requests
+import functools
+import time
 import logging
 from flask_cors import CORS
 
@@ -16,7 +45,20 @@ from flask_cors import CORS
 # Init
 #------------------------------------------------------------------------------
 
-app = Flask(__name__)
+#all log records are written as JSON by a background listener, tagged with the
+#correlation id of the request being processed (see structured_logging)
+structured_logging.configure_logging(settings.LOG_LEVEL, log_format=settings.LOG_FORMAT, queue_size=settings.LOG_QUEUE_SIZE, info_sample_rate=settings.LOG_INFO_SAMPLE_RATE)
+structured_logging.set_correlation_id_getter(lambda: g.get("correlation_id") if has_request_context() else None)
+
+#outbound calls made while a request is processed are bounded by its deadline
+deadlines.set_deadline_getter(lambda: g.get("deadline") if has_request_context() else None)
+deadline_stats = deadlines.DeadlineStats()
+
+#the default static route is disabled.  fingerprinted static files are served by 
+#get_static_file() (below)
+app = Flask(__name__, static_folder=None)
+#request bodies and responses are parsed and encoded with the configured JSON codec
+json_codec.install(app)
 
 #In debug mode add CORS headers to responses. (When not in debug mode, it is 
 #assumed that CORS headers will be controlled externally, such as by a reverse
@@ -24,29 +66,70 @@ app = Flask(__name__)
 if "FLASK_DEBUG" in os.environ and os.environ["FLASK_DEBUG"]:
   CORS(app)
 
-#setup data stores
-kq_store = RequestStore(app, db_url=settings.KQ_STORE_URL, default_ttl_seconds=settings.KQ_STORE_TTL_SECONDS)
-challenge_store = ChallengeStore(app, db_url=settings.CAPTCHA_STORE_URL, default_ttl_seconds=settings.CAPTCHA_STORE_TTL_SECONDS)
+#setup data stores.  key requests and challenges are kept in Redis unless a memory 
+#backend is configured.
+kq_backend = storage.backend_from_settings("kq_store", settings.KQ_STORE_BACKEND)
+challenge_backend = storage.backend_from_settings("challenge_store", settings.CAPTCHA_STORE_BACKEND)
+kq_store = RequestStore(app, db_url=settings.KQ_STORE_URL, default_ttl_seconds=settings.KQ_STORE_TTL_SECONDS, status_ttl_seconds=settings.STATUS_TTL_SECONDS, backend=kq_backend)
+if settings.CHALLENGE_TOKENS_ENABLED:
+  challenge_store = TokenChallengeStore(app, db_url=settings.CAPTCHA_STORE_URL, default_ttl_seconds=settings.CAPTCHA_STORE_TTL_SECONDS, server_key=settings.CHALLENGE_TOKEN_KEY)
+else:
+  challenge_store = ChallengeStore(app, db_url=settings.CAPTCHA_STORE_URL, default_ttl_seconds=settings.CAPTCHA_STORE_TTL_SECONDS, shard_urls=settings.CHALLENGE_STORE_SHARD_URLS, backend=challenge_backend)
+limiter = RateLimiter(app, db_url=settings.CAPTCHA_STORE_URL, rules=rate_limiter.rules_from_settings(), enabled=settings.RATE_LIMITS_ENABLED)
+package_name_registry = PackageNameRegistry(app, db_url=settings.KQ_STORE_URL, cache_ttl_seconds=settings.PACKAGE_NAME_CACHE_TTL_SECONDS, reservation_ttl_seconds=settings.PACKAGE_NAME_RESERVATION_TTL_SECONDS)
+admin_digest = AdminDigest(app, db_url=settings.KQ_STORE_URL, interval_seconds=settings.ADMIN_EMAIL_DIGEST_INTERVAL_SECONDS, max_items=settings.ADMIN_EMAIL_DIGEST_MAX_ITEMS)
+submission_store = IdempotencyStore(app, db_url=settings.KQ_STORE_URL, key_ttl_seconds=settings.IDEMPOTENCY_KEY_TTL_SECONDS, window_seconds=settings.DUPLICATE_SUBMISSION_WINDOW_SECONDS)
+status_watcher = StatusWatcher(app, db_url=settings.KQ_STORE_URL)
+lifecycle = LifecycleEvents(app, db_url=settings.KQ_STORE_URL, enabled=settings.LIFECYCLE_EVENTS_ENABLED, stream_max_length=settings.LIFECYCLE_STREAM_MAX_LENGTH, retention_days=settings.LIFECYCLE_STATS_RETENTION_DAYS)
+if kq_backend:
+  #statuses saved in this process are passed to the watcher directly, not through Redis
+  kq_backend.subscribe(status_watcher.dispatch)
+
+#the slow steps of verification which don't depend on the click are run in the
+#background once a request is saved (see precompute)
+precomputer = Precomputer(kq_store, [
+    (precompute.APP_FORMAT, lambda req_data: get_app_format(req_data["app"]["url"], settings.APP_URL_PROBE_TIMEOUT_SECONDS))
+  ],
+  enabled=settings.PRECOMPUTE_ENABLED,
+  workers=settings.PRECOMPUTE_WORKERS,
+  max_pending=settings.PRECOMPUTE_MAX_PENDING)
+
+#the dependencies' health is checked in the background, so GET /readyz does no I/O
+health_checker = HealthChecker([
+    (health.KQ_STORE, kq_store.ping),
+    (health.CAPTCHA_STORE, challenge_store.ping),
+    (health.BCDC, functools.partial(bcdc.status_show, timeout=settings.HEALTH_CHECK_TIMEOUT_SECONDS)),
+    (health.SMTP, functools.partial(check_smtp_server, settings.SMTP_SERVER, settings.SMTP_PORT, timeout=settings.HEALTH_CHECK_TIMEOUT_SECONDS))
+  ],
+  required=settings.HEALTH_REQUIRED_CHECKS,
+  interval_seconds=settings.HEALTH_CHECK_INTERVAL_SECONDS,
+  timeout_seconds=settings.HEALTH_CHECK_TIMEOUT_SECONDS)
+
+#opt-in tracing of the memory allocated by each request (see allocation_profiler)
+allocation_profiler = AllocationProfiler(enabled=settings.ALLOCATION_PROFILING_ENABLED, frames=settings.ALLOCATION_PROFILING_FRAMES, top_sites=settings.ALLOCATION_PROFILING_TOP_SITES)
+allocation_profiler.start()
 
 #setup logging
+app.logger.removeHandler(default_handler) #records propagate to the queue handler instead
 app.logger.setLevel(getattr(logging, settings.LOG_LEVEL)) #main logger's level
 
 #inject some initial log messages
-app.logger.info("Initializing {}".format(__name__))
-app.logger.info("Log level is '{}'".format(settings.LOG_LEVEL))
+app.logger.info("Initializing %s", __name__)
+app.logger.info("Log level is '%s'", settings.LOG_LEVEL)
 
-profanity_filter = ProfanityFilter()
+#limits concurrent requests to expensive endpoints (per worker process)
+admission_controller = AdmissionController(admission.limits_from_settings(), settings.ADMISSION_MAX_WAIT_SECONDS, settings.ADMISSION_RETRY_AFTER_SECONDS)
+
+profanity_matcher = ProfanityMatcher.from_profanity_filter(ProfanityFilter())
+request_validator = RequestValidator(REQUEST_SCHEMA, profanity_matcher, challenge_store)
 
 #------------------------------------------------------------------------------
 # Constants
 #------------------------------------------------------------------------------
 
 API_SPEC_FILENAME = os.path.join(app.root_path, "../docs/kq-api.openapi3.json")
-STATUS_KEY = "kq_status"
-PROCESSING_STATES = {
-  "AWAITING_VERIFICATION": "awaiting verification",
-  "VERIFIED": "verified"
-}
+api_spec = ApiSpec(API_SPEC_FILENAME, max_hosts=settings.API_SPEC_CACHE_MAX_HOSTS, known_hosts=settings.API_SPEC_CACHED_URLS)
+COMPRESSIBLE_MIMETYPES = ["text/html", "application/json"]
 
 #------------------------------------------------------------------------------
 # API Endpoints
@@ -58,12 +141,15 @@ def api():
   Summary information about this API
   """
   apiBaseUrl = request.url_root.rstrip("/")
+  spec = api_spec.render(apiBaseUrl)
 
-  with open(API_SPEC_FILENAME) as f:
-    s = f.read()
-    s = s.replace("${HOST}", apiBaseUrl)
-    r = Response(response=s, mimetype='application/json', status=200)
-    return r
+  r = make_precompressed_response(spec["body"], spec["variants"], spec["etag"], 'application/json')
+  r.last_modified = api_spec.last_modified
+  r.headers["Cache-Control"] = "public, max-age={}".format(settings.API_SPEC_MAX_AGE_SECONDS)
+
+  #converts the response to a 304 if the client's cached copy is still current
+  r.make_conditional(request)
+  return r
 
 @app.route('/request_key', methods=["POST"])
 def request_key():
@@ -82,44 +168,42 @@ def request_key():
   try:
     req_data = request.get_json()
   except Exception as e:
-    print(e)
+    app.logger.debug("Invalid request body. %s", e)
     return jsonify({"msg": "request body is not valid json"}), 400
 
-  #validate the request body
-  try:
-    req_data = clean_and_validate_req_data(req_data)
-  except ValueError as e:
-    return jsonify({"msg": "{}".format(e)}), 400
-  except RuntimeError as e:
-    app.logger.error("{}".format(e));
-    return jsonify({"msg": "An unexpected error occurred while validating the API key request."}), 500
- 
-  #check for bad language in request body
-  app.logger.info("check bad language")
-  try:
-    check_bad_language(req_data)
-  except ValueError as e:
-    return jsonify({"msg": "{}".format(e)}), 400
+  #limit requests per client.  (requests are limited per submitter once they are
+  #validated, see process_key_request.)
+  throttled = check_rate_limits([(rate_limiter.REQUEST_KEY, get_client_ip())])
+  if throttled:
+    return throttled
 
-  #save the API key request and generate a verification code
+  #a retried or double-submitted request gets the original response, and is not 
+  #validated, stored or emailed again
   try:
-    verification_code = kq_store.save_request(req_data)
+    submission = submission_store.begin(request.headers.get("Idempotency-Key"), req_data)
   except RuntimeError as e:
-    app.logger.error("Unable to save request. {}".format(e))
+    app.logger.error("Unable to check for duplicate submission. %s", e)
     return jsonify({"msg": "Server error.  Unable to record API key request."}), 500
 
-  #send the verification code to the user
-  try:
-    send_verification_email_to_submitter(req_data, verification_code)
-  except Exception as e: 
-    app.logger.error("Unable to send verification email for new API. {}".format(e))
-    return jsonify({"msg": "Server error.  Unable to record API key request."}), 500
-
-  success_resp = {
-    "verification_code": verification_code
-  }
+  if submission["outcome"] == idempotency_store.REPLAY:
+    r = jsonify(submission["response"])
+    r.headers["Idempotent-Replayed"] = "true"
+    return r, 200
+  if submission["outcome"] == idempotency_store.IN_PROGRESS:
+    r = jsonify({"msg": "An identical API key request is already being processed."})
+    r.headers["Retry-After"] = "1"
+    return r, 409
+  if submission["outcome"] == idempotency_store.MISMATCH:
+    return jsonify({"msg": "Idempotency-Key has already been used with a different request body."}), 422
+
+  resp, status_code, headers = process_key_request(req_data)
+  if status_code == 200:
+    submission_store.complete(submission["claim"], resp)
+  else:
+    #unsuccessful submissions may be retried
+    submission_store.release(submission["claim"])
 
-  return jsonify(success_resp), 200
+  return jsonify(resp), status_code, headers
 
 @app.route('/verify_key_request', methods=["GET"])
 def verify_key_request():
@@ -134,18 +218,21 @@ def verify_key_request():
   try:
     req_data = kq_store.load_request(verification_code)
   except RuntimeError as e:
-    app.logger.error("Unable to access request from store. {}".format(e))
+    app.logger.error("Unable to access request from store. %s", e)
     return html.get_err_verify_key_request_store(), 500
 
   if not req_data:
     return html.get_err_verify_key_request_invalid_code(), 404
 
-  if req_data[STATUS_KEY]["state"] != PROCESSING_STATES["AWAITING_VERIFICATION"]:
+  if not key_requests.is_awaiting_verification(req_data):
     return html.get_err_verify_key_request_already_done(), 400
 
-  metadata_web_url = None
-  #create a draft metadata record (if one doesn't exist yet)
-  if not req_data["app"].get("metadata_url"):
+  #results of the steps run in the background when the request was saved
+  precomputed = kq_store.load_precomputed(verification_code)
+
+  #create a draft metadata record (if one doesn't exist yet, and wasn't created by an
+  #earlier attempt to verify this request)
+  if not req_data["app"].get("metadata_url") and not key_requests.has_new_metadata_record(req_data):
     package = None
     try:
       package = create_package(req_data)
@@ -153,30 +240,42 @@ def verify_key_request():
         raise ValueError("Unknown reason")
       #add a status object to the request data.  the updated request data will
       #be saved back to the store (below) for a brief period of time.
-      new_metadata_record_details = {
-        "package_id": package["id"],
-        "metadata_web_url": bcdc.package_id_to_web_url(package["id"]),
-        "metadata_api_url": bcdc.package_id_to_api_url(package["id"])
-      }
-      req_data[STATUS_KEY]["new_metadata_record"] = new_metadata_record_details
+      req_data[STATUS_KEY]["new_metadata_record"] = key_requests.new_metadata_record_details(package)
     except ValueError as e: #user input errors cause HTTP 400
       return html.get_err_create_metadata(e), 400
     except RuntimeError as e: #unexpected system errors cause HTTP 500
-      app.logger.error("{}".format(e))
+      app.logger.error("%s", e)
       return html.get_err_verify_key_request_general(), 500
 
+    #the package exists now, so verification must complete: the package is recorded
+    #(so it isn't created again if the link is clicked again), and the remaining steps
+    #are no longer bounded by the request's deadline, and can't fail the request
+    deadlines.lift()
     try:
-      create_app_resource(package["id"], req_data)
-    except ValueError as e: #perhaps other errors are possible too??  if so, catch those too
-      app.logger.warn("Unable to create app root resource associated with the new metadata record. {}".format(e))
+      kq_store.save_request(req_data, verification_code=verification_code)
+    except RuntimeError as e:
+      app.logger.error("Unable to record the new metadata record of request. %s", e)
 
-  send_notification_email_to_admin(req_data)
+    try:
+      create_app_resource(package["id"], req_data, format=precomputed.get(precompute.APP_FORMAT))
+    except (ValueError, RuntimeError) as e:
+      app.logger.warning("Unable to create app root resource associated with the new metadata record. %s", e)
+
+  try:
+    send_notification_email_to_admin(req_data)
+  except Exception as e:
+    app.logger.error("Unable to send notification email to admin. %s", e)
 
   req_data[STATUS_KEY]["state"] = PROCESSING_STATES["VERIFIED"]
 
-  send_notification_email_to_submitter(req_data)
+  try:
+    send_notification_email_to_submitter(req_data)
+  except Exception as e:
+    app.logger.error("Unable to send notification email to submitter. %s", e)
 
-  kq_store.save_request(req_data, verification_code=verification_code)
+  #only the status is needed from now on
+  kq_store.compact_request(req_data, verification_code)
+  lifecycle.verified(req_data, verification_code)
 
   return html.get_verify_key_request_success(req_data), 200
 
@@ -187,25 +286,74 @@ def get_status():
   associated with a given verification code.  The status is only available for a certain 
   amount of time (STATUS_TTL_SECONDS) after the a request is verified .  
   After that the status is deleted.
+  The response has an ETag.  If the request has an If-None-Match header with the current 
+  ETag and a 'wait' parameter (seconds), the response is held until the status changes 
+  (HTTP 200) or the wait is over (HTTP 304).
   """
-  app.logger.info("verify_key_request message received")
+  app.logger.info("get_status message received")
   verification_code = request.args.get('verification_code')
+
+  try:
+    wait_seconds = parse_wait_seconds(request.args.get('wait'), settings.STATUS_LONG_POLL_MAX_SECONDS)
+  except ValueError as e:
+    return jsonify({"msg": "{}".format(e)}), 400
+
+  waiter = None
+  if wait_seconds and verification_code and request.if_none_match:
+    waiter = status_watcher.watch(verification_code)
+  try:
+    try:
+      req_data = kq_store.load_request(verification_code)
+    except RuntimeError as e:
+      app.logger.error("Unable to access request from store. %s", e)
+      return jsonify({"msg": "Server error.  Unable to access status of API key request."}), 500
+
+    if not req_data:
+      return jsonify({"msg": "Unknown verification code"}), 404
+    
+    if not STATUS_KEY in req_data:
+      return jsonify({"msg": "Unable to find status of this request"}), 500
+
+    status = req_data[STATUS_KEY]
+    etag = status_etag(status)
+    if waiter:
+      status, etag = wait_for_status_change(waiter, status, etag, wait_seconds)
+  finally:
+    if waiter:
+      status_watcher.unwatch(waiter)
+
+  r = jsonify(status)
+  r.set_etag(etag)
+  r.headers["Cache-Control"] = "no-cache"
+  #converts the response to a 304 if the client already has this status
+  r.make_conditional(request)
+  return r
   
+@app.route('/status/batch', methods=["POST"])
+def get_status_batch():
+  """
+  Gets the statuses of several API Key Requests in one request (and one round trip to
+  the store), for support tooling.  The request body (application/json) is:
+    {"verification_codes": ["CODE", ...]}
+  with at most STATUS_BATCH_MAX_CODES codes.  The response maps each code to
+  {"status": {...}} or, if the code is unknown, {"msg": "..."}:
+    {"results": {"CODE": {"status": {...}}, ...}}
+  """
   try:
-    req_data = kq_store.load_request(verification_code)
+    codes = key_requests.parse_status_batch(request.get_json(silent=True), settings.STATUS_BATCH_MAX_CODES)
+  except ValueError as e:
+    return jsonify({"msg": "{}".format(e)}), 400
+
+  try:
+    statuses = kq_store.load_many(codes)
   except RuntimeError as e:
-    app.logger.error("Unable to access request from store. {}".format(e))
-    return jsonify({"msg": "Server error.  Unable to access status of API key request."}), 500
+    app.logger.error("Unable to access requests from store. %s", e)
+    return jsonify({"msg": "Server error.  Unable to access status of API key requests."}), 500
 
-  if not req_data:
-    return jsonify({"msg": "Unknown verification code"}), 404
-  
-  if not STATUS_KEY in req_data:
-    return jsonify({"msg": "Unable to find status of this request"}), 500
+  r = jsonify(key_requests.status_batch_response(statuses))
+  r.headers["Cache-Control"] = "no-cache"
+  return r, 200
 
-  status = req_data[STATUS_KEY]
-  return jsonify(status), 200
-  
 @app.route('/challenge', methods=["POST"])
 def new_challenge():
   """
@@ -228,6 +376,10 @@ def new_challenge():
       "challenge_id": "ID HERE"
     }
   """
+  throttled = check_rate_limits([(rate_limiter.CHALLENGE, get_client_ip())])
+  if throttled:
+    return throttled
+
   include_secret = False
 
   #check optional request body.
@@ -241,10 +393,11 @@ def new_challenge():
 
   try:
     challenge = challenge_store.new_challenge()
-    print(challenge)
+    app.logger.debug("Created challenge %s", challenge["challenge_id"])
   except RuntimeError as e:
-    app.logger.error("Unable to create new challenge. {}".format(e))
+    app.logger.error("Unable to create new challenge. %s", e)
     return jsonify({"msg": "Unable to create new challenge"}), 500
+  lifecycle.challenge_created()
 
   resp_success = {
     "challenge_id": challenge["challenge_id"]
@@ -264,229 +417,472 @@ def get_captcha_image(challenge_id):
   if not challenge_id:
     return jsonify({"msg": "Not found"}), 404
 
-  captcha_bytes = challenge_store.challenge_id_to_captcha(challenge_id)
+  throttled = check_rate_limits([(rate_limiter.CAPTCHA_IMAGE, get_client_ip())])
+  if throttled:
+    return throttled
+
+  try:
+    captcha_bytes = challenge_store.challenge_id_to_captcha(challenge_id)
+  except ValueError as e:
+    return jsonify({"msg": "Not found"}), 404
+  except RuntimeError as e:
+    app.logger.error("Unable to create captcha image. %s", e)
+    return jsonify({"msg": "Unable to create captcha image"}), 500
+  lifecycle.captcha_served()
   return send_file(captcha_bytes, mimetype='image/png')
 
+@app.route('/static/<filename>', methods=["GET"])
+def get_static_file(filename):
+  """
+  Gets a fingerprinted static file (currently only the Bootstrap CSS, which web pages
+  link to when the LINK_PAGE_CSS setting is enabled).  The file name includes a hash of the 
+  content, so the response may be cached indefinitely.
+  """
+  css = html.get_bootstrap_css()
+  if filename != css.published_name:
+    return jsonify({"msg": "Not found"}), 404
+
+  r = make_precompressed_response(css.body, css.variants, css.etag, css.mimetype)
+  r.headers["Cache-Control"] = "public, max-age={}, immutable".format(settings.STATIC_MAX_AGE_SECONDS)
+  r.make_conditional(request)
+  return r
+
+@app.route('/healthz', methods=["GET"])
+def get_liveness():
+  """
+  Liveness probe.  Responds if the process can serve requests; does no I/O.
+  """
+  return jsonify({"status": "ok"}), 200
+
+@app.route('/readyz', methods=["GET"])
+def get_readiness():
+  """
+  Readiness probe.  Reports the latest results of the background health checks
+  (application/json).  HTTP 200 if the required dependencies are healthy, otherwise
+  HTTP 503.
+  """
+  ready, body = health_checker.readiness()
+  r = jsonify(body)
+  r.status_code = 200 if ready else 503
+  r.headers["Cache-Control"] = "no-store"
+  return r
+
+@app.route('/admin/admission', methods=["GET"])
+def get_admission_stats():
+  """
+  Gets the admission control limits of this worker process, and the current number of 
+  active and queued requests for each controlled endpoint (application/json)
+  """
+  return jsonify(admission_controller.stats()), 200
+
+@app.route('/admin/deadlines', methods=["GET"])
+def get_deadline_stats():
+  """
+  Gets the number of requests to each route in this worker process which finished
+  after their deadline, which found the budget spent before an outbound step, and
+  which skipped optional steps to stay within it (application/json)
+  """
+  return jsonify(deadline_stats.stats()), 200
+
+@app.route('/admin/allocations', methods=["GET", "DELETE"])
+def get_allocations():
+  """
+  Gets the top allocation sites of each route (application/json), or clears them
+  (DELETE).  Only available when ALLOCATION_PROFILING_ENABLED is set.
+  Optional parameter:
+    top: the number of sites per route
+  """
+  if not allocation_profiler.enabled:
+    return jsonify({"msg": "Allocation profiling is not enabled."}), 404
+  if request.method == "DELETE":
+    allocation_profiler.reset()
+    return jsonify({"msg": "Allocation statistics cleared."}), 200
+  try:
+    top_sites = int(request.args.get("top") or allocation_profiler.top_sites)
+  except ValueError:
+    return jsonify({"msg": "Invalid 'top' parameter.  Expecting an integer."}), 400
+  return jsonify(allocation_profiler.report(top_sites)), 200
+
+@app.route('/admin/stats', methods=["GET"])
+def get_lifecycle_stats():
+  """
+  Gets the number of requests submitted, verified and expired, challenges created and
+  captchas served per day (UTC) and per owner organization, and a histogram of the
+  time from submission to verification (application/json).  The counts are kept up
+  to date as events happen (see lifecycle_events), so no requests are read.
+  Optional parameter:
+    days: the number of days to report, including today (default 7)
+  """
+  try:
+    days = lifecycle_events.parse_days(request.args.get("days"), settings.LIFECYCLE_STATS_RETENTION_DAYS)
+  except ValueError as e:
+    return jsonify({"msg": "{}".format(e)}), 400
+  try:
+    stats = lifecycle.stats(days)
+  except RuntimeError as e:
+    app.logger.error("%s", e)
+    return jsonify({"msg": "Server error.  Unable to read statistics."}), 500
+  return jsonify(stats), 200
+
 # -----------------------------------------------------------------------------
-# Helper functions
+# Correlation ids
 # -----------------------------------------------------------------------------
 
-def check_bad_language(req_data):
+@app.before_request
+def assign_correlation_id():
   """
-  Checks for profanity in the request object
-  If any problems is found, raises a ValueError with a description.  
-  Otherwise returns None if no problems.
+  Each request has a correlation id which is added to every log record written while
+  it is processed, and returned in the X-Request-ID response header.  An id sent by
+  the proxy or client in the X-Request-ID header is reused.
   """
-  app.logger.info("check bad language")
-  app.logger.info(req_data["app"]["title"])
-  app.logger.info(profanity_filter.is_profane(req_data["app"]["title"]))
-  if profanity_filter.is_profane(req_data["app"]["title"]):
-    raise ValueError("Inappropriate language found in the application's title.")  
+  g.correlation_id = structured_logging.new_correlation_id(request.headers.get("X-Request-ID"))
 
-  if profanity_filter.is_profane(req_data["app"]["description"]):
-    raise ValueError("Inappropriate language found in the application's description.")
-  
+@app.after_request
+def add_correlation_id_header(response):
+  if "correlation_id" in g:
+    response.headers["X-Request-ID"] = g.correlation_id
+  return response
+
+# -----------------------------------------------------------------------------
+# Admin routes
+# -----------------------------------------------------------------------------
+
+@app.before_request
+def authenticate_admin_request():
+  """
+  Requests to the admin routes must carry the admin key (see admin_auth)
+  """
+  if not request.path.startswith(admin_auth.ADMIN_PATH_PREFIX):
+    return None
+  rejection = admin_auth.check(request.headers.get("Authorization"))
+  if not rejection:
+    return None
+  body, status_code, headers = rejection
+  app.logger.warning("Rejected request to '%s': HTTP %s.", request.path, status_code)
+  return jsonify(body), status_code, headers
+
+# -----------------------------------------------------------------------------
+# Deadlines
+# -----------------------------------------------------------------------------
+
+@app.before_request
+def start_deadline():
+  """
+  Starts the request's time budget (see deadlines)
+  """
+  seconds = deadlines.seconds_for_route(request.endpoint)
+  if seconds:
+    g.deadline = deadlines.Deadline(request.endpoint, seconds)
+
+@app.teardown_request
+def record_deadline(exception):
+  deadline_stats.record(g.pop("deadline", None))
+
+# -----------------------------------------------------------------------------
+# Allocation profiling
+# -----------------------------------------------------------------------------
+
+@app.before_request
+def snapshot_allocations():
+  if request.endpoint != "get_allocations":
+    g.allocation_snapshot = allocation_profiler.snapshot()
+
+@app.teardown_request
+def record_allocations(exception):
+  allocation_profiler.record(request.endpoint, g.pop("allocation_snapshot", None))
+
+# -----------------------------------------------------------------------------
+# Background tasks
+# -----------------------------------------------------------------------------
+
+@app.before_request
+def start_background_tasks():
+  """
+  Starts this worker process's background tasks (once).  They are started here 
+  rather than at import time so that they run in each worker, not in a gunicorn
+  master which preloads the application.
+  """
+  if settings.ADMIN_EMAIL_DIGEST_ENABLED:
+    admin_digest.start_flusher(send_admin_digest)
+  if settings.STATUS_LONG_POLL_MAX_SECONDS and not kq_backend:
+    status_watcher.start_listener()
+  for backend in [kq_backend, challenge_backend]:
+    if backend:
+      backend.start_snapshots()
+  health_checker.start()
+
+# -----------------------------------------------------------------------------
+# Admission control
+# -----------------------------------------------------------------------------
+
+@app.before_request
+def admit_request():
+  """
+  Requests to expensive endpoints wait (briefly) for a free slot.  If none becomes 
+  available the request is rejected with HTTP 503 instead of occupying the worker.
+  """
+  gate = admission_controller.gate(request.endpoint)
+  if not gate:
+    return None
+  if not gate.enter():
+    app.logger.warning("Rejected request to '%s': %s active, %s queued.", request.endpoint, gate.active, gate.queued)
+    r = jsonify({"msg": "The server is busy.  Please try again later."})
+    r.status_code = 503
+    r.headers["Retry-After"] = str(admission_controller.retry_after_seconds)
+    return r
+  g.admission_gate = gate
   return None
 
-def clean_and_validate_req_data(req_data):
+@app.teardown_request
+def release_request(exception):
+  gate = g.pop("admission_gate", None)
+  if gate:
+    gate.leave()
 
-  #ensure req_data object hierarchy exists
-  #---------------------------------------
-  if not req_data:
-    req_data = {}
-  if not req_data.get("api"):
-    req_data["api"] = {}
-  if not req_data.get("app"):
-    req_data["app"] = {}
-  if not req_data["app"].get("group"):
-    req_data["app"]["group"] = {}
-  if not req_data["app"].get("owner"):
-    req_data["app"]["owner"] = {}
-  if not req_data["app"].get("security"):
-    req_data["app"]["security"] = {}
-  #if not req_data["app"].get("license"):
-  #  req_data["app"]["license"] = {}
-  if not req_data["app"]["owner"].get("contact_person"):
-    req_data["app"]["owner"]["contact_person"] = {}
-  if not req_data.get("submitted_by_person"):
-    req_data["submitted_by_person"] = {}
-  if not req_data.get("challenge"):
-    req_data["challenge"] = {}
-
-  #check that required fields are present
-  #--------------------------------------
-  if not req_data["api"].get("title"):
-    raise ValueError("Missing '$.api.title'")
-
-  if not req_data["app"].get("title"):
-    raise ValueError("Missing '$.app.title'")
-  if not req_data["app"].get("description"):
-    raise ValueError("Missing '$.app.description'")
-  if not req_data["app"].get("url"):
-    raise ValueError("Missing '$.app.url'")
-  if not req_data["app"].get("status"):
-    raise ValueError("Missing '$.app.status'")
-
-  if not req_data["app"]["owner"].get("org_id"):
-    raise ValueError("Missing '$.app.owner.org_id'")
-  
-  if not req_data["app"]["owner"]["contact_person"].get("name"):
-    raise ValueError("Missing '$.app.owner.contact_person.name'")
-  if not req_data["app"]["owner"]["contact_person"].get("business_email"):
-    raise ValueError("Missing '$.app.owner.contact_person.business_email'") 
-
-  if not req_data["app"]["security"].get("download_audience"):
-    raise ValueError("Missing '$.app.security.download_audience'")
-  if not req_data["app"]["security"].get("view_audience"):
-    raise ValueError("Missing '$.app.security.view_audience'")
-  if not req_data["app"]["security"].get("metadata_visibility"):
-    raise ValueError("Missing '$.app.security.metadata_visibility'")
-  if not req_data["app"]["security"].get("security_class"):
-    raise ValueError("Missing '$.app.security.security_class'")
-
-  #if not req_data["app"]["license"].get("license_id"):
-  #  raise ValueError("Missing '$.app.license.license_id'")
-
-  if not req_data["submitted_by_person"].get("name"):
-    raise ValueError("Missing '$.submitted_by_person.name'")
-  if not req_data["submitted_by_person"].get("org_id") and not req_data["submitted_by_person"].get("org_name"):
-    raise ValueError("Missing one of '$.submitted_by_person.org_id' or '$submitted_by_person.org_name'")
-  if not req_data["submitted_by_person"].get("business_email"):
-    raise ValueError("Missing '$.submitted_by_person.business_email'")
-
-  if not req_data["challenge"].get("id"):
-    raise ValueError("Missing '$.challenge.id'")
-  if not req_data["challenge"].get("secret"):
-    raise ValueError("Missing '$.challenge.secret'")
-  
-  if not challenge_store.is_valid(req_data["challenge"].get("id"), req_data["challenge"].get("secret")):
-    raise ValueError("Captcha challenge failed.")
-
-  #defaults
-  #--------
-  if not req_data["app"]["owner"]["contact_person"].get("org_id"):
-    req_data["app"]["owner"]["contact_person"]["org_id"] = req_data["app"]["owner"].get("org_id")
-  if not req_data["app"]["owner"]["contact_person"].get("sub_org_id"):
-    req_data["app"]["owner"]["contact_person"]["sub_org_id"] = req_data["app"]["owner"].get("sub_org_id")
-
-  #validate field values
-  #---------------------
-  req_data["validated"] = {}
-  owner_org = bcdc.get_organization(req_data["app"]["owner"].get("org_id"))
-  if owner_org:
-    req_data["validated"]["owner_org_name"] = owner_org["title"]
-  else:
-    raise ValueError("Unknown organization specified in '$.app.owner.org_id'")    
-  
-  owner_sub_org = bcdc.get_organization(req_data["app"]["owner"].get("sub_org_id"))
-  if owner_sub_org:
-    req_data["validated"]["owner_sub_org_name"] = owner_sub_org["title"]    
-  
-  owner_contact_org = bcdc.get_organization(req_data["app"]["owner"]["contact_person"].get("org_id"))
-  if owner_contact_org:
-    req_data["validated"]["owner_contact_org_name"] = owner_contact_org["title"]
+# -----------------------------------------------------------------------------
+# Response processing
+# -----------------------------------------------------------------------------
+
+@app.after_request
+def compress_response(response):
+  """
+  Compresses HTML and JSON responses with the best content coding accepted by the 
+  client.  Responses that are already encoded, streamed, or smaller than
+  COMPRESS_MIN_SIZE_BYTES are left as-is.  A compressed response's ETag is suffixed
+  with the content coding, like those of precompressed responses.
+  """
+  if not settings.COMPRESS_RESPONSES:
+    return response
+  if response.direct_passthrough or "Content-Encoding" in response.headers or response.status_code == 304:
+    return response
+  if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+    return response
+
+  response.vary.add("Accept-Encoding")
+  encoding = compression.choose_encoding(request.headers.get("Accept-Encoding"))
+  if not encoding:
+    return response
+
+  data = response.get_data()
+  if len(data) < settings.COMPRESS_MIN_SIZE_BYTES:
+    return response
+
+  etag, weak = response.get_etag()
+  if etag:
+    response.set_etag(compression.encoded_etag(etag, encoding), weak)
+  response.set_data(compression.compress(data, encoding))
+  response.headers["Content-Encoding"] = encoding
+  return response
+
+@app.after_request
+def match_etag_variants(response):
+  """
+  Converts a response into a 304 if the client has any variant of it (compressed with
+  any content coding, or not at all).  The views' make_conditional only matches the
+  exact ETag.  (Runs before compress_response: after_request functions are called in
+  reverse order.)
+  """
+  if response.status_code != 200 or request.method not in ("GET", "HEAD"):
+    return response
+  etag, _ = response.get_etag()
+  if compression.etags_match(request.headers.get("If-None-Match"), etag):
+    response.status_code = 304
+  return response
+
+# -----------------------------------------------------------------------------
+# Helper functions
+# -----------------------------------------------------------------------------
+
+def get_client_ip():
+  """
+  The IP address of the client which sent the current request.  See 
+  rate_limiter.client_ip and settings.TRUSTED_PROXY_COUNT.
+  """
+  return rate_limiter.client_ip(request.remote_addr, request.headers.get("X-Forwarded-For"), settings.TRUSTED_PROXY_COUNT)
+
+def check_rate_limits(rule_identities):
+  """
+  Counts the current request against the given rate limit rules.  Returns a 429 
+  response if any of the limits has been reached, otherwise None.
+  :param rule_identities: a list of (rule name, identity) tuples.  See RateLimiter.hit.
+  """
+  retry_after = limiter.hit(rule_identities)
+  if not retry_after:
+    return None
+  r = jsonify({"msg": "Too many requests.  Please try again later."})
+  r.status_code = 429
+  r.headers["Retry-After"] = str(retry_after)
+  return r
+
+def wait_for_status_change(waiter, status, etag, wait_seconds):
+  """
+  Waits until a status other than the one the client has (in its If-None-Match header)
+  is published, or wait_seconds have passed.  Returns the latest (status, etag).
+  """
+  deadline = time.time() + wait_seconds
+  #the client may have the ETag of a compressed variant of the status
+  while compression.etags_match(request.headers.get("If-None-Match"), etag):
+    remaining = deadline - time.time()
+    if remaining <= 0:
+      break
+    published = waiter.wait(remaining)
+    if published is None:
+      break
+    status, etag = published, status_etag(published)
+  return status, etag
+
+def make_precompressed_response(body, variants, etag, mimetype):
+  """
+  Creates a response for content which has already been compressed.  The variant 
+  sent is chosen from the request's Accept-Encoding header.  Each variant has its own 
+  ETag.
+  :param body: the uncompressed content (bytes)
+  :param variants: a dictionary which maps content coding to compressed content
+  :param etag: the ETag of the uncompressed content
+  :param mimetype: the mimetype of the content
+  """
+  encoding = compression.choose_encoding(request.headers.get("Accept-Encoding"), list(variants))
+  if encoding:
+    r = Response(response=variants[encoding], mimetype=mimetype, status=200)
+    r.headers["Content-Encoding"] = encoding
+    r.set_etag(compression.encoded_etag(etag, encoding))
   else:
-    raise ValueError("Unknown organization specified in '$.app.owner.contact_person.org_id'")
+    r = Response(response=body, mimetype=mimetype, status=200)
+    r.set_etag(etag)
+  r.vary.add("Accept-Encoding")
+  return r
+
+def process_key_request(req_data):
+  """
+  Validates a new API key request, saves it and emails a verification code to the 
+  submitter.
+  :param req_data: the body of the request to /request_key as a dictionary
+  :return: a tuple (response body as a dictionary, HTTP status code, response headers)
+  """
 
-  owner_contact_sub_org = bcdc.get_organization(req_data["app"]["owner"]["contact_person"].get("sub_org_id"))
-  if owner_contact_sub_org:
-    req_data["validated"]["owner_contact_sub_org_name"] = owner_contact_sub_org["title"]
+  #validate the request body (including checks for bad language).  all problems 
+  #found are reported together.
+  try:
+    req_data = clean_and_validate_req_data(req_data)
+  except ValidationError as e:
+    return {"msg": "{}".format(e), "errors": e.errors}, 400, {}
+  except ValueError as e:
+    return {"msg": "{}".format(e)}, 400, {}
+  except RuntimeError as e:
+    app.logger.error("%s", e)
+    return {"msg": "An unexpected error occurred while validating the API key request."}, 500, {}
 
-  submitted_by_person_org = bcdc.get_organization(req_data["submitted_by_person"].get("org_id"))
-  if submitted_by_person_org:
-    req_data["validated"]["submitted_by_person_org_name"] = submitted_by_person_org["title"]
+  #limit requests per submitter.  only requests which passed the captcha challenge are
+  #counted, so nobody else can use up the limit of a submitter's email address.
+  retry_after = limiter.hit([(rate_limiter.REQUEST_KEY_PER_EMAIL, key_requests.submitter_email(req_data))])
+  if retry_after:
+    return {"msg": "Too many requests.  Please try again later."}, 429, {"Retry-After": str(retry_after)}
 
-  submitted_by_person_sub_org = bcdc.get_organization(req_data["submitted_by_person"].get("sub_org_id"))
-  if submitted_by_person_sub_org:
-    req_data["validated"]["submitted_by_person_sub_org_name"] = submitted_by_person_sub_org["title"]
+  #save the API key request and generate a verification code
+  try:
+    verification_code = kq_store.save_request(req_data)
+  except RuntimeError as e:
+    app.logger.error("Unable to save request. %s", e)
+    return {"msg": "Server error.  Unable to record API key request."}, 500, {}
+  lifecycle.submitted(req_data, verification_code, settings.KQ_STORE_TTL_SECONDS)
+  precomputer.schedule(req_data, verification_code)
 
-  if not submitted_by_person_org:
-    req_data["validated"]["submitted_by_person_org_name"] = req_data["submitted_by_person"].get("org_name")
+  #send the verification code to the user
+  try:
+    send_verification_email_to_submitter(req_data, verification_code)
+  except Exception as e: 
+    app.logger.error("Unable to send verification email for new API. %s", e)
+    return {"msg": "Server error.  Unable to record API key request."}, 500, {}
 
-  #add a "status" attribute to track progress of the the request
-  #-------------------------------------------------------------
+  success_resp = {
+    "verification_code": str(verification_code)
+  }
 
-  if not STATUS_KEY in req_data:
-    req_data[STATUS_KEY] = {
-      "state": PROCESSING_STATES["AWAITING_VERIFICATION"]
-    }
+  return success_resp, 200, {}
 
-  return req_data
+def clean_and_validate_req_data(req_data):
+  """
+  Cleans and validates the body of a request to /request_key, and adds a status 
+  object to it.  See validation.REQUEST_SCHEMA for the rules.
+  Raises ValidationError (a ValueError) listing every problem found, or RuntimeError
+  if the challenge store or BCDC could not be accessed.
+  """
+  req_data = request_validator.validate(req_data)
+  return key_requests.add_initial_status(req_data)
 
 def create_package(req_data):
   """
   Registers a new package with BCDC
   :param req_data: the req_data of the http request to the /register resource
   """
-  groups = None
-  if req_data["app"]["group"].get("id"):
-    groups = [{"id" : req_data["app"]["group"].get("id")}]
-  package_dict = {
-    "title": req_data["app"].get("title"),
-    "name": bcdc.prepare_package_name(req_data["app"].get("title")),
-    "org": settings.BCDC_PACKAGE_OWNER_ORG_ID,
-    "sub_org": settings.BCDC_PACKAGE_OWNER_SUB_ORG_ID,
-    "owner_org": settings.BCDC_PACKAGE_OWNER_SUB_ORG_ID,
-    "notes": req_data["app"].get("description"),
-    "groups": groups,
-    "state": "active",
-    "resource_status": req_data["app"].get("status", "completed"),
-    "type": "WebService",
-    "tag_string": "API",
-    "tags": [{"name": "TODO"}],
-    "sector": "Service",
-    "edc_state": "DRAFT",
-    "download_audience": req_data["app"]["security"].get("download_audience"),
-    "view_audience":  req_data["app"]["security"].get("view_audience"),
-    "metadata_visibility": req_data["app"]["security"].get("metadata_visibility"),
-    "security_class": req_data["app"]["security"].get("security_class"),
-    "license_id": settings.BCDC_LICENSE_ID_FOR_NEW_METADATA,
-    "contacts": [
-      {
-        "name": req_data["app"]["owner"]["contact_person"].get("name"),
-        "organization": req_data["app"]["owner"]["contact_person"].get("org_id", settings.BCDC_PACKAGE_OWNER_ORG_ID),
-        "branch": req_data["app"]["owner"]["contact_person"].get("sub_org_id", settings.BCDC_PACKAGE_OWNER_SUB_ORG_ID),
-        "email": req_data["app"]["owner"]["contact_person"].get("business_email"),
-        "role": req_data["app"]["owner"]["contact_person"].get("role", "pointOfContact"),
-        "private": req_data["app"]["owner"]["contact_person"].get("private", "Display")
-      }
-    ]
-  }
-
-  package = bcdc.package_create(package_dict, api_key=settings.BCDC_API_KEY)
-  app.logger.debug("Created metadata record: {}".format(bcdc.package_id_to_web_url(package["id"])))
+  package_dict = key_requests.make_package_dict(req_data)
+  preferred_name = package_dict["name"]
+  package_dict["name"], token = package_name_registry.reserve(preferred_name)
+  try:
+    package = create_package_with_reserved_name(package_dict, token)
+  except bcdc.PackageNameTakenError as e:
+    #the name belongs to a package which isn't in the list of known names (such as 
+    #a private package, or one created since the names were cached).  try once more 
+    #with the next available name.
+    app.logger.info("Package name '%s' is taken. %s", package_dict["name"], e)
+    package_dict["name"], token = package_name_registry.reserve(preferred_name)
+    package = create_package_with_reserved_name(package_dict, token)
+  package_name_registry.mark_taken(package_dict["name"])
+  app.logger.debug("Created metadata record: %s", bcdc.package_id_to_web_url(package["id"]))
   return package
 
-def create_app_resource(package_id, req_data):
+def create_package_with_reserved_name(package_dict, token):
+  """
+  Creates a package whose name was reserved with the given token.  If the name is
+  taken it is recorded as such, and if the package can't be created for another
+  reason the name is released.
+  """
+  try:
+    return bcdc.package_create(package_dict, api_key=settings.BCDC_API_KEY)
+  except bcdc.PackageNameTakenError:
+    package_name_registry.mark_taken(package_dict["name"])
+    raise
+  except Exception:
+    package_name_registry.release(package_dict["name"], token)
+    raise
+
+def create_app_resource(package_id, req_data, format=None):
   """
   Adds a new resource to the given package.  The new resource represents the URL of the app.
   :param package_id: the id of the package to add the resource to.
   :param req_data: the req_data of the request to /register as a dictionary
+  :param format: the format of the app's content, if it is already known (precomputed).
+    Otherwise the app's URL is probed for it.
   :return: the new resource
   """
   
   #download api base url and check its content type (so we can create a 'resource' 
   #with the appropriate content type)
-  format = "text"
-  try:
-    r = requests.get(req_data["app"]["url"])
-    if r.status_code < 400:
-      resource_content_type = r.headers['content-type']
-      format = content_type_to_format(resource_content_type, "text")
-  except requests.exceptions.ConnectionError as e:
-    app.logger.warning("Unable to access app '{}' to determine content type.".format(req_data["app"]["url"]))
-    pass
+  if not format:
+    #the probe is optional.  it is skipped if it could leave too little of the 
+    #request's budget for creating the resource and sending the emails.
+    timeout = deadlines.optional_timeout(deadlines.APP_URL_PROBE, settings.APP_URL_PROBE_TIMEOUT_SECONDS)
+    if timeout is None:
+      app.logger.warning("Skipped content type probe of app '%s' to meet the request's deadline.", req_data["app"]["url"])
+    else:
+      format = get_app_format(req_data["app"]["url"], timeout)
 
   #add the "API root" resource to the package
-  resource_dict = {
-    "package_id": package_id, 
-    "url": req_data["app"]["url"],
-    "format": format, 
-    "name": "Application home"
-  }
+  resource_dict = key_requests.make_app_resource_dict(package_id, req_data, format or "text")
   resource = bcdc.resource_create(resource_dict, api_key=settings.BCDC_API_KEY)
   return resource
 
+def get_app_format(url, timeout):
+  """
+  Requests the app's URL to determine the ckan format of its content (see
+  key_requests.content_type_to_format).  Returns None if the URL may not be probed
+  (see url_probe), or the app could not be accessed or responded with an error.
+  """
+  content_type = url_probe.get_content_type(url, timeout)
+  if content_type:
+    return key_requests.content_type_to_format(content_type, "text")
+  return None
+
 def create_api_spec_resource(package_id, req_data):
   """
   Adds a new resource to the given package.  The new resource represents the API spec.
@@ -504,7 +900,7 @@ def create_api_spec_resource(package_id, req_data):
       "format": "openapi-json",
       "name": "API specification"
     }
-    resource = resource_create(resource_dict, api_key=settings.BCDC_API_KEY)
+    resource = bcdc.resource_create(resource_dict, api_key=settings.BCDC_API_KEY)
     return resource
 
   return None
@@ -514,62 +910,51 @@ def send_verification_email_to_submitter(req_data, verification_code):
   Sends an email with a link to verify the API key request.
   (Verifying the request will advance to the next step of processing.)
   """
-
-  email_body = html.get_verification_email_body(req_data, verification_code)
-
-  send_email(
-    to=[req_data["submitted_by_person"]["business_email"]], \
-    bcc=None, \
-    email_subject="Verify API Key Request - {}".format(req_data["api"]["title"]), \
-    email_body=email_body,\
-    smtp_server=settings.SMTP_SERVER, \
-    smtp_port=settings.SMTP_PORT, \
-    from_email_address=settings.FROM_EMAIL_ADDRESS, \
-    from_password=settings.FROM_EMAIL_PASSWORD)
-  app.logger.debug("Sent verification email to: {}.".format(req_data["submitted_by_person"]["business_email"]))
-
+  to, subject, body = key_requests.verification_email(req_data, verification_code)
+  _send_email(to, subject, body)
+  app.logger.debug("Sent verification email to: %s.", to)
 
 def send_notification_email_to_submitter(req_data):
   """
   Sends a notification email
   """
-  to = [req_data["submitted_by_person"]["business_email"]]
-
-  send_email(
-    to=to, \
-    email_subject="API Key Request - {}".format(req_data["api"]["title"]), \
-    email_body=html.get_notification_email_body(req_data, include_new_metadata_url=False, include_msg=True), \
-    smtp_server=settings.SMTP_SERVER, \
-    smtp_port=settings.SMTP_PORT, \
-    from_email_address=settings.FROM_EMAIL_ADDRESS, \
-    from_password=settings.FROM_EMAIL_PASSWORD)
-  app.logger.debug("Sent notification email to: {}.".format(to))
+  to, subject, body = key_requests.submitter_notification_email(req_data)
+  _send_email(to, subject, body)
+  app.logger.debug("Sent notification email to: %s.", to)
 
 def send_notification_email_to_admin(req_data):
   """
-  Sends a notification email
+  Sends a notification email.  In digest mode (ADMIN_EMAIL_DIGEST_ENABLED) the request is
+  added to the next digest instead, unless it is urgent.
+  """
+  if settings.ADMIN_EMAIL_DIGEST_ENABLED and not key_requests.is_urgent(req_data):
+    try:
+      if admin_digest.add(key_requests.admin_digest_summary(req_data)):
+        admin_digest.flush(send_admin_digest)
+      return
+    except RuntimeError as e:
+      app.logger.error("%s  Sending admin notification immediately.", e)
+
+  to, subject, body = key_requests.admin_notification_email(req_data)
+  _send_email(to, subject, body)
+  app.logger.debug("Sent notification email to: %s. ", to)
+
+def send_admin_digest(summaries):
+  """
+  Sends one email which lists several verified requests
   """
-  to = settings.TARGET_EMAIL_ADDRESSES.split(",")
+  to, subject, body = key_requests.admin_digest_email(summaries)
+  _send_email(to, subject, body)
+  app.logger.debug("Sent digest of %s requests to: %s.", len(summaries), to)
 
+def _send_email(to, subject, body):
   send_email(
     to=to, \
-    email_subject="API Key Request - {}".format(req_data["api"]["title"]), \
-    email_body=html.get_notification_email_body(req_data, include_new_metadata_url=True, include_msg=False), \
+    bcc=None, \
+    email_subject=subject, \
+    email_body=body, \
     smtp_server=settings.SMTP_SERVER, \
     smtp_port=settings.SMTP_PORT, \
     from_email_address=settings.FROM_EMAIL_ADDRESS, \
-    from_password=settings.FROM_EMAIL_PASSWORD)
-  app.logger.debug("Sent notification email to: {}. ".format(to))
-
-def content_type_to_format(content_type, default=None):
-  """
-  Converts a content type (aka mine type, as would appear in the Content-Type header 
-  of an HTTP request or response) into corresponding ckan resource string (html, json, xml, etc.)
-  """
-  if content_type.startswith("text/html"):
-    return "html"
-  if content_type.startswith("application/json"):
-    return "json"
-  if "xml" in content_type:
-    return "xml"
-  return default
\ No newline at end of file
+    from_password=settings.FROM_EMAIL_PASSWORD, \
+    timeout=deadlines.timeout(deadlines.SMTP))
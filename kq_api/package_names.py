@@ -0,0 +1,182 @@
+from flask_redis import FlaskRedis
+import redis
+import threading
+import uuid
+from . import bcdc
+from . import settings
+from .redis_clients import RedisProvider
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+KNOWN_NAMES_KEY = "package_names:known"
+REFRESHED_KEY = "package_names:refreshed"
+REFRESH_LOCK_KEY = "package_names:refresh_lock"
+RESERVED_KEY_PREFIX = "package_names:reserved:"
+
+#how many suffixed alternatives (name-2, name-3, ...) are considered
+MAX_CANDIDATES = 50
+
+#how long one worker may spend refreshing the known names before another may try
+REFRESH_LOCK_TTL_SECONDS = 60
+
+#Reserves the first candidate name which is neither a known package name nor
+#reserved by another request.
+#KEYS[1]: the set of known names.  ARGV[1]: the reservation key prefix.  ARGV[2]: the
+#reservation token.  ARGV[3]: the reservation ttl.  ARGV[4...]: the candidates.
+#Returns the reserved name, or false if every candidate is taken.
+RESERVE_SCRIPT = """
+for i = 4, #ARGV do
+  local name = ARGV[i]
+  if redis.call('SISMEMBER', KEYS[1], name) == 0 then
+    if redis.call('SET', ARGV[1] .. name, ARGV[2], 'NX', 'EX', ARGV[3]) then
+      return name
+    end
+  end
+end
+return false
+"""
+
+#Releases a reservation if it is still held by the given token.
+#KEYS[1]: the reservation key.  ARGV[1]: the reservation token.
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+class PackageNameRegistry(object):
+  """
+  Chooses unique names for new BCDC packages.  Names are checked against a cached
+  set of the names of existing packages (refreshed from BCDC's package_list) and
+  reserved in Redis, so that two requests with similar titles verified at the same
+  time do not choose the same name.  If the preferred name is taken, a numeric suffix
+  is added (name-2, name-3, ...).
+
+  Choosing a name never waits for BCDC: when the cached names are stale they are
+  refreshed in a background thread, and the stale names are used meanwhile (a name
+  taken since then is reported by package_create, see PackageNameTakenError).
+  """
+
+  def __init__(self, app, db_url=None, cache_ttl_seconds=3600, reservation_ttl_seconds=3600):
+    """
+    :param cache_ttl_seconds: how often the set of known names is refreshed from BCDC
+    :param reservation_ttl_seconds: how long a reserved name is held for the request
+      which reserved it
+    """
+    self.app = app
+    self.db_url = db_url
+
+    if db_url:
+      app.config["REDIS_URL"] = db_url
+
+    self._cache_ttl_seconds = cache_ttl_seconds
+    self._reservation_ttl_seconds = reservation_ttl_seconds
+    self._store = FlaskRedis.from_custom_provider(RedisProvider, app)
+    self._reserve_script = self._store.register_script(RESERVE_SCRIPT)
+    self._release_script = self._store.register_script(RELEASE_SCRIPT)
+
+  def reserve(self, name):
+    """
+    Reserves a unique package name.  Returns a tuple (name, reservation token): the
+    preferred name if it is available, otherwise the first available suffixed
+    alternative.  If the registry can't be used (e.g. Redis is unavailable) the
+    preferred name is returned unchecked, with no token.
+    :param name: the preferred name (see bcdc.prepare_package_name)
+    """
+    token = uuid.uuid4().hex
+    try:
+      if self.claim_refresh():
+        threading.Thread(target=self.refresh, kwargs={"timeout": settings.OUTBOUND_TIMEOUT_SECONDS}, daemon=True).start()
+      reserved = self._reserve_script(keys=[KNOWN_NAMES_KEY],
+        args=reserve_args(name, token, self._reservation_ttl_seconds))
+    except redis.exceptions.RedisError as e:
+      self.app.logger.error("Unable to reserve package name in Redis database: '%s'. %s", self.db_url, e)
+      return (name, None)
+    if not reserved:
+      self.app.logger.warning("No unique package name available for '%s'.", name)
+      return (name, None)
+    return (reserved.decode("utf-8") if isinstance(reserved, bytes) else reserved, token)
+
+  def release(self, name, token):
+    """
+    Releases a name reserved by reserve() which was not used (e.g. because
+    package_create failed), so that other requests may choose it
+    """
+    if not token:
+      return
+    try:
+      self._release_script(keys=[reservation_key(name)], args=[token])
+    except redis.exceptions.RedisError as e:
+      self.app.logger.error("Unable to release package name in Redis database: '%s'. %s", self.db_url, e)
+
+  def mark_taken(self, name):
+    """
+    Records that a package with the given name exists (e.g. after it is created, or
+    after BCDC reports that the name is in use)
+    """
+    try:
+      self._store.sadd(KNOWN_NAMES_KEY, name)
+    except redis.exceptions.RedisError as e:
+      self.app.logger.error("Unable to record package name in Redis database: '%s'. %s", self.db_url, e)
+
+  def refresh_if_stale(self):
+    """
+    Refreshes the known names from BCDC if they are older than the cache ttl.  Only
+    one worker refreshes at a time; the others continue to use the previous names.
+    """
+    if self.claim_refresh():
+      self.refresh()
+
+  def claim_refresh(self):
+    """
+    Returns True if the known names are stale and this worker may refresh them (it
+    holds the refresh lock until refresh() completes, or the lock expires)
+    """
+    if self._store.exists(REFRESHED_KEY):
+      return False
+    return bool(self._store.set(REFRESH_LOCK_KEY, 1, nx=True, ex=REFRESH_LOCK_TTL_SECONDS))
+
+  def refresh(self, timeout=None):
+    """
+    Fetches the known names from BCDC.  Call claim_refresh() first.  Errors are
+    logged, and the refresh is retried after the lock expires.
+    """
+    try:
+      names = bcdc.package_list(timeout=timeout)
+      self.app.logger.debug("Refreshed %s package names from BCDC.", len(names))
+    except Exception as e:
+      self.app.logger.warning("Unable to refresh package names from BCDC. %s", e)
+      return
+    try:
+      pipe = self._store.pipeline()
+      for command in add_known_names_commands(names, self._cache_ttl_seconds):
+        pipe.execute_command(*command)
+      pipe.execute()
+    except redis.exceptions.RedisError as e:
+      self.app.logger.error("Unable to save package names in Redis database: '%s'. %s", self.db_url, e)
+
+#------------------------------------------------------------------------------
+# Functions shared with the ASGI application
+#------------------------------------------------------------------------------
+
+def reservation_key(name):
+  return "{}{}".format(RESERVED_KEY_PREFIX, name)
+
+def reserve_args(name, token, ttl_seconds):
+  return [RESERVED_KEY_PREFIX, token, ttl_seconds] + bcdc.package_name_candidates(name, MAX_CANDIDATES)
+
+def add_known_names_commands(names, cache_ttl_seconds, chunk_size=1000):
+  """
+  The Redis commands which add the names fetched from BCDC to the set of known names.
+  Names are never removed from the set, because BCDC keeps the names of deleted 
+  packages until they are purged.
+  """
+  commands = []
+  for i in range(0, len(names), chunk_size):
+    commands.append(["SADD", KNOWN_NAMES_KEY] + names[i:i + chunk_size])
+  commands.append(["SET", REFRESHED_KEY, 1, "EX", cache_ttl_seconds])
+  commands.append(["DEL", REFRESH_LOCK_KEY])
+  return commands
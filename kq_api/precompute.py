@@ -0,0 +1,159 @@
+"""
+Purpose: Speculative work for the verification of API key requests.  Between POST
+/request_key and the click on the verification link there are usually minutes or
+hours, so the slow steps of verification which do not depend on it are run in the
+background as soon as a request is saved.  There is one such step: the content type
+probe of the app's URL, which determines the format of the app's resource.  (The URL
+comes from an unverified request, so the probe only requests public addresses, and
+reads no more than the headers: see url_probe.)  Its
+result is cached alongside the request (see RequestStore.save_precomputed), and
+deleted when the request is verified (see RequestStore.compact_request).
+
+When the request is verified, the cached results are used instead of repeating the
+steps, so the click only waits for package_create and resource_create (and the
+emails).  The work is optional: if a step fails, or the worker is too busy to run
+it, verification runs the step itself, as before.
+
+(The known package names are not refreshed here: PackageNameRegistry refreshes them
+in the background when they are stale, so choosing a name never waits for BCDC.)
+
+The notification emails are not rendered in advance.  Rendering takes well under a
+millisecond, but each body embeds the page stylesheet (about 150 KB), which would
+multiply the memory held per pending request.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+#names of the steps (and of their cached results)
+APP_FORMAT = "app_format"
+
+class Precomputer(object):
+  """
+  Runs the steps for each saved request in a pool of background threads, and saves
+  their results alongside the request
+  """
+
+  def __init__(self, store, steps, enabled=True, workers=2, max_pending=100):
+    """
+    :param store: the RequestStore the results are saved in
+    :param steps: a list of (name, function) tuples.  Each function is called with the
+      request data and returns a result to cache (JSON-serializable) or None.
+    :param max_pending: the most requests waiting for (or in) the pool.  More are not
+      precomputed.
+    """
+    self.store = store
+    self.steps = steps
+    self.enabled = enabled
+    self.workers = workers
+    self.max_pending = max_pending
+    self._pending = 0
+    self._lock = threading.Lock()
+    self._executor = None
+    self._executor_pid = None
+
+  def schedule(self, req_data, verification_code):
+    """
+    Starts precomputing the steps for a saved request.  Returns False if it was not
+    scheduled (disabled, or too many pending).
+    """
+    if not self.enabled or not self._reserve():
+      return False
+    try:
+      self._get_executor().submit(self._run, req_data, verification_code)
+    except RuntimeError as e:
+      self._release()
+      logger.warning("Unable to schedule precomputation. %s", e)
+      return False
+    return True
+
+  def _run(self, req_data, verification_code):
+    try:
+      results = {}
+      for name, step in self.steps:
+        try:
+          add_result(results, name, step(req_data))
+        except Exception as e:
+          logger.warning("Unable to precompute '%s' for a request. %s", name, e)
+      if results:
+        self.store.save_precomputed(verification_code, results)
+    except RuntimeError as e:
+      logger.warning("Unable to save precomputed results. %s", e)
+    finally:
+      self._release()
+
+  def _reserve(self):
+    with self._lock:
+      if self._pending >= self.max_pending:
+        logger.info("Precomputation skipped: %s requests pending.", self._pending)
+        return False
+      self._pending += 1
+      return True
+
+  def _release(self):
+    with self._lock:
+      self._pending -= 1
+
+  def _get_executor(self):
+    #each worker process gets its own threads (not those of a preloading master)
+    with self._lock:
+      if self._executor_pid != os.getpid():
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        self._executor_pid = os.getpid()
+      return self._executor
+
+class AsyncPrecomputer(Precomputer):
+  """
+  A Precomputer whose steps are coroutine functions, each request's steps run by a
+  task on the event loop.  The store is an AsyncRequestStore.
+  """
+
+  def __init__(self, store, steps, enabled=True, max_pending=100):
+    super(AsyncPrecomputer, self).__init__(store, steps, enabled=enabled, max_pending=max_pending)
+    self._tasks = set()
+
+  def schedule(self, req_data, verification_code):
+    if not self.enabled or not self._reserve():
+      return False
+    task = asyncio.ensure_future(self._run_async(req_data, verification_code))
+    self._tasks.add(task)
+    task.add_done_callback(self._tasks.discard)
+    return True
+
+  async def _run_async(self, req_data, verification_code):
+    try:
+      results = {}
+      for name, step in self.steps:
+        try:
+          add_result(results, name, await step(req_data))
+        except Exception as e:
+          logger.warning("Unable to precompute '%s' for a request. %s", name, e)
+      if results:
+        await self.store.save_precomputed(verification_code, results)
+    except RuntimeError as e:
+      logger.warning("Unable to save precomputed results. %s", e)
+    finally:
+      self._release()
+
+  def cancel(self):
+    """
+    Cancels the pending tasks (when the application stops)
+    """
+    for task in list(self._tasks):
+      task.cancel()
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+
+def add_result(results, name, result):
+  if result is not None:
+    results[name] = result
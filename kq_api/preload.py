@@ -0,0 +1,46 @@
+"""
+Purpose: Build the application's immutable state ahead of time.  When gunicorn runs
+with preload enabled (see gunicorn.conf.py) this is done once in the master process,
+before workers are forked, so the workers share the memory copy-on-write instead of
+each building their own copy.
+
+Immutable state: the profanity word list and compiled matcher, the compiled request
+validator, captcha fonts (or glyph atlas), compiled HTML templates, the Bootstrap CSS, and the OpenAPI
+spec.  Sockets and connection pools are not opened here.  The Redis clients only
+connect on first use (and redis-py discards connections inherited across a fork),
+and the async clients are created inside the worker's event loop.
+"""
+import gc
+import time
+
+def warm_up():
+  """
+  Imports the Flask application and builds all its immutable state.  Returns a
+  list of (step, seconds) tuples describing how long each step took.
+  """
+  timings = []
+
+  start = time.time()
+  from . import main
+  timings.append(("import kq_api.main", time.time() - start))
+
+  from . import html_templates
+  start = time.time()
+  html_templates.compile_templates()
+  timings.append(("compile templates and load CSS", time.time() - start))
+
+  start = time.time()
+  main.challenge_store.warm_up()
+  timings.append(("load captcha fonts or build glyph atlas", time.time() - start))
+
+  return timings
+
+def freeze():
+  """
+  Moves all objects that exist now into the garbage collector's permanent generation
+  (Python 3.7+).  The collector then never touches them, so the pages holding them
+  are not copied when a forked worker runs a collection.
+  """
+  gc.collect()
+  if hasattr(gc, "freeze"):
+    gc.freeze()
@@ -0,0 +1,168 @@
+"""
+Purpose: Detect profanity in the free-text fields of an API key request.
+The word list of a ProfanityFilter is compiled once into a single regular
+expression, and all fields of a request are scanned with one search.
+"""
+import re
+import bisect
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+#the user-supplied free-text fields of an API key request which are checked for
+#profanity.  each item is (path, label), where path is a tuple of keys into
+#the request data, and label describes the field in error messages.
+FREE_TEXT_FIELDS = [
+  (("api", "title"), "the API's title"),
+  (("app", "title"), "the application's title"),
+  (("app", "description"), "the application's description"),
+  (("app", "owner", "contact_person", "name"), "the name of the API primary contact person"),
+  (("submitted_by_person", "name"), "the name of the person submitting the request"),
+  (("submitted_by_person", "org_name"), "the organization of the person submitting the request")
+]
+
+#separates fields when they are joined for a single scan.  it is not a word
+#character, so word boundaries at the edges of each field are preserved.
+FIELD_SEPARATOR = "\n"
+
+#same rules as ProfanityFilter for deciding whether a word needs a word boundary
+STARTS_WITH_WORD_CHAR = re.compile(r'^\w')
+ENDS_WITH_WORD_CHAR = re.compile(r'[^\\]\w$')
+RE_ESCAPED_CHAR = re.compile(r'\\(.)')
+
+#key which marks the end of a word in a trie node
+WORD_END = ""
+
+class ProfanityMatcher(object):
+  """
+  Matches text against a list of profane words using one precompiled regular
+  expression.  The words are merged into a prefix tree before being compiled, 
+  so at each position of the text the regex engine only follows branches that
+  match the next character.  Matching is equivalent to ProfanityFilter.is_profane,
+  which instead compiles one regular expression per word on every call.
+  """
+
+  def __init__(self, escaped_words):
+    """
+    :param escaped_words: a list of profane words, already escaped for use in a
+      regular expression (as returned by ProfanityFilter.get_profane_words)
+    """
+    trie = {}
+    for word in set(escaped_words):
+      if not word:
+        continue
+      #the trie is built from unescaped, lower case characters.  the end of each
+      #word is marked with a flag that says whether a word boundary must follow.
+      node = trie
+      for c in RE_ESCAPED_CHAR.sub(r'\1', word).lower():
+        node = node.setdefault(c, {})
+      node[WORD_END] = node.get(WORD_END, True) and bool(ENDS_WITH_WORD_CHAR.search(word))
+
+    #words that start with a word character must also start at a word boundary
+    starts_with_word_char = dict((c, n) for c, n in trie.items() if STARTS_WITH_WORD_CHAR.search(c))
+    others = dict((c, n) for c, n in trie.items() if c not in starts_with_word_char)
+    alternatives = []
+    if starts_with_word_char:
+      alternatives.append(r'\b' + _trie_to_regex(starts_with_word_char))
+    if others:
+      alternatives.append(_trie_to_regex(others))
+
+    #a pattern which never matches, for an empty word list
+    pattern = "|".join(alternatives) or r'(?!x)x'
+    self._regex = re.compile(pattern, re.IGNORECASE)
+
+  @classmethod
+  def from_profanity_filter(cls, profanity_filter):
+    """
+    Creates a matcher with the same word list (including plurals and any custom
+    words) as the given ProfanityFilter.
+    """
+    return cls(profanity_filter.get_profane_words())
+
+  def is_profane(self, text):
+    """
+    Returns True if the text contains any profane words, False otherwise.
+    """
+    if not text:
+      return False
+    return self._regex.search(text) is not None
+
+  def find_profane_field(self, req_data, fields=FREE_TEXT_FIELDS):
+    """
+    Scans all the given fields of the request data in a single pass.  Returns the
+    (path, label) of the first field which contains profanity, or None if no
+    field does.  Missing and non-string fields are skipped.
+    :param req_data: the request data object
+    :param fields: a list of (path, label) tuples.  defaults to FREE_TEXT_FIELDS.
+    """
+    for field in self._scan(req_data, fields):
+      return field
+    return None
+
+  def find_profane_fields(self, req_data, fields=FREE_TEXT_FIELDS):
+    """
+    Like find_profane_field, but returns a list of every field which contains
+    profanity (in the order of 'fields').  The list is empty if no field does.
+    """
+    profane_fields = []
+    for field in self._scan(req_data, fields):
+      if field not in profane_fields:
+        profane_fields.append(field)
+    return profane_fields
+
+  def _scan(self, req_data, fields):
+    """
+    Joins the given fields and scans them with one pass of the regex.  Yields the
+    field of each match, in order.
+    """
+    texts = []
+    scanned_fields = []
+    offsets = []
+    offset = 0
+    for field in fields:
+      value = get_path(req_data, field[0])
+      if not value or not isinstance(value, str):
+        continue
+      texts.append(value)
+      scanned_fields.append(field)
+      offsets.append(offset)
+      offset += len(value) + len(FIELD_SEPARATOR)
+
+    if not texts:
+      return
+
+    for match in self._regex.finditer(FIELD_SEPARATOR.join(texts)):
+      #map the position of the match back to the field it was found in
+      index = bisect.bisect_right(offsets, match.start()) - 1
+      yield scanned_fields[index]
+
+#------------------------------------------------------------------------------
+# Helper functions
+#------------------------------------------------------------------------------
+
+def _trie_to_regex(node):
+  """
+  Converts a trie node into an equivalent regular expression.  Longer words are
+  tried before a word which ends at this node.
+  """
+  alternatives = []
+  for c in sorted(k for k in node if k != WORD_END):
+    alternatives.append(re.escape(c) + _trie_to_regex(node[c]))
+  if WORD_END in node:
+    alternatives.append(r'\b' if node[WORD_END] else "")
+
+  if len(alternatives) == 1:
+    return alternatives[0]
+  return "(?:{})".format("|".join(alternatives))
+
+def get_path(obj, path):
+  """
+  Gets the value at the given path (a tuple of keys) in a hierarchy of 
+  dictionaries, or None if any part of the path is missing.
+  """
+  for key in path:
+    if not isinstance(obj, dict):
+      return None
+    obj = obj.get(key)
+  return obj
@@ -0,0 +1,166 @@
+from flask_redis import FlaskRedis
+import redis
+import hashlib
+import math
+import uuid
+from . import settings
+from .redis_clients import RedisProvider
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+KEY_PREFIX = "rate_limit"
+
+#rule names
+CHALLENGE = "challenge"
+CAPTCHA_IMAGE = "captcha_image"
+REQUEST_KEY = "request_key"
+REQUEST_KEY_PER_EMAIL = "request_key_per_email"
+
+#Sliding window log.  Each key is a sorted set of the times (in ms) of the requests
+#counted against it.  All the keys must have room for the request, otherwise it is
+#not counted against any of them.  The Redis server's clock is used, so that every
+#worker and replica agrees on the time.
+#KEYS: the keys.  ARGV[1]: a unique id for the request.  ARGV[2*i], ARGV[2*i+1]: the
+#limit and window length (ms) of KEYS[i].
+#Returns the number of ms until the request would be allowed (0 if it was allowed).
+SLIDING_WINDOW_SCRIPT = """
+if redis.replicate_commands then
+  redis.replicate_commands()
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local retry_after = 0
+for i, key in ipairs(KEYS) do
+  local limit = tonumber(ARGV[2 * i])
+  local window = tonumber(ARGV[2 * i + 1])
+  redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+  if redis.call('ZCARD', key) >= limit then
+    local oldest = redis.call('ZRANGE', key, -limit, -limit, 'WITHSCORES')
+    retry_after = math.max(retry_after, tonumber(oldest[2]) + window - now, 1)
+  end
+end
+if retry_after > 0 then
+  return retry_after
+end
+for i, key in ipairs(KEYS) do
+  redis.call('ZADD', key, now, ARGV[1])
+  redis.call('PEXPIRE', key, tonumber(ARGV[2 * i + 1]))
+end
+return 0
+"""
+
+class RateLimiter(object):
+  """
+  Limits how often a client may call an endpoint.  Each limit is a named rule
+  (such as "challenge") with a maximum number of requests per sliding window of time.
+  Requests are counted per identity (such as the client's IP address) in Redis, so the
+  limits apply across all workers and replicas.
+  """
+
+  def __init__(self, app, db_url=None, rules=None, enabled=True):
+    """
+    :param rules: a dictionary which maps rule name to a (max requests, window
+      seconds) tuple.  Rules which are missing or None are not enforced.
+    :param enabled: if False, no limits are enforced
+    """
+    self.app = app
+    self.db_url = db_url
+
+    if db_url:
+      app.config["REDIS_URL"] = db_url
+
+    self._rules = rules or {}
+    self._enabled = enabled
+    self._store = FlaskRedis.from_custom_provider(RedisProvider, app)
+    self._script = self._store.register_script(SLIDING_WINDOW_SCRIPT)
+
+  def hit(self, rule_identities):
+    """
+    Counts a request against one or more rules.  The request is only counted if no
+    rule's limit has been reached.
+    :param rule_identities: a list of (rule name, identity) tuples, e.g.
+      [("request_key", "10.0.0.1"), ("request_key_per_email", "a@b.ca")].  Tuples with
+      an empty identity are ignored.
+    :return: 0 if the request is allowed, otherwise the number of seconds until it
+      would be
+    """
+    keys, args = make_script_args(self._rules, rule_identities) if self._enabled else ([], [])
+    if not keys:
+      return 0
+    try:
+      retry_after_ms = self._script(keys=keys, args=args)
+    except redis.exceptions.RedisError as e:
+      #rate limiting is a protection, not a dependency.  if Redis is unavailable the
+      #request is allowed (and the endpoint will report its own Redis errors).
+      self.app.logger.error("Unable to check rate limits in Redis database: '%s'. %s", self.db_url, e)
+      return 0
+    return int(math.ceil(retry_after_ms / 1000.0))
+
+#------------------------------------------------------------------------------
+# Functions shared with the ASGI application
+#------------------------------------------------------------------------------
+
+def rules_from_settings():
+  """
+  The rate limit rules configured in the application settings
+  """
+  return {
+    CHALLENGE: parse_rule(settings.RATE_LIMIT_CHALLENGE),
+    CAPTCHA_IMAGE: parse_rule(settings.RATE_LIMIT_CAPTCHA_IMAGE),
+    REQUEST_KEY: parse_rule(settings.RATE_LIMIT_REQUEST_KEY),
+    REQUEST_KEY_PER_EMAIL: parse_rule(settings.RATE_LIMIT_REQUEST_KEY_PER_EMAIL)
+  }
+
+def parse_rule(value):
+  """
+  Parses a rate limit setting of the form "<max requests>/<window seconds>", e.g.
+  "20/60".  Returns a (max requests, window seconds) tuple, or None if the value is
+  empty or "0" (no limit).  Raises ValueError if the value is not valid.
+  """
+  if not value or value.strip() == "0":
+    return None
+  try:
+    count, seconds = value.split("/")
+    count, seconds = int(count), int(seconds)
+  except ValueError:
+    raise ValueError("Invalid rate limit '{}'.  Expecting <max requests>/<window seconds>".format(value))
+  if count < 1 or seconds < 1:
+    raise ValueError("Invalid rate limit '{}'.  Both values must be positive".format(value))
+  return (count, seconds)
+
+def make_script_args(rules, rule_identities):
+  """
+  Builds the KEYS and ARGV for SLIDING_WINDOW_SCRIPT.  Identities are hashed so that
+  email addresses are not stored.
+  """
+  keys = []
+  args = [uuid.uuid4().hex]
+  for rule_name, identity in rule_identities:
+    rule = rules.get(rule_name)
+    if not rule or not identity:
+      continue
+    count, seconds = rule
+    identity_hash = hashlib.sha1(identity.strip().lower().encode("utf-8")).hexdigest()
+    keys.append("{}:{}:{}".format(KEY_PREFIX, rule_name, identity_hash))
+    args.extend([count, seconds * 1000])
+  return keys, args
+
+def client_ip(remote_addr, forwarded_for, trusted_proxies):
+  """
+  Determines the IP address of the client which sent a request.  Each trusted proxy
+  (e.g. Caddy) appends the address it received the request from to the
+  X-Forwarded-For header, so the client's address is the one added by the outermost
+  trusted proxy.  Addresses to the left of it can be forged by the client and are
+  ignored.
+  :param remote_addr: the address of the peer which connected to this application
+  :param forwarded_for: the value of the X-Forwarded-For header (may be None)
+  :param trusted_proxies: the number of proxies in front of this application
+  """
+  if not trusted_proxies or not forwarded_for:
+    return remote_addr
+  addresses = [a.strip() for a in forwarded_for.split(",") if a.strip()]
+  if not addresses:
+    return remote_addr
+  return addresses[-min(trusted_proxies, len(addresses))]
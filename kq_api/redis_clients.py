@@ -0,0 +1,201 @@
+"""
+Purpose: Creates the Redis clients used by the data stores.  Besides the usual
+redis://, rediss:// and unix:// URLs, two kinds of deployment are supported:
+
+- Redis Sentinel, with a URL of the form
+    redis+sentinel://[:password@]host:port[,host:port...]/service_name[/db]
+  The client asks the sentinels for the current master of the service, and finds
+  the new master after a failover.
+- Client-side sharding (for the challenge store, see CHALLENGE_STORE_SHARD_URLS).
+  Each key is stored on one of several nodes, chosen by consistent hashing, so
+  adding or removing a node moves only the keys of that node.
+"""
+import bisect
+import hashlib
+import redis
+from urllib.parse import unquote
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+SENTINEL_SCHEME = "redis+sentinel://"
+DEFAULT_SENTINEL_PORT = 26379
+
+#points per node on the hash ring.  more points spread keys more evenly.
+VIRTUAL_NODES_PER_SHARD = 160
+
+class RedisProvider(object):
+  """
+  A client class for FlaskRedis.from_custom_provider which also accepts Sentinel URLs
+  """
+
+  @classmethod
+  def from_url(cls, url, **kwargs):
+    return create_client(url, **kwargs)
+
+class ShardRing(object):
+  """
+  A consistent hash ring which maps keys to one of several nodes
+  """
+
+  def __init__(self, node_names, virtual_nodes=VIRTUAL_NODES_PER_SHARD):
+    """
+    :param node_names: a unique name for each node (e.g. its URL).  A node's position
+      on the ring depends only on its name, not its position in the list.
+    """
+    if not node_names:
+      raise ValueError("A shard ring needs at least one node")
+    points = sorted((_hash("{}#{}".format(name, v)), index) for index, name in enumerate(node_names) for v in range(virtual_nodes))
+    self._hashes = [h for h, _ in points]
+    self._indexes = [index for _, index in points]
+
+  def index(self, key):
+    """
+    The index (in node_names) of the node which holds the given key
+    """
+    i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+    return self._indexes[i]
+
+class ShardedRedis(object):
+  """
+  Spreads single-key commands across several Redis nodes.  Only the commands used by
+  the challenge store are supported; commands which involve several keys (such as Lua
+  scripts over related keys) must use an unsharded client.
+  """
+
+  def __init__(self, urls, **kwargs):
+    """
+    :param kwargs: passed to each node's client (e.g. socket_timeout)
+    """
+    self.urls = urls
+    self._clients = [create_client(url, **kwargs) for url in urls]
+    self._ring = ShardRing(urls)
+
+  def client_for(self, key):
+    return self._clients[self._ring.index(key)]
+
+  def get(self, key):
+    return self.client_for(key).get(key)
+
+  def set(self, key, value, **kwargs):
+    return self.client_for(key).set(key, value, **kwargs)
+
+  def delete(self, key):
+    return self.client_for(key).delete(key)
+
+  def ping(self):
+    for client in self._clients:
+      client.ping()
+    return True
+
+  def connection_pools(self):
+    return [client.connection_pool for client in self._clients]
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+
+def create_client(url, **kwargs):
+  """
+  A (synchronous) Redis client for a Redis or Sentinel URL
+  """
+  sentinel = parse_sentinel_url(url)
+  if not sentinel:
+    return redis.StrictRedis.from_url(url, **kwargs)
+  from redis.sentinel import Sentinel
+  return Sentinel(sentinel["sentinels"], **kwargs).master_for(sentinel["service_name"],
+    redis_class=redis.StrictRedis, db=sentinel["db"], password=sentinel["password"])
+
+def create_async_client(url, **kwargs):
+  """
+  A redis.asyncio client for a Redis or Sentinel URL.  Requires redis-py 4.2 or later.
+  """
+  import redis.asyncio
+  sentinel = parse_sentinel_url(url)
+  if not sentinel:
+    return redis.asyncio.Redis.from_url(url, **kwargs)
+  from redis.asyncio.sentinel import Sentinel
+  return Sentinel(sentinel["sentinels"], **kwargs).master_for(sentinel["service_name"],
+    db=sentinel["db"], password=sentinel["password"])
+
+def ping(client):
+  """
+  Checks that a Redis client (or ShardedRedis) can reach its server(s).  Returns the
+  state of its connection pools (see check_connection_pools).  Raises a RedisError
+  if a server can't be reached.
+  """
+  client.ping()
+  return check_connection_pools(client)
+
+async def ping_async(client):
+  """
+  Checks that a redis.asyncio client (or AsyncShardedRedis) can reach its server(s).
+  See ping.
+  """
+  await client.ping()
+  return check_connection_pools(client)
+
+def check_connection_pools(client):
+  """
+  Returns the number of connections in use and idle, and the maximum, across a
+  client's connection pools.  Raises RuntimeError if every connection is in use
+  (further commands would fail or wait for a connection).
+  """
+  if hasattr(client, "connection_pools"):
+    pools = client.connection_pools()
+  else:
+    pools = [client.connection_pool]
+  stats = {"in_use": 0, "idle": 0, "max": 0}
+  for pool in pools:
+    in_use = len(getattr(pool, "_in_use_connections", []))
+    stats["in_use"] += in_use
+    stats["idle"] += len(getattr(pool, "_available_connections", []))
+    stats["max"] += pool.max_connections
+    if in_use >= pool.max_connections:
+      raise RuntimeError("Redis connection pool exhausted ({} connections in use)".format(in_use))
+  return stats
+
+def parse_sentinel_url(url):
+  """
+  Parses a redis+sentinel:// URL.  Returns a dictionary with the sentinels (a list of
+  (host, port) tuples), service_name, db and password, or None if the URL is not a
+  Sentinel URL.  Raises ValueError if the URL is not valid.
+  """
+  if not url or not url.startswith(SENTINEL_SCHEME):
+    return None
+  netloc, _, path = url[len(SENTINEL_SCHEME):].partition("/")
+  password = None
+  if "@" in netloc:
+    credentials, netloc = netloc.rsplit("@", 1)
+    password = unquote(credentials.partition(":")[2]) or None
+
+  sentinels = []
+  for address in netloc.split(","):
+    host, _, port = address.strip().partition(":")
+    if not host:
+      raise ValueError("Invalid Sentinel URL.  Missing a sentinel host.")
+    try:
+      sentinels.append((host, int(port) if port else DEFAULT_SENTINEL_PORT))
+    except ValueError:
+      raise ValueError("Invalid Sentinel URL.  Invalid port '{}'.".format(port))
+
+  parts = [p for p in path.split("/") if p]
+  if not parts or len(parts) > 2:
+    raise ValueError("Invalid Sentinel URL.  Expecting redis+sentinel://host:port[,host:port...]/service_name[/db]")
+  try:
+    db = int(parts[1]) if len(parts) == 2 else 0
+  except ValueError:
+    raise ValueError("Invalid Sentinel URL.  Invalid db '{}'.".format(parts[1]))
+
+  return {
+    "sentinels": sentinels,
+    "service_name": parts[0],
+    "db": db,
+    "password": password
+  }
+
+def _hash(key):
+  if not isinstance(key, bytes):
+    key = str(key).encode("utf-8")
+  return int(hashlib.md5(key).hexdigest()[:8], 16)
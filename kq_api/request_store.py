@@ -1,10 +1,40 @@
 from flask_redis import FlaskRedis
 #from flask_redis import redis
 import redis
+import re
 import uuid
 import json
+import logging
 from . import settings
+from . import json_codec
+from .key_requests import STATUS_KEY
+from .redis_clients import RedisProvider
+from .storage import RedisBackend
+from . import deadlines
 
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+#the status of each request is published on its own channel (followed by its
+#verification code) whenever the request is saved.  see StatusWatcher.
+STATUS_CHANNEL_PREFIX = "kq_status:"
+
+#the results of steps precomputed for a request (see precompute) are saved under this
+#prefix, followed by its verification code
+PRECOMPUTED_KEY_PREFIX = "kq_precomputed:"
+
+#verification codes are random UUIDs (in the canonical form).  other values are never
+#looked up, so a code can't name one of the other keys in the same database (e.g. the
+#lifecycle statistics or precomputed results)
+VERIFICATION_CODE_PATTERN = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+#the status key, as encoded by both JSON codecs (they differ in the whitespace after it)
+STATUS_KEY_JSON = '"{}":'.format(STATUS_KEY)
+
+_decoder = json.JSONDecoder()
+
+logger = logging.getLogger(__name__)
 
 class RequestStore(object):
   """
@@ -12,7 +42,13 @@ class RequestStore(object):
   is assigned a "verification code" which can be used later to access or remove the request.
   """
 
-  def __init__(self, app, db_url=None, default_ttl_seconds=settings.SECONDS_PER_DAY):
+  def __init__(self, app, db_url=None, default_ttl_seconds=settings.SECONDS_PER_DAY, status_ttl_seconds=None, backend=None):
+    """
+    :param status_ttl_seconds: the TTL of compacted (verified) requests.  By default,
+      default_ttl_seconds.
+    :param backend: the StorageBackend in which requests are kept.  By default, the
+      Redis database at db_url.
+    """
 
     self.app = app
     self.db_url = db_url
@@ -21,23 +57,28 @@ class RequestStore(object):
       app.config["REDIS_URL"] = db_url
 
     self._default_ttl_seconds = default_ttl_seconds
-    self._store = FlaskRedis(app)
+    self._status_ttl_seconds = status_ttl_seconds or default_ttl_seconds
+    if not backend:
+      #each command is bounded (redis-py has no per-call timeout for the request's deadline)
+      backend = RedisBackend(FlaskRedis.from_custom_provider(RedisProvider, app, socket_timeout=settings.OUTBOUND_TIMEOUT_SECONDS))
+    self._store = backend
 
   def save_request(self, req_data, verification_code=None, ttl_seconds=None):
     """
     Saves the given API request object to permenant storage.  A new, unique "verification code"
-    is assigned to the request.  The verification code is returned.
+    (a string) is assigned to the request.  The verification code is returned.
     """
     if not verification_code:
-      verification_code = uuid.uuid4()
+      verification_code = str(uuid.uuid4())
     if not ttl_seconds:
       ttl_seconds = self._default_ttl_seconds
     try:
-      #serialize as json then save
-      req_data_as_json = json.dumps(req_data)
-      self._store.set(verification_code, req_data_as_json, ex=ttl_seconds)
-    except redis.exceptions.ConnectionError as e:
-      self.app.logger.error("Unable to connect to Redis database: '{}'.".format(self.db_url))
+      #serialize as json then save.  the status is published in the same round trip
+      #so clients waiting for it to change are notified.
+      req_data_as_json = json_codec.dumps(req_data)
+      self._store.set(verification_code, req_data_as_json, ttl_seconds, notify=status_notification(verification_code, req_data))
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+      self.app.logger.error("Unable to connect to Redis database: '%s'.", self.db_url)
       raise RuntimeError("Unable to connect to Redis database.")
     return verification_code
 
@@ -47,12 +88,139 @@ class RequestStore(object):
     (req_data) object. Otherwise returns None.
     """
     req_data = None
+    if not is_verification_code(verification_code):
+      return None
+    deadlines.check(deadlines.KQ_STORE)
     try:
       #get from redis, then deserialize the json
       req_data_as_json = self._store.get(verification_code)
       if req_data_as_json:
-        req_data = json.loads(req_data_as_json)
-    except redis.exceptions.ConnectionError as e:
-      self.app.logger.error("Unable to connect to Redis database: '{}'.".format(self.db_url))
+        req_data = json_codec.loads(req_data_as_json)
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+      self.app.logger.error("Unable to connect to Redis database: '%s'.", self.db_url)
       raise RuntimeError("Unable to connect to Redis database")
     return req_data
+
+  def load_many(self, verification_codes):
+    """
+    Loads the status of several requests in one round trip.  Returns a dictionary
+    which maps each verification code to the request's status object, or to None if
+    the code is unknown (or the request has no status).
+    """
+    statuses = dict.fromkeys(verification_codes)
+    valid_codes = [code for code in statuses if is_verification_code(code)]
+    if not valid_codes:
+      return statuses
+    deadlines.check(deadlines.KQ_STORE)
+    try:
+      values = self._store.get_many(valid_codes)
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+      self.app.logger.error("Unable to connect to Redis database: '%s'.", self.db_url)
+      raise RuntimeError("Unable to connect to Redis database")
+    statuses.update((code, status_of(value)) for code, value in zip(valid_codes, values))
+    return statuses
+
+  def save_precomputed(self, verification_code, results):
+    """
+    Saves the results of steps precomputed for a request (a dictionary) alongside it.
+    They expire with the request.
+    """
+    try:
+      self._store.set(precomputed_key(verification_code), json_codec.dumps(results), self._default_ttl_seconds)
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+      self.app.logger.error("Unable to connect to Redis database: '%s'.", self.db_url)
+      raise RuntimeError("Unable to connect to Redis database.")
+
+  def load_precomputed(self, verification_code):
+    """
+    The results of steps precomputed for a request, or an empty dictionary if there
+    are none (or they can't be loaded: they are optional)
+    """
+    try:
+      value = self._store.get(precomputed_key(verification_code))
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+      self.app.logger.warning("Unable to load precomputed results from Redis database: '%s'.", self.db_url)
+      return {}
+    return json_codec.loads(value) if value else {}
+
+  def compact_request(self, req_data, verification_code):
+    """
+    Replaces a request which needs no more processing (it has been verified) with just
+    its status, which expires after the status TTL.  The status is all GET /status
+    and verify_key_request read once a request is verified.  The results precomputed
+    for the request are deleted.
+    """
+    verification_code = self.save_request(compact(req_data), verification_code=verification_code, ttl_seconds=self._status_ttl_seconds)
+    try:
+      self._store.delete(precomputed_key(verification_code))
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+      #they expire with the request anyway
+      self.app.logger.warning("Unable to delete precomputed results from Redis database: '%s'.", self.db_url)
+    return verification_code
+
+  def ping(self):
+    """
+    Checks that the store is available.  Returns a dictionary describing its state.
+    Raises a RedisError if the Redis database can't be reached.
+    """
+    return self._store.ping()
+
+#------------------------------------------------------------------------------
+# Functions shared with the ASGI application
+#------------------------------------------------------------------------------
+
+def is_verification_code(value):
+  """
+  Whether a value has the form of a verification code (see VERIFICATION_CODE_PATTERN)
+  """
+  return isinstance(value, str) and VERIFICATION_CODE_PATTERN.fullmatch(value) is not None
+
+def compact(req_data):
+  """
+  The record of a verified request: its status only
+  """
+  return {STATUS_KEY: req_data[STATUS_KEY]}
+
+def status_of(req_data_as_json):
+  """
+  Decodes only the status object of a saved request, or returns None if there is no
+  request (or it has no status).  The status is added to a request after the
+  submitted data, which may contain a key of the same name, and quotes inside
+  strings are escaped, so the last occurrence of the key is the top-level one.  If
+  that fails for any reason, the whole request is decoded.
+  """
+  if not req_data_as_json:
+    return None
+  if isinstance(req_data_as_json, bytes):
+    req_data_as_json = req_data_as_json.decode("utf-8")
+  start = req_data_as_json.rfind(STATUS_KEY_JSON)
+  if start >= 0:
+    start += len(STATUS_KEY_JSON)
+    while req_data_as_json[start:start + 1].isspace():
+      start += 1
+    try:
+      status, _ = _decoder.raw_decode(req_data_as_json, start)
+      if isinstance(status, dict) and "state" in status:
+        return status
+    except ValueError:
+      pass
+  try:
+    return json_codec.loads(req_data_as_json).get(STATUS_KEY)
+  except (ValueError, AttributeError) as e:
+    logger.warning("Unable to decode a saved request. %s", e)
+    return None
+
+def precomputed_key(verification_code):
+  return "{}{}".format(PRECOMPUTED_KEY_PREFIX, verification_code)
+
+def status_channel(verification_code):
+  return "{}{}".format(STATUS_CHANNEL_PREFIX, verification_code)
+
+def status_notification(verification_code, req_data):
+  """
+  The (channel, message) notification published when the request is saved, or None
+  if the request has no status
+  """
+  if not STATUS_KEY in req_data:
+    return None
+  return (status_channel(verification_code), json_codec.dumps(req_data[STATUS_KEY]))
@@ -31,6 +31,17 @@ if not "LOG_LEVEL" in os.environ:
 else:
   LOG_LEVEL = os.environ['LOG_LEVEL']
 
+#"json" (one JSON object per line) or "text"
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json').lower()
+
+#The maximum number of log records waiting to be written.  Records logged while the queue is 
+#full are dropped rather than delaying the request.
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+#The fraction (0 to 1) of requests whose INFO and DEBUG log records are written.  Warnings and
+#errors are always written.
+LOG_INFO_SAMPLE_RATE = float(os.environ.get('LOG_INFO_SAMPLE_RATE', 1.0))
+
 #
 # BC Data Catalog
 #
@@ -119,6 +130,10 @@ else:
 #whether or not is has been verified.
 KQ_STORE_TTL_SECONDS = os.environ.get('KQ_STORE_TTL_SECONDS', 5*SECONDS_PER_DAY)
 
+#The time-to-live (TTL) in seconds of the status of a verified request.  Once a request is verified,
+#only its status is kept (for GET /status), and it is erased when this TTL expires.
+STATUS_TTL_SECONDS = int(os.environ.get('STATUS_TTL_SECONDS', SECONDS_PER_DAY))
+
 #The URL of the Redis database used for captchas
 if not "CAPTCHA_STORE_URL" in os.environ:
   raise ValueError("Missing 'CAPTCHA_STORE_URL' environment variable. Must specify a Redis url.")
@@ -128,6 +143,43 @@ else:
 #The time-to-live (TTL) in seconds for captchas
 CAPTCHA_STORE_TTL_SECONDS = os.environ.get('CAPTCHA_STORE_TTL_SECONDS', 5*SECONDS_PER_DAY)
 
+#Optional.  A space-separated list of Redis (or Sentinel) URLs.  If given, challenges are spread
+#across these nodes by consistent hashing instead of being stored in CAPTCHA_STORE_URL (which still
+#holds the rate limit counters).
+CHALLENGE_STORE_SHARD_URLS = os.environ.get('CHALLENGE_STORE_SHARD_URLS', '').split()
+
+#Where key requests and challenges are stored: 'redis' (the default) or 'memory' (in the memory of
+#the application process).  The memory backend must only be used with a single worker process.
+#The other stores still use Redis (KQ_STORE_URL and CAPTCHA_STORE_URL).
+KQ_STORE_BACKEND = os.environ.get('KQ_STORE_BACKEND', 'redis').lower()
+CAPTCHA_STORE_BACKEND = os.environ.get('CAPTCHA_STORE_BACKEND', 'redis').lower()
+
+#The maximum number of values in each memory store.  When a store is full, the values closest to
+#expiry are evicted.
+MEMORY_STORE_MAX_ITEMS = int(os.environ.get('MEMORY_STORE_MAX_ITEMS', 100000))
+
+#Optional.  A directory in which the memory stores save snapshots (every
+#MEMORY_STORE_SNAPSHOT_INTERVAL_SECONDS and when the worker exits), and from which they are
+#reloaded on start.
+MEMORY_STORE_SNAPSHOT_DIR = os.environ.get('MEMORY_STORE_SNAPSHOT_DIR', '')
+MEMORY_STORE_SNAPSHOT_INTERVAL_SECONDS = int(os.environ.get('MEMORY_STORE_SNAPSHOT_INTERVAL_SECONDS', 60))
+
+#If true, challenge ids are self-contained tokens holding the secret (encrypted and authenticated
+#with CHALLENGE_TOKEN_KEY), so challenges are not stored.  Tokens which have been used are recorded
+#in CAPTCHA_STORE_URL until they expire.
+CHALLENGE_TOKENS_ENABLED = os.environ.get('CHALLENGE_TOKENS_ENABLED', '0').upper() in TRUTH_VALUES
+CHALLENGE_TOKEN_KEY = os.environ.get('CHALLENGE_TOKEN_KEY', '')
+if CHALLENGE_TOKENS_ENABLED and not CHALLENGE_TOKEN_KEY:
+  raise ValueError("Missing 'CHALLENGE_TOKEN_KEY' environment variable. Required when CHALLENGE_TOKENS_ENABLED is set.")
+
+#How captcha images are rendered: 'imagecaptcha' (the captcha package, drawing each image from the
+#fonts) or 'atlas' (composing each image from glyphs pre-rendered at startup, with NumPy).
+CAPTCHA_RENDERER = os.environ.get('CAPTCHA_RENDERER', 'imagecaptcha').lower()
+if CAPTCHA_RENDERER not in ('imagecaptcha', 'atlas'):
+  raise ValueError("Invalid 'CAPTCHA_RENDERER' environment variable. Expecting 'imagecaptcha' or 'atlas'.")
+#The number of distorted variants of each character pre-rendered by the 'atlas' renderer
+CAPTCHA_ATLAS_VARIANTS = int(os.environ.get('CAPTCHA_ATLAS_VARIANTS', 32))
+
 #
 # This API's URL
 #
@@ -138,6 +190,225 @@ if not "KQ_API_URL" in os.environ:
 else:
   KQ_API_URL = os.environ['KQ_API_URL']
 
+#
+# OpenAPI spec (GET /)
+#
+
+#The maximum number of distinct hosts for which a rendered copy of the OpenAPI spec is cached
+API_SPEC_CACHE_MAX_HOSTS = int(os.environ.get('API_SPEC_CACHE_MAX_HOSTS', 16))
+
+#The base URLs (space-separated) for which the rendered spec is cached and precompressed.  The
+#spec is rendered for other hosts (from the Host header) on each request, without precompression.
+API_SPEC_CACHED_URLS = os.environ.get('API_SPEC_CACHED_URLS', KQ_API_URL).split()
+
+#The value of the max-age directive in the Cache-Control header of OpenAPI spec responses
+API_SPEC_MAX_AGE_SECONDS = int(os.environ.get('API_SPEC_MAX_AGE_SECONDS', 300))
+
+#
+# Response compression and static files
+#
+
+#Whether HTML and JSON responses are compressed (gzip or brotli, as negotiated with the client)
+COMPRESS_RESPONSES = os.environ.get('COMPRESS_RESPONSES', '1').upper() in TRUTH_VALUES
+
+#Responses smaller than this number of bytes are not compressed
+COMPRESS_MIN_SIZE_BYTES = int(os.environ.get('COMPRESS_MIN_SIZE_BYTES', 1024))
+
+#If true, web pages link to a fingerprinted copy of the Bootstrap CSS served by this API 
+#(/static/bootstrap.<hash>.css) instead of inlining it.  Emails always inline the CSS.
+LINK_PAGE_CSS = os.environ.get('LINK_PAGE_CSS', '0').upper() in TRUTH_VALUES
+
+#The max-age of the Cache-Control header sent with fingerprinted static files
+STATIC_MAX_AGE_SECONDS = int(os.environ.get('STATIC_MAX_AGE_SECONDS', 365*SECONDS_PER_DAY))
+
+#
+# Duplicate submissions (POST /request_key)
+#
+
+#How long (in seconds) the response to a request with an Idempotency-Key header is remembered.
+#A later request with the same key receives the same response.
+IDEMPOTENCY_KEY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_KEY_TTL_SECONDS', SECONDS_PER_DAY))
+
+#Identical request bodies from the same submitter within this many seconds are treated as
+#duplicates and receive the original response.  0 disables the check.
+DUPLICATE_SUBMISSION_WINDOW_SECONDS = int(os.environ.get('DUPLICATE_SUBMISSION_WINDOW_SECONDS', 600))
+
+#
+# Rate limits (counted in the captcha Redis database)
+#
+
+#Whether rate limits are enforced
+RATE_LIMITS_ENABLED = os.environ.get('RATE_LIMITS_ENABLED', '1').upper() in TRUTH_VALUES
+
+#The number of reverse proxies (e.g. Caddy) in front of this application.  The client's IP
+#address is taken from the X-Forwarded-For entry added by the outermost of them.  0 means
+#X-Forwarded-For is ignored.
+TRUSTED_PROXY_COUNT = int(os.environ.get('TRUSTED_PROXY_COUNT', 1))
+
+#Limits of the form "<max requests>/<window seconds>".  An empty value or 0 means no limit.
+#POST /challenge, per client IP address
+RATE_LIMIT_CHALLENGE = os.environ.get('RATE_LIMIT_CHALLENGE', '20/60')
+#GET /challenge/<challenge_id>.png, per client IP address
+RATE_LIMIT_CAPTCHA_IMAGE = os.environ.get('RATE_LIMIT_CAPTCHA_IMAGE', '40/60')
+#POST /request_key, per client IP address
+RATE_LIMIT_REQUEST_KEY = os.environ.get('RATE_LIMIT_REQUEST_KEY', '20/3600')
+#POST /request_key, per submitter email address (counting only valid requests)
+RATE_LIMIT_REQUEST_KEY_PER_EMAIL = os.environ.get('RATE_LIMIT_REQUEST_KEY_PER_EMAIL', '5/3600')
+
+#
+# Admission control (per worker process)
+#
+
+#Whether the number of concurrent requests to expensive endpoints is limited
+ADMISSION_CONTROL_ENABLED = os.environ.get('ADMISSION_CONTROL_ENABLED', '1').upper() in TRUTH_VALUES
+
+#Limits of the form "<max concurrent>/<max queued>".  Requests beyond both are rejected with
+#HTTP 503.  An empty value or 0 means no limit.
+ADMISSION_LIMIT_REQUEST_KEY = os.environ.get('ADMISSION_LIMIT_REQUEST_KEY', '8/16')
+ADMISSION_LIMIT_VERIFY_KEY_REQUEST = os.environ.get('ADMISSION_LIMIT_VERIFY_KEY_REQUEST', '4/8')
+ADMISSION_LIMIT_CAPTCHA_IMAGE = os.environ.get('ADMISSION_LIMIT_CAPTCHA_IMAGE', '4/16')
+
+#The longest time (in seconds) a queued request waits to be admitted before it is rejected
+ADMISSION_MAX_WAIT_SECONDS = float(os.environ.get('ADMISSION_MAX_WAIT_SECONDS', 5))
+
+#The Retry-After value (in seconds) sent with rejected requests
+ADMISSION_RETRY_AFTER_SECONDS = int(os.environ.get('ADMISSION_RETRY_AFTER_SECONDS', 2))
+
+#
+# Package names
+#
+
+#How often (in seconds) the names of existing BCDC packages are refreshed from BCDC (package_list)
+PACKAGE_NAME_CACHE_TTL_SECONDS = int(os.environ.get('PACKAGE_NAME_CACHE_TTL_SECONDS', 3600))
+
+#How long (in seconds) a package name chosen for a new metadata record is reserved
+PACKAGE_NAME_RESERVATION_TTL_SECONDS = int(os.environ.get('PACKAGE_NAME_RESERVATION_TTL_SECONDS', 3600))
+
+#
+# Admin notification digest
+#
+
+#If true, administrators receive one digest email listing several verified requests instead
+#of one email per request.  Urgent requests (see below) are always sent immediately.
+ADMIN_EMAIL_DIGEST_ENABLED = os.environ.get('ADMIN_EMAIL_DIGEST_ENABLED', '0').upper() in TRUTH_VALUES
+
+#Requests owned by these organizations (BCDC org ids, separated by spaces) are urgent
+ADMIN_EMAIL_URGENT_ORG_IDS = os.environ.get('ADMIN_EMAIL_URGENT_ORG_IDS', '').split()
+
+#Requests with these security classes (separated by spaces, e.g. "HIGH-SENSITIVITY") are urgent
+ADMIN_EMAIL_URGENT_SECURITY_CLASSES = os.environ.get('ADMIN_EMAIL_URGENT_SECURITY_CLASSES', '').split()
+
+#A digest is sent this many seconds after the first request in it was verified...
+ADMIN_EMAIL_DIGEST_INTERVAL_SECONDS = int(os.environ.get('ADMIN_EMAIL_DIGEST_INTERVAL_SECONDS', 3600))
+
+#...or as soon as it lists this many requests
+ADMIN_EMAIL_DIGEST_MAX_ITEMS = int(os.environ.get('ADMIN_EMAIL_DIGEST_MAX_ITEMS', 20))
+
+#
+# Status updates
+#
+
+#The longest time (in seconds) a GET /status request with ?wait=<seconds> and an If-None-Match
+#header is held open waiting for the status to change.  0 disables waiting.
+STATUS_LONG_POLL_MAX_SECONDS = int(os.environ.get('STATUS_LONG_POLL_MAX_SECONDS', 30))
+
+#The most verification codes a POST /status/batch request may look up
+STATUS_BATCH_MAX_CODES = int(os.environ.get('STATUS_BATCH_MAX_CODES', 100))
+
+#
+# Request deadlines
+#
+
+#The time budget (in seconds) of each request.  Outbound calls (BCDC, the app URL probe, SMTP) use
+#the remaining budget as their timeout.  0 means no deadline.
+REQUEST_DEADLINE_SECONDS = float(os.environ.get('REQUEST_DEADLINE_SECONDS', 10))
+REQUEST_DEADLINE_REQUEST_KEY = float(os.environ.get('REQUEST_DEADLINE_REQUEST_KEY', 20))
+REQUEST_DEADLINE_VERIFY_KEY_REQUEST = float(os.environ.get('REQUEST_DEADLINE_VERIFY_KEY_REQUEST', 30))
+#deadlines by route (the name of the view function).  a long-polling GET /status may also wait.
+REQUEST_DEADLINES = {
+  "request_key": REQUEST_DEADLINE_REQUEST_KEY,
+  "verify_key_request": REQUEST_DEADLINE_VERIFY_KEY_REQUEST,
+  "get_status": REQUEST_DEADLINE_SECONDS and REQUEST_DEADLINE_SECONDS + STATUS_LONG_POLL_MAX_SECONDS
+}
+
+#The longest timeout of any one outbound call, and the timeout of calls made outside requests
+OUTBOUND_TIMEOUT_SECONDS = float(os.environ.get('OUTBOUND_TIMEOUT_SECONDS', 10))
+#The longest time (in seconds) the app URL may take to respond to the content type probe
+APP_URL_PROBE_TIMEOUT_SECONDS = float(os.environ.get('APP_URL_PROBE_TIMEOUT_SECONDS', 5))
+#Optional steps (the content type probe) are skipped unless this much of the budget (in seconds)
+#would remain for the steps after them
+DEADLINE_RESERVE_SECONDS = float(os.environ.get('DEADLINE_RESERVE_SECONDS', 10))
+
+#
+# Health checks (GET /readyz)
+#
+
+#How often (in seconds) each worker checks the Redis stores, BCDC and the SMTP server
+HEALTH_CHECK_INTERVAL_SECONDS = int(os.environ.get('HEALTH_CHECK_INTERVAL_SECONDS', 15))
+#How long (in seconds) each check may take
+HEALTH_CHECK_TIMEOUT_SECONDS = int(os.environ.get('HEALTH_CHECK_TIMEOUT_SECONDS', 5))
+#The checks which must pass for the worker to be ready (space separated): kq_store, captcha_store,
+#bcdc, smtp.  The others are reported only.
+HEALTH_REQUIRED_CHECKS = os.environ.get('HEALTH_REQUIRED_CHECKS', 'kq_store captcha_store').split()
+for check in HEALTH_REQUIRED_CHECKS:
+  if check not in ('kq_store', 'captcha_store', 'bcdc', 'smtp'):
+    raise ValueError("Invalid 'HEALTH_REQUIRED_CHECKS' environment variable. Unknown check '{}'.".format(check))
+
+#
+# Verification warm-up
+#
+
+#If true, the slow steps of verification which don't depend on it (the app URL content type probe)
+#run in the background as soon as a request is saved
+PRECOMPUTE_ENABLED = os.environ.get('PRECOMPUTE_ENABLED', '1').upper() in TRUTH_VALUES
+#The number of background threads which run them (per worker process, Flask only)
+PRECOMPUTE_WORKERS = int(os.environ.get('PRECOMPUTE_WORKERS', 2))
+#The most requests waiting for them (per worker process).  Others are not precomputed.
+PRECOMPUTE_MAX_PENDING = int(os.environ.get('PRECOMPUTE_MAX_PENDING', 100))
+
+#
+# Admin routes (/admin/...)
+#
+
+#The key which callers of the admin routes must send as a bearer token ("Authorization: Bearer
+#<key>").  If empty (the default), the admin routes are disabled.
+ADMIN_API_KEY = os.environ.get('ADMIN_API_KEY', '')
+
+#
+# Lifecycle events and statistics (GET /admin/stats)
+#
+
+#If true, submissions, verifications, expiries, new challenges and captcha images are recorded
+#in a Redis Stream (kq_events) and counted per day and per owner organization
+LIFECYCLE_EVENTS_ENABLED = os.environ.get('LIFECYCLE_EVENTS_ENABLED', '1').upper() in TRUTH_VALUES
+#The (approximate) number of events kept in the stream.  Older events are trimmed.
+LIFECYCLE_STREAM_MAX_LENGTH = int(os.environ.get('LIFECYCLE_STREAM_MAX_LENGTH', 100000))
+#How long (in days) the daily statistics are kept.  Also the most days GET /admin/stats reports.
+LIFECYCLE_STATS_RETENTION_DAYS = int(os.environ.get('LIFECYCLE_STATS_RETENTION_DAYS', 400))
+
+#
+# JSON
+#
+
+#The JSON codec used to parse request bodies, encode responses and save requests: "orjson" (used
+#only if it is installed; the json module otherwise) or "json" (the standard library)
+JSON_CODEC = os.environ.get('JSON_CODEC', 'orjson')
+if JSON_CODEC not in ('orjson', 'json'):
+  raise ValueError("Invalid 'JSON_CODEC' environment variable. Expecting 'orjson' or 'json'.")
+
+#
+# Allocation profiling
+#
+
+#If true, allocations are traced with tracemalloc and the memory still held after each request
+#is aggregated by route and source line (GET /admin/allocations).  Slows every request down;
+#for test and soak environments only.
+ALLOCATION_PROFILING_ENABLED = os.environ.get('ALLOCATION_PROFILING_ENABLED', '0').upper() in TRUTH_VALUES
+#The number of stack frames stored per traced allocation
+ALLOCATION_PROFILING_FRAMES = int(os.environ.get('ALLOCATION_PROFILING_FRAMES', 1))
+#The number of allocation sites reported per route
+ALLOCATION_PROFILING_TOP_SITES = int(os.environ.get('ALLOCATION_PROFILING_TOP_SITES', 10))
+
 #
 # Other
 #
@@ -0,0 +1,37 @@
+"""
+Purpose: Static files (such as the Bootstrap CSS) which are read once and served
+many times.  Each asset has a content fingerprint so that it can be published at a
+URL which never changes meaning, and can therefore be cached by clients for a
+long time.
+"""
+import hashlib
+from . import compression
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+FINGERPRINT_LENGTH = 12
+
+class StaticAsset(object):
+  """
+  An in-memory copy of a static file with its fingerprint, ETag and
+  precompressed variants.
+  """
+
+  def __init__(self, filename, name, extension, mimetype):
+    """
+    :param filename: path of the file to load
+    :param name: base of the published file name (e.g. "bootstrap")
+    :param extension: extension of the published file name (e.g. "css")
+    :param mimetype: the mimetype the asset is served with
+    """
+    with open(filename, 'rb') as f:
+      self.body = f.read()
+
+    self.text = self.body.decode("utf-8")
+    self.mimetype = mimetype
+    self.etag = hashlib.sha1(self.body).hexdigest()
+    self.fingerprint = self.etag[:FINGERPRINT_LENGTH]
+    self.published_name = "{}.{}.{}".format(name, self.fingerprint, extension)
+    self.variants = compression.precompress(self.body)
@@ -0,0 +1,175 @@
+"""
+Purpose: Lets GET /status wait for the status of an API key request to change, instead
+of clients polling it repeatedly.  RequestStore publishes a request's status (on a
+Redis pub/sub channel) whenever it saves the request.  Each worker process has one
+listener which subscribes to all status channels and wakes the requests waiting for
+the verification code concerned, so a waiting request holds no Redis connection.
+
+If the listener misses a change (e.g. while it is reconnecting) the waiting request
+simply times out, and the client's next poll receives the current status.
+"""
+from flask_redis import FlaskRedis
+import redis
+import hashlib
+import json
+import os
+import threading
+import time
+from .request_store import STATUS_CHANNEL_PREFIX
+from . import json_codec
+from .redis_clients import RedisProvider
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+#how long the listener waits before reconnecting after an error
+LISTENER_RETRY_SECONDS = 1
+
+class StatusWaiter(object):
+  """
+  A request waiting for the status of one API key request to change
+  """
+
+  def __init__(self, verification_code):
+    self.verification_code = verification_code
+    self.status = None
+    self._event = threading.Event()
+
+  def notify(self, status):
+    self.status = status
+    self._event.set()
+
+  def wait(self, timeout_seconds):
+    """
+    Waits for a status to be published.  Returns the status, or None if none was
+    published before the timeout.
+    """
+    if not self._event.wait(timeout_seconds):
+      return None
+    self._event.clear()
+    return self.status
+
+class StatusWatcher(object):
+  """
+  Dispatches published statuses to the requests waiting for them (in this process)
+  """
+
+  def __init__(self, app, db_url=None, waiter_class=StatusWaiter):
+    self.app = app
+    self.db_url = db_url
+
+    if db_url:
+      app.config["REDIS_URL"] = db_url
+
+    self._store = FlaskRedis.from_custom_provider(RedisProvider, app)
+    self._waiter_class = waiter_class
+    self._waiters = {}
+    self._lock = threading.Lock()
+    self._listener_pid = None
+
+  def watch(self, verification_code):
+    """
+    Registers a waiter for the given verification code.  Register before reading the
+    current status, so that a change made in between is not missed.  Every waiter
+    must be removed with unwatch().
+    """
+    waiter = self._waiter_class(str(verification_code))
+    with self._lock:
+      self._waiters.setdefault(waiter.verification_code, set()).add(waiter)
+    return waiter
+
+  def unwatch(self, waiter):
+    with self._lock:
+      waiters = self._waiters.get(waiter.verification_code)
+      if waiters:
+        waiters.discard(waiter)
+        if not waiters:
+          del self._waiters[waiter.verification_code]
+
+  def dispatch(self, message):
+    """
+    Passes a published status to the requests waiting for it
+    :param message: a pub/sub message (see parse_status_message)
+    """
+    verification_code, status = parse_status_message(message)
+    if verification_code is None:
+      return
+    with self._lock:
+      waiters = list(self._waiters.get(verification_code, []))
+    for waiter in waiters:
+      waiter.notify(status)
+
+  def waiting(self):
+    """
+    The number of requests waiting in this process
+    """
+    with self._lock:
+      return sum(len(waiters) for waiters in self._waiters.values())
+
+  def start_listener(self):
+    """
+    Starts the listener thread of this process (once per process).  Safe to call on
+    every request.
+    """
+    if self._listener_pid == os.getpid():
+      return
+    self._listener_pid = os.getpid()
+    t = threading.Thread(target=self._listen, name="status-listener")
+    t.daemon = True
+    t.start()
+
+  def _listen(self):
+    while True:
+      pubsub = self._store.pubsub(ignore_subscribe_messages=True)
+      try:
+        pubsub.psubscribe(STATUS_CHANNEL_PREFIX + "*")
+        for message in pubsub.listen():
+          self.dispatch(message)
+      except redis.exceptions.RedisError as e:
+        self.app.logger.error("Status listener lost its connection to Redis database: '%s'. %s", self.db_url, e)
+      finally:
+        pubsub.close()
+      time.sleep(LISTENER_RETRY_SECONDS)
+
+#------------------------------------------------------------------------------
+# Functions shared with the ASGI application
+#------------------------------------------------------------------------------
+
+def parse_status_message(message):
+  """
+  Returns a (verification code, status) tuple from a pub/sub message published by
+  RequestStore, or (None, None) if the message isn't a valid status
+  """
+  if message.get("type") not in ("message", "pmessage"):
+    return (None, None)
+  channel = message["channel"]
+  if isinstance(channel, bytes):
+    channel = channel.decode("utf-8")
+  try:
+    status = json_codec.loads(message["data"])
+  except (TypeError, ValueError):
+    return (None, None)
+  return (channel[len(STATUS_CHANNEL_PREFIX):], status)
+
+def status_etag(status):
+  """
+  An ETag which changes whenever the status does
+  """
+  return hashlib.sha1(json.dumps(status, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+def parse_wait_seconds(value, max_seconds):
+  """
+  Parses the 'wait' parameter of GET /status.  Returns the number of seconds to wait
+  (at most max_seconds), or 0 if the value is empty.  Raises ValueError if the value
+  is not a non-negative number.
+  """
+  if not value:
+    return 0
+  try:
+    seconds = float(value)
+  except ValueError:
+    raise ValueError("Invalid 'wait' parameter.  Expecting a number of seconds.")
+  if seconds < 0 or seconds != seconds:
+    raise ValueError("Invalid 'wait' parameter.  Expecting a number of seconds.")
+  return min(seconds, max_seconds)
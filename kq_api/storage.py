@@ -0,0 +1,312 @@
+"""
+Purpose: Storage backends for RequestStore and ChallengeStore.  Both stores only need
+to get, set (with a time-to-live) and delete values by key, so they can keep their
+data in Redis (the default) or in the memory of the application process.
+
+The in-process backend avoids a network round trip per operation of these two
+stores, which suits tests, benchmarks and small single-node deployments.  It does
+not remove the need for Redis: the other stores (rate limits, duplicate submission
+detection, package names, the admin digest, status notifications and lifecycle
+events) still connect to KQ_STORE_URL and CAPTCHA_STORE_URL.  Its data is not shared
+between processes, so it must only be used with a single worker process (gunicorn's
+default).  It can save a snapshot to disk periodically and when the worker process
+exits, and reload it on start, so that requests in progress survive a restart.
+"""
+import atexit
+import heapq
+import logging
+import os
+import pickle
+import threading
+import time
+from . import settings
+from . import redis_clients
+
+logger = logging.getLogger(__name__)
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+REDIS = "redis"
+MEMORY = "memory"
+
+#the expiry heap is rebuilt when it holds this many times more entries than there are
+#keys (overwritten and deleted keys leave stale entries behind)
+HEAP_COMPACTION_FACTOR = 2
+
+class StorageBackend(object):
+  """
+  The operations RequestStore and ChallengeStore need from a key-value store.  Keys
+  are strings (other values are converted with str()).  Values are returned as bytes.
+  """
+
+  def get(self, key):
+    """
+    The value of the key, or None if it does not exist or has expired
+    """
+    raise NotImplementedError()
+
+  def get_many(self, keys):
+    """
+    The values of several keys, in the same order (None for each key which does not
+    exist or has expired)
+    """
+    raise NotImplementedError()
+
+  def set(self, key, value, ttl_seconds, notify=None):
+    """
+    Sets the value of the key, which expires after ttl_seconds
+    :param notify: an optional (channel, message) tuple which is published once the
+      value is saved
+    """
+    raise NotImplementedError()
+
+  def delete(self, key):
+    raise NotImplementedError()
+
+  def ping(self):
+    """
+    Checks that the backend is available.  Returns a dictionary describing its state.
+    Raises an error (e.g. a RedisError) if it is not available.
+    """
+    raise NotImplementedError()
+
+class RedisBackend(StorageBackend):
+  """
+  Stores values in Redis.  Redis errors are raised unchanged.
+  """
+
+  def __init__(self, client):
+    """
+    :param client: a Redis client (e.g. FlaskRedis or ShardedRedis)
+    """
+    self._client = client
+
+  def get(self, key):
+    return self._client.get(key)
+
+  def get_many(self, keys):
+    #one round trip (MGET)
+    return self._client.mget(keys)
+
+  def set(self, key, value, ttl_seconds, notify=None):
+    if not notify:
+      self._client.set(key, value, ex=ttl_seconds)
+      return
+    #the value and the notification are sent in one round trip
+    pipe = self._client.pipeline()
+    pipe.set(key, value, ex=ttl_seconds)
+    pipe.publish(*notify)
+    pipe.execute()
+
+  def delete(self, key):
+    self._client.delete(key)
+
+  def ping(self):
+    return {"backend": REDIS, "connections": redis_clients.ping(self._client)}
+
+class InProcessBackend(StorageBackend):
+  """
+  Stores values in a dictionary in the memory of this process.  Expired values are
+  removed using a heap ordered by expiry time, so each write costs O(log n) and the
+  expired values are removed in amortised O(log n) each.  When the store is full, the
+  values closest to expiry are evicted first.  Thread safe.
+  """
+
+  def __init__(self, name, max_items=100000, snapshot_path=None, snapshot_interval_seconds=60):
+    """
+    :param name: a name for the store, used in log messages
+    :param max_items: the maximum number of values held
+    :param snapshot_path: if given, the values are loaded from this file now, and
+      once start_snapshots() is called (in the worker process), saved to it every
+      snapshot_interval_seconds and when the process exits
+    """
+    self.name = name
+    self.max_items = max_items
+    self.snapshot_path = snapshot_path
+    self.snapshot_interval_seconds = snapshot_interval_seconds
+    self.evicted = 0
+    self._values = {}
+    self._expiry_heap = []
+    self._subscribers = []
+    self._lock = threading.Lock()
+    self._snapshot_pid = None
+    if snapshot_path:
+      self.load_snapshot()
+
+  def get(self, key):
+    key = _key(key)
+    with self._lock:
+      entry = self._values.get(key)
+      if not entry:
+        return None
+      if entry[1] <= time.time():
+        del self._values[key]
+        return None
+      return entry[0]
+
+  def get_many(self, keys):
+    now = time.time()
+    values = []
+    with self._lock:
+      for key in keys:
+        entry = self._values.get(_key(key))
+        values.append(entry[0] if entry and entry[1] > now else None)
+    return values
+
+  def set(self, key, value, ttl_seconds, notify=None):
+    key = _key(key)
+    if isinstance(value, str):
+      value = value.encode("utf-8")
+    now = time.time()
+    expires = now + int(ttl_seconds)
+    with self._lock:
+      self._remove_expired(now)
+      if key not in self._values:
+        while len(self._values) >= self.max_items and self._evict_next():
+          pass
+      self._values[key] = (value, expires)
+      heapq.heappush(self._expiry_heap, (expires, key))
+      if len(self._expiry_heap) > HEAP_COMPACTION_FACTOR * max(len(self._values), 1000):
+        self._compact_heap()
+      subscribers = list(self._subscribers) if notify else []
+    for callback in subscribers:
+      callback({"type": "message", "pattern": None, "channel": notify[0], "data": notify[1]})
+
+  def delete(self, key):
+    with self._lock:
+      self._values.pop(_key(key), None)
+
+  def ping(self):
+    return {"backend": MEMORY, "items": self.size(), "max_items": self.max_items, "evicted": self.evicted}
+
+  def subscribe(self, callback):
+    """
+    Registers a function which is called with each notification published by set().
+    The function receives a message shaped like a Redis pub/sub message.  (Since the
+    data is in this process, subscribers here see every change.)
+    """
+    with self._lock:
+      self._subscribers.append(callback)
+
+  def size(self):
+    with self._lock:
+      return len(self._values)
+
+  def start_snapshots(self):
+    """
+    Starts a background thread (once per process) which saves a snapshot every
+    snapshot_interval_seconds, and saves one when the process exits.  Safe to call on
+    every request.  Only the worker process calls this: with PRELOAD_APP, the master
+    process holds a stale copy of the values, which must not overwrite the worker's
+    snapshot when the master exits.
+    """
+    if not self.snapshot_path or self._snapshot_pid == os.getpid():
+      return
+    self._snapshot_pid = os.getpid()
+    atexit.register(self._save_at_exit, self._snapshot_pid)
+    t = threading.Thread(target=self._save_periodically, name="{}-snapshot".format(self.name))
+    t.daemon = True
+    t.start()
+
+  def save_snapshot(self):
+    """
+    Writes the unexpired values to the snapshot file.  The file is replaced
+    atomically, so a crash while saving leaves the previous snapshot intact.
+    """
+    with self._lock:
+      self._remove_expired(time.time())
+      values = dict(self._values)
+    tmp_path = "{}.tmp".format(self.snapshot_path)
+    with open(tmp_path, "wb") as f:
+      pickle.dump(values, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, self.snapshot_path)
+
+  def load_snapshot(self):
+    """
+    Loads the values saved in the snapshot file (if it exists), except those which
+    have expired since
+    """
+    if not os.path.exists(self.snapshot_path):
+      return
+    with open(self.snapshot_path, "rb") as f:
+      values = pickle.load(f)
+    now = time.time()
+    with self._lock:
+      for key, entry in values.items():
+        if entry[1] > now:
+          self._values[key] = entry
+      self._compact_heap()
+
+  def _save_at_exit(self, pid):
+    #atexit handlers are inherited by forked processes.  only the process which
+    #started the snapshots saves one.
+    if os.getpid() != pid:
+      return
+    try:
+      self.save_snapshot()
+    except (IOError, OSError, pickle.PicklingError) as e:
+      logger.error("Unable to save snapshot of the '%s' memory store to '%s'. %s", self.name, self.snapshot_path, e)
+
+  def _save_periodically(self):
+    while True:
+      time.sleep(self.snapshot_interval_seconds)
+      try:
+        self.save_snapshot()
+      except (IOError, OSError, pickle.PicklingError) as e:
+        #the next attempt may succeed (e.g. after disk space is freed)
+        logger.error("Unable to save snapshot of the '%s' memory store to '%s'. %s", self.name, self.snapshot_path, e)
+
+  def _remove_expired(self, now):
+    heap = self._expiry_heap
+    while heap and heap[0][0] <= now:
+      expires, key = heapq.heappop(heap)
+      entry = self._values.get(key)
+      #skip stale heap entries (the key was overwritten with a later expiry, or deleted)
+      if entry and entry[1] == expires:
+        del self._values[key]
+
+  def _evict_next(self):
+    """
+    Removes the value closest to expiry.  Returns False if there is nothing to evict.
+    """
+    heap = self._expiry_heap
+    while heap:
+      expires, key = heapq.heappop(heap)
+      entry = self._values.get(key)
+      if entry and entry[1] == expires:
+        del self._values[key]
+        self.evicted += 1
+        return True
+    return False
+
+  def _compact_heap(self):
+    self._expiry_heap = [(entry[1], key) for key, entry in self._values.items()]
+    heapq.heapify(self._expiry_heap)
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+
+def backend_from_settings(name, backend_type):
+  """
+  The storage backend of a store, as configured in the application settings: a new
+  InProcessBackend if backend_type is MEMORY, or None if it is REDIS (the store then
+  creates its own Redis client).  The snapshot file (if MEMORY_STORE_SNAPSHOT_DIR is
+  set) is named after the store.  Raises ValueError if backend_type is not valid.
+  """
+  if backend_type == REDIS:
+    return None
+  if backend_type != MEMORY:
+    raise ValueError("Invalid storage backend '{}'.  Expecting '{}' or '{}'.".format(backend_type, REDIS, MEMORY))
+  snapshot_path = None
+  if settings.MEMORY_STORE_SNAPSHOT_DIR:
+    snapshot_path = os.path.join(settings.MEMORY_STORE_SNAPSHOT_DIR, "{}.snapshot".format(name))
+  return InProcessBackend(name, max_items=settings.MEMORY_STORE_MAX_ITEMS, snapshot_path=snapshot_path,
+    snapshot_interval_seconds=settings.MEMORY_STORE_SNAPSHOT_INTERVAL_SECONDS)
+
+def _key(key):
+  if isinstance(key, bytes):
+    return key.decode("utf-8")
+  return key if isinstance(key, str) else str(key)
@@ -0,0 +1,218 @@
+"""
+Purpose: A non-blocking, structured logging pipeline.  Log records are put on an
+in-memory queue by the thread (or greenlet) which logs them, and are formatted and
+written to stderr by a background listener, so request handlers never wait on I/O.
+
+- Records are written as one JSON object per line (or as plain text, see LOG_FORMAT).
+- Messages should use lazy %-style arguments (logger.info("Saved %s", code)).  They
+  are only formatted if the record is enabled, and the formatting happens in the
+  listener when the arguments are immutable.
+- Each record carries the correlation id of the request being processed (see
+  set_correlation_id_getter).
+- Records at INFO level and below may be sampled (LOG_INFO_SAMPLE_RATE).  All
+  records of a sampled request are kept together, since the decision is based on its
+  correlation id.  Warnings and errors are never sampled.
+"""
+import atexit
+import copy
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+JSON = "json"
+TEXT = "text"
+TEXT_FORMAT = "[%(asctime)s] %(levelname)s in %(module)s [%(correlation_id)s]: %(message)s"
+
+#argument types which can't change between logging and formatting
+IMMUTABLE_TYPES = (str, bytes, int, float, bool, type(None))
+
+#attributes of every LogRecord.  other attributes were added with the 'extra'
+#parameter, and are included in the JSON output.
+STANDARD_RECORD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime", "correlation_id"}
+
+_get_correlation_id = lambda: None
+_handler = None
+
+#------------------------------------------------------------------------------
+# Setup
+#------------------------------------------------------------------------------
+
+def configure_logging(level, log_format=JSON, queue_size=10000, info_sample_rate=1.0):
+  """
+  Sends all log records (from the root logger down) through the queue.  Replaces any
+  handlers already on the root logger.
+  :param level: the name of the root logger's level (e.g. "INFO")
+  :param log_format: JSON or TEXT
+  :param queue_size: the maximum number of records waiting to be written.  Records
+    logged while the queue is full are dropped (and counted) rather than blocking.
+  :param info_sample_rate: the fraction (0 to 1) of requests whose INFO and DEBUG
+    records are kept
+  """
+  global _handler
+
+  stream_handler = logging.StreamHandler(sys.stderr)
+  stream_handler.setFormatter(JsonFormatter() if log_format == JSON else logging.Formatter(TEXT_FORMAT))
+
+  _handler = NonBlockingQueueHandler(queue.Queue(queue_size), stream_handler)
+  _handler.addFilter(CorrelationIdFilter())
+  if info_sample_rate < 1:
+    _handler.addFilter(SamplingFilter(info_sample_rate))
+
+  root = logging.getLogger()
+  for h in list(root.handlers):
+    root.removeHandler(h)
+  root.addHandler(_handler)
+  root.setLevel(getattr(logging, level))
+  atexit.register(_handler.stop_listener)
+  return _handler
+
+def set_correlation_id_getter(get_correlation_id):
+  """
+  :param get_correlation_id: a function which returns the correlation id of the
+    request being processed by the caller, or None
+  """
+  global _get_correlation_id
+  _get_correlation_id = get_correlation_id
+
+def new_correlation_id(requested=None):
+  """
+  The correlation id for a new request.  A valid id sent by the client or a proxy
+  (e.g. in an X-Request-ID header) is reused, otherwise a new one is created.
+  """
+  if requested and len(requested) <= 64 and all(c.isalnum() or c in "-_." for c in requested):
+    return requested
+  return "{:016x}".format(random.getrandbits(64))
+
+def stats():
+  """
+  The number of records dropped because the queue was full, and the number waiting
+  """
+  if not _handler:
+    return {}
+  return {"dropped": _handler.dropped, "queued": _handler.queue.qsize()}
+
+#------------------------------------------------------------------------------
+# Handler, filters and formatter
+#------------------------------------------------------------------------------
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+  """
+  Puts records on a bounded queue without waiting.  A listener which writes the
+  records with the given handler is started in each process on first use (so that
+  it also runs in worker processes forked after the handler was created).
+  """
+
+  def __init__(self, q, target_handler):
+    super(NonBlockingQueueHandler, self).__init__(q)
+    self.target_handler = target_handler
+    self.dropped = 0
+    self._listener = None
+    self._listener_pid = None
+
+  def enqueue(self, record):
+    if self._listener_pid != os.getpid():
+      self._start_listener()
+    try:
+      self.queue.put_nowait(record)
+    except queue.Full:
+      self.dropped += 1
+
+  def prepare(self, record):
+    """
+    Prepares a record to be passed to the listener.  Unlike the standard QueueHandler,
+    the message is not formatted here if its arguments are immutable; the listener
+    formats it.  Mutable arguments (which may change before the listener gets to
+    them) and exception tracebacks are formatted now.
+    """
+    record = copy.copy(record)
+    if record.args:
+      if not _all_immutable(record.args):
+        record.msg = record.getMessage()
+        record.args = None
+      elif isinstance(record.args, dict):
+        #a single dictionary argument (for "%(name)s" placeholders) may itself change
+        record.args = dict(record.args)
+    if record.exc_info:
+      record.exc_text = logging.Formatter().formatException(record.exc_info)
+      record.exc_info = None
+    return record
+
+  def stop_listener(self):
+    if self._listener and self._listener_pid == os.getpid():
+      self._listener.stop()
+      self._listener = None
+
+  def _start_listener(self):
+    #a listener inherited from a parent process has no thread in this process
+    self._listener_pid = os.getpid()
+    self._listener = logging.handlers.QueueListener(self.queue, self.target_handler, respect_handler_level=True)
+    self._listener.start()
+
+class CorrelationIdFilter(logging.Filter):
+  """
+  Adds the current request's correlation id to each record
+  """
+
+  def filter(self, record):
+    if not hasattr(record, "correlation_id"):
+      try:
+        record.correlation_id = _get_correlation_id()
+      except Exception:
+        record.correlation_id = None
+    return True
+
+class SamplingFilter(logging.Filter):
+  """
+  Keeps a fraction of INFO and DEBUG records.  Records of the same request are all
+  kept or all dropped.
+  """
+
+  def __init__(self, rate):
+    super(SamplingFilter, self).__init__()
+    self._threshold = int(rate * 0xFFFFFFFF)
+
+  def filter(self, record):
+    if record.levelno > logging.INFO:
+      return True
+    correlation_id = getattr(record, "correlation_id", None)
+    if correlation_id:
+      return int(hashlib.sha1(correlation_id.encode("utf-8")).hexdigest()[:8], 16) <= self._threshold
+    return random.getrandbits(32) <= self._threshold
+
+class JsonFormatter(logging.Formatter):
+  """
+  Formats a record as a single line of JSON.  Attributes added with the 'extra'
+  parameter are included.
+  """
+
+  def format(self, record):
+    entry = {
+      "time": "{}.{:03d}Z".format(time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)), int(record.msecs)),
+      "level": record.levelname,
+      "logger": record.name,
+      "message": record.getMessage(),
+      "correlation_id": getattr(record, "correlation_id", None)
+    }
+    for key, value in record.__dict__.items():
+      if key not in STANDARD_RECORD_ATTRIBUTES:
+        entry[key] = value
+    if record.exc_info and not record.exc_text:
+      record.exc_text = self.formatException(record.exc_info)
+    if record.exc_text:
+      entry["exception"] = record.exc_text
+    return json.dumps(entry, default=str)
+
+def _all_immutable(args):
+  if isinstance(args, dict):
+    args = args.values()
+  return all(isinstance(a, IMMUTABLE_TYPES) for a in args)
@@ -0,0 +1,110 @@
+"""
+Purpose: The content type probe of an app's URL, which determines the format of the
+app's resource.  The URL is supplied by the submitter, and is probed before the
+request is verified (see precompute), so the probe is restricted:
+
+- only http and https URLs whose host resolves to public addresses are requested
+  (not loopback, private, link-local or reserved ones), and each redirect is
+  checked the same way
+- only the response headers are read: the body is never downloaded
+"""
+import asyncio
+import ipaddress
+import logging
+import socket
+from urllib.parse import urljoin, urlsplit
+import httpx
+import requests
+
+logger = logging.getLogger(__name__)
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+SCHEMES = ("http", "https")
+MAX_REDIRECTS = 3
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+
+def get_content_type(url, timeout):
+  """
+  The content type of the given URL, or None if the URL may not be probed, could not
+  be accessed (within timeout seconds) or responded with an error
+  """
+  for _ in range(MAX_REDIRECTS + 1):
+    host, port = _host_and_port(url)
+    if not host or not _is_public(_resolve(host, port)):
+      logger.warning("Refused to probe app URL '%s': not a public http(s) URL.", url)
+      return None
+    try:
+      r = requests.get(url, timeout=timeout, stream=True, allow_redirects=False)
+      r.close()
+    except requests.exceptions.RequestException as e:
+      logger.warning("Unable to access app '%s' to determine content type. %s", url, e)
+      return None
+    if not r.is_redirect:
+      return r.headers.get("content-type") if r.status_code < 400 else None
+    url = urljoin(url, r.headers["location"])
+  return None
+
+async def get_content_type_async(client, url, timeout):
+  """
+  The content type of the given URL.  See get_content_type.
+  :param client: the httpx.AsyncClient to send the requests with
+  """
+  loop = asyncio.get_running_loop()
+  for _ in range(MAX_REDIRECTS + 1):
+    host, port = _host_and_port(url)
+    if not host or not _is_public(await loop.run_in_executor(None, _resolve, host, port)):
+      logger.warning("Refused to probe app URL '%s': not a public http(s) URL.", url)
+      return None
+    try:
+      r = await client.send(client.build_request("GET", url, timeout=timeout), stream=True, follow_redirects=False)
+      await r.aclose()
+    except httpx.HTTPError as e:
+      logger.warning("Unable to access app '%s' to determine content type. %s", url, e)
+      return None
+    if not r.is_redirect:
+      return r.headers.get("content-type") if r.status_code < 400 else None
+    url = urljoin(url, r.headers["location"])
+  return None
+
+#------------------------------------------------------------------------------
+# Helper functions
+#------------------------------------------------------------------------------
+
+def _host_and_port(url):
+  """
+  The host and port of an http(s) URL, or (None, None) for other URLs
+  """
+  try:
+    parts = urlsplit(url)
+    if parts.scheme not in SCHEMES or not parts.hostname:
+      return None, None
+    return parts.hostname, parts.port or (443 if parts.scheme == "https" else 80)
+  except (ValueError, TypeError, AttributeError):
+    return None, None
+
+def _resolve(host, port):
+  try:
+    return [info[4][0] for info in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)]
+  except (socket.gaierror, UnicodeError):
+    return []
+
+def _is_public(addresses):
+  """
+  True if there is at least one address and all of them are public (globally routable)
+  """
+  if not addresses:
+    return False
+  for address in addresses:
+    try:
+      #strip the scope of IPv6 link-local addresses (e.g. 'fe80::1%eth0')
+      if not ipaddress.ip_address(address.split("%")[0]).is_global:
+        return False
+    except ValueError:
+      return False
+  return True
@@ -0,0 +1,298 @@
+"""
+Purpose: Validate the body of an API key request.  The rules are declared in
+REQUEST_SCHEMA and compiled once into a list of checks ordered by cost:
+  1. structure (required fields, string fields, defaults) and profanity - local, cheap
+  2. the captcha challenge - one Redis round trip
+  3. organizations - BCDC round trips
+All local checks run, and every error they find is reported together.  The more
+expensive checks only run if all the cheaper ones passed, so invalid requests
+do not cost any Redis or BCDC round trips.
+"""
+import asyncio
+import inspect
+from . import bcdc
+from .profanity import get_path
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+#check costs.  checks run in this order.
+COST_STRUCTURE = 0
+COST_PROFANITY = 1
+COST_CHALLENGE = 2
+COST_BCDC = 3
+
+#checks with a cost up to this one run even if earlier checks found errors
+MAX_LOCAL_COST = COST_PROFANITY
+
+REQUEST_SCHEMA = {
+  #objects which are created (empty) if missing
+  "objects": [
+    ("api",),
+    ("app",),
+    ("app", "group"),
+    ("app", "owner"),
+    ("app", "security"),
+    ("app", "owner", "contact_person"),
+    ("submitted_by_person",),
+    ("challenge",)
+  ],
+  #required fields, in the order they are reported.  each item is either a path,
+  #or a list of paths of which at least one is required.
+  "required": [
+    ("api", "title"),
+    ("app", "title"),
+    ("app", "description"),
+    ("app", "url"),
+    ("app", "status"),
+    ("app", "owner", "org_id"),
+    ("app", "owner", "contact_person", "name"),
+    ("app", "owner", "contact_person", "business_email"),
+    ("app", "security", "download_audience"),
+    ("app", "security", "view_audience"),
+    ("app", "security", "metadata_visibility"),
+    ("app", "security", "security_class"),
+    ("submitted_by_person", "name"),
+    [("submitted_by_person", "org_id"), ("submitted_by_person", "org_name")],
+    ("submitted_by_person", "business_email"),
+    ("challenge", "id"),
+    ("challenge", "secret")
+  ],
+  #fields which must be strings (if present)
+  "strings": [
+    ("app", "owner", "org_id"),
+    ("app", "owner", "sub_org_id"),
+    ("app", "owner", "contact_person", "org_id"),
+    ("app", "owner", "contact_person", "sub_org_id"),
+    ("submitted_by_person", "org_id"),
+    ("submitted_by_person", "sub_org_id"),
+    ("challenge", "id"),
+    ("challenge", "secret")
+  ],
+  #fields which default to the value of another field.  each item is
+  #(path, path of the default value)
+  "defaults": [
+    (("app", "owner", "contact_person", "org_id"), ("app", "owner", "org_id")),
+    (("app", "owner", "contact_person", "sub_org_id"), ("app", "owner", "sub_org_id"))
+  ],
+  #the challenge id and secret
+  "challenge": (("challenge", "id"), ("challenge", "secret")),
+  #organization ids which are looked up in BCDC.  each item is
+  #(path, key of the organization's name in $.validated, required)
+  "organizations": [
+    (("app", "owner", "org_id"), "owner_org_name", True),
+    (("app", "owner", "sub_org_id"), "owner_sub_org_name", False),
+    (("app", "owner", "contact_person", "org_id"), "owner_contact_org_name", True),
+    (("app", "owner", "contact_person", "sub_org_id"), "owner_contact_sub_org_name", False),
+    (("submitted_by_person", "org_id"), "submitted_by_person_org_name", False),
+    (("submitted_by_person", "sub_org_id"), "submitted_by_person_sub_org_name", False)
+  ],
+  #fields used in place of an organization which is not found in BCDC.  each
+  #item is (key in $.validated, path of the fallback value)
+  "organization_fallbacks": [
+    ("submitted_by_person_org_name", ("submitted_by_person", "org_name"))
+  ]
+}
+
+class ValidationError(ValueError):
+  """
+  Raised when a request is invalid.  The 'errors' attribute is a list of
+  messages, one per problem found.
+  """
+
+  def __init__(self, errors):
+    super(ValidationError, self).__init__("; ".join(errors))
+    self.errors = errors
+
+class RequestValidator(object):
+  """
+  Validates API key requests against a schema.  The schema is compiled into a list
+  of checks when the validator is created.
+  """
+
+  def __init__(self, schema, profanity_matcher, challenge_store):
+    """
+    :param schema: a schema with the same structure as REQUEST_SCHEMA
+    :param profanity_matcher: a ProfanityMatcher used to check free-text fields
+    :param challenge_store: the ChallengeStore used to check the captcha challenge
+    """
+    self._profanity_matcher = profanity_matcher
+    self._challenge_store = challenge_store
+    self._checks = _compile(schema, self)
+
+  def validate(self, req_data):
+    """
+    Cleans and validates the given request data.  Missing objects and defaults are
+    filled in, and the names of the organizations (from BCDC) are added under
+    $.validated.  Returns the cleaned request data.
+    Raises ValidationError listing every problem found, or RuntimeError if a
+    data store or BCDC could not be accessed.
+    """
+    if not isinstance(req_data, dict):
+      req_data = {}
+
+    errors = []
+    context = {}
+    for cost, check in self._checks:
+      if errors and cost > MAX_LOCAL_COST:
+        break
+      check(req_data, errors, context)
+
+    if errors:
+      raise ValidationError(errors)
+    return req_data
+
+  def _check_challenge(self, req_data, errors, challenge_id, secret):
+    if not self._challenge_store.is_valid(challenge_id, secret):
+      errors.append("Captcha challenge failed.")
+
+  def _check_organizations(self, req_data, errors, org_ids, organization_rules, fallback_rules):
+    """
+    Looks up each organization id in BCDC and records the organization names in
+    $.validated.  Each distinct id is only fetched once (the contact person's
+    organization often defaults to the owner's).
+    """
+    organizations = {}
+    for org_id in org_ids:
+      if org_id and org_id not in organizations:
+        organizations[org_id] = bcdc.get_organization(org_id)
+    _record_organizations(req_data, errors, organizations, org_ids, organization_rules, fallback_rules)
+
+class AsyncRequestValidator(RequestValidator):
+  """
+  A RequestValidator for use in an event loop.  The challenge store's is_valid must
+  be a coroutine.  Organizations are fetched from BCDC concurrently.
+  """
+
+  async def validate(self, req_data):
+    """
+    Same as RequestValidator.validate, but a coroutine.
+    """
+    if not isinstance(req_data, dict):
+      req_data = {}
+
+    errors = []
+    context = {}
+    for cost, check in self._checks:
+      if errors and cost > MAX_LOCAL_COST:
+        break
+      result = check(req_data, errors, context)
+      if inspect.isawaitable(result):
+        await result
+
+    if errors:
+      raise ValidationError(errors)
+    return req_data
+
+  async def _check_challenge(self, req_data, errors, challenge_id, secret):
+    if not await self._challenge_store.is_valid(challenge_id, secret):
+      errors.append("Captcha challenge failed.")
+
+  async def _check_organizations(self, req_data, errors, org_ids, organization_rules, fallback_rules):
+    from . import async_bcdc
+    distinct_ids = [org_id for org_id in set(org_ids) if org_id]
+    results = await asyncio.gather(*[async_bcdc.get_organization(org_id) for org_id in distinct_ids])
+    organizations = dict(zip(distinct_ids, results))
+    _record_organizations(req_data, errors, organizations, org_ids, organization_rules, fallback_rules)
+
+#------------------------------------------------------------------------------
+# Schema compilation
+#------------------------------------------------------------------------------
+
+def _compile(schema, validator):
+  """
+  Converts a schema into a list of (cost, check) tuples sorted by cost.  Each check
+  is a function which takes (req_data, errors, context) and appends a message to
+  'errors' for each problem it finds.
+  """
+  checks = []
+
+  objects = [tuple(path) for path in schema.get("objects", [])]
+  def ensure_objects(req_data, errors, context):
+    for path in objects:
+      parent = get_path(req_data, path[:-1])
+      if isinstance(parent, dict) and not parent.get(path[-1]):
+        parent[path[-1]] = {}
+  checks.append((COST_STRUCTURE, ensure_objects))
+
+  required = []
+  for rule in schema.get("required", []):
+    if isinstance(rule, list):
+      paths = [tuple(path) for path in rule]
+      msg = "Missing one of {}".format(" or ".join("'{}'".format(_path_to_str(p)) for p in paths))
+    else:
+      paths = [tuple(rule)]
+      msg = "Missing '{}'".format(_path_to_str(rule))
+    required.append((paths, msg))
+  def check_required(req_data, errors, context):
+    for paths, msg in required:
+      if not any(get_path(req_data, path) for path in paths):
+        errors.append(msg)
+  checks.append((COST_STRUCTURE, check_required))
+
+  strings = [tuple(path) for path in schema.get("strings", [])]
+  def check_strings(req_data, errors, context):
+    for path in strings:
+      value = get_path(req_data, path)
+      if value and not isinstance(value, str):
+        errors.append("Invalid '{}'.  Expecting a string.".format(_path_to_str(path)))
+  checks.append((COST_STRUCTURE, check_strings))
+
+  defaults = [(tuple(path), tuple(default_path)) for path, default_path in schema.get("defaults", [])]
+  def apply_defaults(req_data, errors, context):
+    for path, default_path in defaults:
+      parent = get_path(req_data, path[:-1])
+      if isinstance(parent, dict) and not parent.get(path[-1]):
+        parent[path[-1]] = get_path(req_data, default_path)
+  checks.append((COST_STRUCTURE, apply_defaults))
+
+  def check_profanity(req_data, errors, context):
+    for path, label in validator._profanity_matcher.find_profane_fields(req_data):
+      errors.append("Inappropriate language found in {}.".format(label))
+  checks.append((COST_PROFANITY, check_profanity))
+
+  if schema.get("challenge"):
+    id_path, secret_path = [tuple(path) for path in schema["challenge"]]
+    def check_challenge(req_data, errors, context):
+      challenge_id = get_path(req_data, id_path)
+      secret = get_path(req_data, secret_path)
+      return validator._check_challenge(req_data, errors, challenge_id, secret)
+    checks.append((COST_CHALLENGE, check_challenge))
+
+  organizations = [(tuple(path), key, is_required) for path, key, is_required in schema.get("organizations", [])]
+  fallbacks = [(key, tuple(path)) for key, path in schema.get("organization_fallbacks", [])]
+  def check_organizations(req_data, errors, context):
+    org_ids = [get_path(req_data, path) for path, key, is_required in organizations]
+    return validator._check_organizations(req_data, errors, org_ids, organizations, fallbacks)
+  checks.append((COST_BCDC, check_organizations))
+
+  #sorting is stable, so checks of the same cost keep their declared order
+  checks.sort(key=lambda check: check[0])
+  return checks
+
+#------------------------------------------------------------------------------
+# Helper functions
+#------------------------------------------------------------------------------
+
+def _record_organizations(req_data, errors, organizations, org_ids, organization_rules, fallback_rules):
+  """
+  Adds the names of the given organizations to $.validated, and reports an error
+  for each required organization which was not found.
+  :param organizations: a dictionary which maps org_id to organization (or None)
+  :param org_ids: the org_id found at the path of each organization rule
+  """
+  validated = {}
+  for org_id, (path, key, is_required) in zip(org_ids, organization_rules):
+    org = organizations.get(org_id)
+    if org:
+      validated[key] = org["title"]
+    elif is_required:
+      errors.append("Unknown organization specified in '{}'".format(_path_to_str(path)))
+  for key, path in fallback_rules:
+    if not validated.get(key):
+      validated[key] = get_path(req_data, path)
+  req_data["validated"] = validated
+
+def _path_to_str(path):
+  return "$.{}".format(".".join(path))
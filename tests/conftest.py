@@ -0,0 +1,24 @@
+"""
+Purpose: Settings for the unit tests.  kq_api.settings requires these environment
+variables; the tests do not connect to the servers they name.
+"""
+import os
+
+TEST_ENVIRONMENT = {
+  "BCDC_BASE_URL": "http://localhost:1",
+  "BCDC_API_PATH": "/api/3",
+  "BCDC_API_KEY": "test",
+  "BCDC_PACKAGE_OWNER_ORG_ID": "test-org",
+  "BCDC_PACKAGE_OWNER_SUB_ORG_ID": "test-sub-org",
+  "SMTP_SERVER": "localhost",
+  "SMTP_PORT": "25",
+  "FROM_EMAIL_ADDRESS": "kq@example.com",
+  "FROM_EMAIL_PASSWORD": "test",
+  "TARGET_EMAIL_ADDRESSES": "admin@example.com",
+  "KQ_STORE_URL": "redis://localhost:6379/0",
+  "CAPTCHA_STORE_URL": "redis://localhost:6379/1",
+  "KQ_API_URL": "http://localhost:8000"
+}
+
+for name, value in TEST_ENVIRONMENT.items():
+  os.environ.setdefault(name, value)
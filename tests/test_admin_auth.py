@@ -0,0 +1,37 @@
+"""
+Purpose: Tests of the authentication of the admin routes (admin_auth), and of the
+verification codes which may be looked up in the request store.
+"""
+import uuid
+import pytest
+from kq_api import admin_auth
+from kq_api.request_store import is_verification_code
+from kq_api.lifecycle_events import STREAM_KEY, PENDING_KEY, DAY_KEY_PREFIX
+
+def test_admin_routes_are_disabled_without_key():
+  body, status_code, headers = admin_auth.check("Bearer ", api_key="")
+  assert status_code == 404
+
+def test_admin_key_is_accepted():
+  assert admin_auth.check("Bearer s3cret", api_key="s3cret") is None
+
+@pytest.mark.parametrize("authorization", [None, "", "s3cret", "Basic s3cret", "bearer s3cret"])
+def test_missing_admin_key_is_rejected(authorization):
+  body, status_code, headers = admin_auth.check(authorization, api_key="s3cret")
+  assert status_code == 401
+  assert headers == {"WWW-Authenticate": "Bearer"}
+
+@pytest.mark.parametrize("authorization", ["Bearer ", "Bearer other", "Bearer s3cret2", "Bearer é"])
+def test_wrong_admin_key_is_rejected(authorization):
+  body, status_code, headers = admin_auth.check(authorization, api_key="s3cret")
+  assert status_code == 403
+
+def test_verification_code_is_a_uuid():
+  assert is_verification_code(str(uuid.uuid4()))
+
+@pytest.mark.parametrize("value", [
+  None, "", 123, STREAM_KEY, PENDING_KEY, DAY_KEY_PREFIX + "20000",
+  "kq_precomputed:" + str(uuid.uuid4()), str(uuid.uuid4()) + "\n", str(uuid.uuid4()).upper()
+])
+def test_other_keys_are_not_verification_codes(value):
+  assert not is_verification_code(value)
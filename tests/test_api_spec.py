@@ -0,0 +1,33 @@
+"""
+Purpose: Tests of the cache of rendered OpenAPI specs (ApiSpec)
+"""
+import pytest
+from kq_api.api_spec import ApiSpec
+
+@pytest.fixture
+def spec_file(tmp_path):
+  path = tmp_path / "spec.json"
+  path.write_text('{"servers": [{"url": "${HOST}"}], "padding": "' + "x" * 2000 + '"}')
+  return str(path)
+
+def test_known_host_is_cached_and_precompressed(spec_file):
+  spec = ApiSpec(spec_file, known_hosts=["https://kq.example.com/"])
+  rendered = spec.render("https://kq.example.com")
+  assert b'"url": "https://kq.example.com"' in rendered["body"]
+  assert rendered["variants"]
+  assert spec.render("https://kq.example.com") is rendered
+
+def test_unknown_host_is_not_cached(spec_file):
+  spec = ApiSpec(spec_file, max_hosts=1, known_hosts=["https://kq.example.com"])
+  known = spec.render("https://kq.example.com")
+  for i in range(3):
+    rendered = spec.render("http://other{}.example.com".format(i))
+    assert "other{}".format(i).encode("utf-8") in rendered["body"]
+    assert rendered["variants"] == {}
+  assert spec.render("https://kq.example.com") is known
+
+def test_every_host_is_cached_without_known_hosts(spec_file):
+  spec = ApiSpec(spec_file, max_hosts=1)
+  rendered = spec.render("http://a.example.com")
+  assert rendered["variants"]
+  assert spec.render("http://a.example.com") is rendered
@@ -0,0 +1,30 @@
+"""
+Purpose: Tests of the interpretation of BCDC responses (bcdc)
+"""
+import json
+import pytest
+from kq_api import bcdc
+
+def test_package_create_returns_package():
+  package = bcdc.parse_package_create_response(200, json.dumps({"success": True, "result": {"id": "p1", "name": "app"}}))
+  assert package == {"id": "p1", "name": "app"}
+
+def test_name_in_use_is_reported():
+  text = json.dumps({"success": False, "error": {"name": ["That URL is already in use."], "__type": "Validation Error"}})
+  with pytest.raises(bcdc.PackageNameTakenError):
+    bcdc.parse_package_create_response(409, text)
+
+@pytest.mark.parametrize("error", [
+  ["Must be purely lowercase alphanumeric (ascii) characters and these symbols: -_"],
+  ["Name must be at least 2 characters long"],
+  "Missing value"
+])
+def test_other_name_errors_are_input_errors(error):
+  text = json.dumps({"success": False, "error": {"name": error, "__type": "Validation Error"}})
+  with pytest.raises(ValueError) as e:
+    bcdc.parse_package_create_response(409, text)
+  assert not isinstance(e.value, bcdc.PackageNameTakenError)
+
+def test_server_error_is_a_runtime_error():
+  with pytest.raises(RuntimeError):
+    bcdc.parse_package_create_response(500, "Internal Server Error")
@@ -0,0 +1,193 @@
+"""
+Purpose: Tests of the self-contained challenge tokens (challenge_tokens), and of the
+stores which accept each token once (TokenChallengeStore, AsyncTokenChallengeStore).
+"""
+import asyncio
+import base64
+import time
+import pytest
+import redis
+from flask import Flask
+from kq_api.challenge_tokens import TokenKeys, seal, unseal, token_digest, HEADER_BYTES, TAG_BYTES
+from kq_api.challenge_store import TokenChallengeStore
+from kq_api.async_stores import AsyncTokenChallengeStore
+
+KEYS = TokenKeys("test server key")
+
+class FakeRedis(object):
+  """
+  The part of a Redis client the token stores use.  Raises 'error' (if any) from
+  every command.
+  """
+
+  def __init__(self, error=None):
+    self.values = {}
+    self.error = error
+
+  def set(self, key, value, nx=False, ex=None):
+    if self.error:
+      raise self.error
+    if nx and key in self.values:
+      return None
+    self.values[key] = value
+    return True
+
+class FakeAsyncRedis(FakeRedis):
+
+  async def set(self, key, value, nx=False, ex=None):
+    return FakeRedis.set(self, key, value, nx=nx, ex=ex)
+
+#------------------------------------------------------------------------------
+# Tokens
+#------------------------------------------------------------------------------
+
+def test_unseal_returns_the_secret():
+  token = seal("aB3dE", time.time() + 60, KEYS)
+  assert unseal(token, KEYS) == "aB3dE"
+
+def test_unseal_returns_non_ascii_secret():
+  token = seal("é€😀", time.time() + 60, KEYS)
+  assert unseal(token, KEYS) == "é€😀"
+
+def test_tokens_of_the_same_secret_differ():
+  expires = time.time() + 60
+  assert seal("aB3dE", expires, KEYS) != seal("aB3dE", expires, KEYS)
+
+def test_token_is_urlsafe_without_padding():
+  token = seal("aB3dE", time.time() + 60, KEYS)
+  assert "=" not in token
+  assert all(c.isalnum() or c in "-_" for c in token)
+
+@pytest.mark.parametrize("position", [
+  0,                        #version
+  2,                        #expiry
+  HEADER_BYTES - 1,         #nonce
+  HEADER_BYTES,             #encrypted secret
+  -TAG_BYTES,               #tag
+  -1
+])
+def test_unseal_rejects_altered_token(position):
+  data = bytearray(_decode(seal("aB3dE", time.time() + 60, KEYS)))
+  data[position] ^= 0x01
+  assert unseal(_encode(bytes(data)), KEYS) is None
+
+def test_unseal_rejects_truncated_token():
+  data = _decode(seal("aB3dE", time.time() + 60, KEYS))
+  assert unseal(_encode(data[:-1]), KEYS) is None
+  assert unseal(_encode(data[:HEADER_BYTES + TAG_BYTES]), KEYS) is None
+
+def test_unseal_rejects_expired_token():
+  expires = time.time() + 60
+  token = seal("aB3dE", expires, KEYS)
+  assert unseal(token, KEYS, now=expires - 1) == "aB3dE"
+  assert unseal(token, KEYS, now=expires) is None
+  assert unseal(seal("aB3dE", time.time() - 1, KEYS), KEYS) is None
+
+def test_unseal_rejects_token_of_another_key():
+  token = seal("aB3dE", time.time() + 60, TokenKeys("another server key"))
+  assert unseal(token, KEYS) is None
+
+def test_keys_are_required():
+  with pytest.raises(ValueError):
+    TokenKeys("")
+
+def test_unseal_accepts_padded_token():
+  token = seal("aB3dE", time.time() + 60, KEYS)
+  padded = token + "=" * (-len(token) % 4)
+  assert unseal(padded, KEYS) == "aB3dE"
+  #the same token, so it can't be used again in another form
+  assert token_digest(padded) == token_digest(token)
+
+def test_unseal_accepts_unused_base64_bits():
+  token = seal("aB3dE", time.time() + 60, KEYS)
+  variant = _with_unused_bits_set(token)
+  if variant is None:
+    pytest.skip("the token's length leaves no unused bits")
+  assert variant != token
+  assert unseal(variant, KEYS) == "aB3dE"
+  assert token_digest(variant) == token_digest(token)
+
+@pytest.mark.parametrize("token", [None, "", 123, b"abc", "not base64!", "a", "abcd"])
+def test_unseal_rejects_malformed_token(token):
+  assert unseal(token, KEYS) is None
+
+def test_standard_base64_alphabet_is_not_accepted():
+  #tokens use the URL-safe alphabet.  '+' and '/' are not part of it, although the
+  #decoder would map them to the same bytes.
+  token = seal("aB3dE", time.time() + 60, KEYS)
+  while "-" not in token and "_" not in token:
+    token = seal("aB3dE", time.time() + 60, KEYS)
+  altered = token.replace("-", "+").replace("_", "/")
+  assert unseal(altered, KEYS) is None
+
+@pytest.mark.parametrize("extra", ["!", " ", "\n", "=", "==="])
+def test_unseal_rejects_token_with_other_characters(extra):
+  token = seal("aB3dE", time.time() + 60, KEYS)
+  assert unseal(token[:5] + extra + token[5:], KEYS) is None
+  assert unseal(token + extra * 3, KEYS) is None
+
+#------------------------------------------------------------------------------
+# Stores
+#------------------------------------------------------------------------------
+
+def make_store(error=None):
+  store = TokenChallengeStore(Flask(__name__), db_url="redis://localhost:6379/1", default_ttl_seconds=60, server_key="test server key")
+  store._store = FakeRedis(error)
+  return store
+
+def make_async_store(error=None):
+  store = AsyncTokenChallengeStore("redis://localhost:6379/1", default_ttl_seconds=60, server_key="test server key")
+  store._store = FakeAsyncRedis(error)
+  return store
+
+def test_store_accepts_each_token_once():
+  store = make_store()
+  challenge = store.new_challenge()
+  assert store.is_valid(challenge["challenge_id"], challenge["secret"])
+  assert not store.is_valid(challenge["challenge_id"], challenge["secret"])
+
+def test_store_rejects_wrong_secret_without_using_token():
+  store = make_store()
+  challenge = store.new_challenge()
+  assert not store.is_valid(challenge["challenge_id"], challenge["secret"] + "x")
+  assert store.is_valid(challenge["challenge_id"], challenge["secret"])
+
+def test_store_rejects_token_when_use_cannot_be_recorded():
+  store = make_store(redis.exceptions.ConnectionError("unavailable"))
+  challenge = store.new_challenge()
+  with pytest.raises(RuntimeError):
+    store.is_valid(challenge["challenge_id"], challenge["secret"])
+
+def test_async_store_accepts_each_token_once():
+  store = make_async_store()
+  challenge = asyncio.run(store.new_challenge())
+  assert asyncio.run(store.is_valid(challenge["challenge_id"], challenge["secret"]))
+  assert not asyncio.run(store.is_valid(challenge["challenge_id"], challenge["secret"]))
+
+def test_async_store_rejects_token_when_use_cannot_be_recorded():
+  store = make_async_store(redis.exceptions.TimeoutError("timed out"))
+  challenge = asyncio.run(store.new_challenge())
+  with pytest.raises(RuntimeError):
+    asyncio.run(store.is_valid(challenge["challenge_id"], challenge["secret"]))
+
+#------------------------------------------------------------------------------
+# Helper functions
+#------------------------------------------------------------------------------
+
+def _decode(token):
+  return base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+
+def _encode(data):
+  return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def _with_unused_bits_set(token):
+  """
+  The token with the unused low bits of its last base64 character set, or None if
+  its length leaves no unused bits
+  """
+  unused_bits = {2: 4, 3: 2}.get(len(token) % 4)
+  if not unused_bits:
+    return None
+  alphabet = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
+  last = alphabet.index(token[-1]) | ((1 << unused_bits) - 1)
+  return token[:-1] + alphabet[last]
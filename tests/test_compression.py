@@ -0,0 +1,35 @@
+"""
+Purpose: Tests of the ETags of compressed variants (compression)
+"""
+import pytest
+from kq_api import compression
+
+def test_variant_etag_has_content_coding_suffix():
+  assert compression.encoded_etag("abc", "br") == "abc-br"
+  assert compression.etag_header_with_encoding('"abc"', "gzip") == '"abc-gzip"'
+  assert compression.etag_header_with_encoding('W/"abc"', "br") == 'W/"abc-br"'
+
+@pytest.mark.parametrize("etag", ['"abc"', '"abc-br"', '"abc-gzip"', 'W/"abc-br"', "abc"])
+def test_base_etag(etag):
+  assert compression.base_etag(etag) == "abc"
+
+@pytest.mark.parametrize("if_none_match, etag", [
+  ('"abc"', '"abc"'),
+  ('"abc-br"', '"abc"'),
+  ('"abc"', '"abc-gzip"'),
+  ('"abc-gzip"', '"abc-br"'),
+  ('"x", W/"abc-br"', "abc"),
+  ("*", '"abc"')
+])
+def test_variants_match(if_none_match, etag):
+  assert compression.etags_match(if_none_match, etag)
+
+@pytest.mark.parametrize("if_none_match, etag", [
+  ('"abd"', '"abc"'),
+  ('"abc-deflate"', '"abc"'),
+  (None, '"abc"'),
+  ('"abc"', None),
+  ("", '"abc"')
+])
+def test_other_etags_do_not_match(if_none_match, etag):
+  assert not compression.etags_match(if_none_match, etag)
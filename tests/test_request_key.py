@@ -0,0 +1,112 @@
+"""
+Purpose: Tests of POST /request_key (Flask application) with duplicate submission
+detection: a request is saved and emailed once, and duplicates receive the original
+response.  Redis is replaced by an in-process store; validation and email are
+replaced so no other servers are needed.
+"""
+import json
+import pytest
+import redis
+from benchmarks.json_codec_benchmark import make_req_data
+from kq_api import main
+from kq_api import idempotency_store
+from kq_api.request_store import RequestStore, is_verification_code
+from kq_api.storage import InProcessBackend
+
+class FakeRedis(object):
+  """
+  The part of a Redis client IdempotencyStore uses.  Raises 'error' (if any) when a
+  pipeline is executed.
+  """
+
+  def __init__(self, error=None):
+    self.values = {}
+    self.error = error
+
+  def claim_script(self, keys, args):
+    #see idempotency_store.CLAIM_SCRIPT
+    for i, key in enumerate(keys):
+      if key in self.values:
+        return [i + 1, self.values[key]]
+    for key in keys:
+      self.values[key] = args[0]
+    return [0]
+
+  def pipeline(self):
+    return FakePipeline(self)
+
+  def delete(self, *keys):
+    for key in keys:
+      self.values.pop(key, None)
+
+class FakePipeline(object):
+
+  def __init__(self, client):
+    self.client = client
+    self.commands = []
+
+  def set(self, key, value, ex=None):
+    self.commands.append((key, value))
+
+  def execute(self):
+    if self.client.error:
+      raise self.client.error
+    self.client.values.update(self.commands)
+
+@pytest.fixture
+def sent_emails(monkeypatch):
+  sent_emails = []
+  monkeypatch.setattr(main, "kq_store", RequestStore(main.app, backend=InProcessBackend("test")))
+  monkeypatch.setattr(main.request_validator, "validate", lambda req_data: req_data)
+  monkeypatch.setattr(main.limiter, "hit", lambda rule_identities: None)
+  monkeypatch.setattr(main.lifecycle, "enabled", False)
+  monkeypatch.setattr(main.precomputer, "enabled", False)
+  monkeypatch.setattr(main.health_checker, "start", lambda: None)
+  monkeypatch.setattr(main.status_watcher, "start_listener", lambda: None)
+  monkeypatch.setattr(main, "send_verification_email_to_submitter", lambda req_data, code: sent_emails.append(code))
+  return sent_emails
+
+def use_submission_store(monkeypatch, client):
+  monkeypatch.setattr(main.submission_store, "_store", client)
+  monkeypatch.setattr(main.submission_store, "_claim_script", client.claim_script)
+
+def post(req_data, idempotency_key="key-1"):
+  return main.app.test_client().post("/request_key", data=json.dumps(req_data), headers={"Content-Type": "application/json", "Idempotency-Key": idempotency_key})
+
+def test_duplicate_submission_receives_original_response(monkeypatch, sent_emails):
+  use_submission_store(monkeypatch, FakeRedis())
+  req_data = make_req_data(10)
+
+  first = post(req_data)
+  assert first.status_code == 200
+  code = first.get_json()["verification_code"]
+  assert is_verification_code(code)
+  assert main.kq_store.load_request(code)
+
+  replay = post(req_data)
+  assert replay.status_code == 200
+  assert replay.headers["Idempotent-Replayed"] == "true"
+  assert replay.get_json() == {"verification_code": code}
+  assert sent_emails == [code]
+
+def test_submission_is_released_if_response_cannot_be_recorded(monkeypatch, sent_emails):
+  client = FakeRedis(redis.exceptions.ConnectionError("unavailable"))
+  use_submission_store(monkeypatch, client)
+  req_data = make_req_data(10)
+
+  first = post(req_data)
+  assert first.status_code == 200
+  assert client.values == {}
+  #a retry is processed again, not rejected as in progress
+  assert post(req_data).status_code == 200
+  assert len(sent_emails) == 2
+
+def test_response_which_cannot_be_encoded_releases_claim():
+  client = FakeRedis()
+  store = idempotency_store.IdempotencyStore(main.app, key_ttl_seconds=60, window_seconds=60)
+  store._store = client
+  store._claim_script = client.claim_script
+  submission = store.begin("key-1", make_req_data(10))
+  assert client.values
+  store.complete(submission["claim"], {"verification_code": object()})
+  assert client.values == {}
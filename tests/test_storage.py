@@ -0,0 +1,168 @@
+"""
+Purpose: Tests of the in-process storage backend (InProcessBackend): expiry, eviction
+and snapshots.
+"""
+import atexit
+import os
+import pytest
+from kq_api import storage
+from kq_api.storage import InProcessBackend
+
+class Clock(object):
+  """
+  Replaces time.time in the storage module, so the tests can move time forward
+  """
+
+  def __init__(self, now=1000000.0):
+    self.now = now
+
+  def time(self):
+    return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+  clock = Clock()
+  monkeypatch.setattr(storage.time, "time", clock.time)
+  return clock
+
+#------------------------------------------------------------------------------
+# Expiry
+#------------------------------------------------------------------------------
+
+def test_get_returns_value_until_it_expires(clock):
+  backend = InProcessBackend("test")
+  backend.set("a", "1", 10)
+  assert backend.get("a") == b"1"
+  clock.now += 9
+  assert backend.get("a") == b"1"
+  clock.now += 1
+  assert backend.get("a") is None
+  assert backend.size() == 0
+
+def test_get_many_omits_expired_values(clock):
+  backend = InProcessBackend("test")
+  backend.set("a", b"1", 10)
+  backend.set("b", b"2", 20)
+  clock.now += 15
+  assert backend.get_many(["a", "b", "c"]) == [None, b"2", None]
+
+def test_overwrite_extends_expiry(clock):
+  backend = InProcessBackend("test")
+  backend.set("a", b"1", 10)
+  backend.set("a", b"2", 30)
+  clock.now += 20
+  #the heap entry of the first write is stale and must not remove the new value
+  backend.set("b", b"3", 10)
+  assert backend.get("a") == b"2"
+
+def test_keys_of_any_type_are_the_same_key(clock):
+  backend = InProcessBackend("test")
+  backend.set(b"a", b"1", 10)
+  assert backend.get("a") == b"1"
+  backend.delete(b"a")
+  assert backend.get("a") is None
+
+#------------------------------------------------------------------------------
+# Eviction
+#------------------------------------------------------------------------------
+
+def test_full_store_evicts_value_closest_to_expiry(clock):
+  backend = InProcessBackend("test", max_items=3)
+  backend.set("a", b"1", 30)
+  backend.set("b", b"2", 10)
+  backend.set("c", b"3", 20)
+  backend.set("d", b"4", 40)
+  assert backend.get("b") is None
+  assert backend.get_many(["a", "c", "d"]) == [b"1", b"3", b"4"]
+  assert backend.evicted == 1
+  assert backend.ping()["evicted"] == 1
+
+def test_overwrite_of_full_store_does_not_evict(clock):
+  backend = InProcessBackend("test", max_items=2)
+  backend.set("a", b"1", 10)
+  backend.set("b", b"2", 20)
+  backend.set("a", b"3", 30)
+  assert backend.get_many(["a", "b"]) == [b"3", b"2"]
+  assert backend.evicted == 0
+
+def test_expired_values_are_removed_before_evicting(clock):
+  backend = InProcessBackend("test", max_items=2)
+  backend.set("a", b"1", 10)
+  backend.set("b", b"2", 30)
+  clock.now += 10
+  backend.set("c", b"3", 20)
+  assert backend.get_many(["b", "c"]) == [b"2", b"3"]
+  assert backend.evicted == 0
+
+def test_deleted_values_are_not_counted_as_evicted(clock):
+  backend = InProcessBackend("test", max_items=2)
+  backend.set("a", b"1", 10)
+  backend.delete("a")
+  backend.set("b", b"2", 20)
+  backend.set("c", b"3", 30)
+  assert backend.get_many(["b", "c"]) == [b"2", b"3"]
+  assert backend.evicted == 0
+
+#------------------------------------------------------------------------------
+# Snapshots
+#------------------------------------------------------------------------------
+
+def test_snapshot_round_trip(clock, tmp_path):
+  path = str(tmp_path / "test.snapshot")
+  backend = InProcessBackend("test", snapshot_path=path)
+  backend.set("a", b"1", 10)
+  backend.set("b", b"2", 30)
+  backend.save_snapshot()
+  assert not os.path.exists("{}.tmp".format(path))
+
+  clock.now += 20
+  restored = InProcessBackend("test", snapshot_path=path)
+  assert restored.get_many(["a", "b"]) == [None, b"2"]
+  assert restored.size() == 1
+  #the loaded values expire at the same time as the saved ones
+  clock.now += 10
+  assert restored.get("b") is None
+
+def test_snapshot_omits_expired_values(clock, tmp_path):
+  path = str(tmp_path / "test.snapshot")
+  backend = InProcessBackend("test", snapshot_path=path)
+  backend.set("a", b"1", 10)
+  backend.set("b", b"2", 30)
+  clock.now += 10
+  backend.save_snapshot()
+  restored = InProcessBackend("test", snapshot_path=path)
+  assert restored.size() == 1
+  assert restored.get("b") == b"2"
+
+def test_missing_snapshot_is_not_an_error(tmp_path):
+  backend = InProcessBackend("test", snapshot_path=str(tmp_path / "missing.snapshot"))
+  assert backend.size() == 0
+
+def test_snapshot_is_saved_at_exit_only_after_start_snapshots(monkeypatch, tmp_path):
+  registered = []
+  monkeypatch.setattr(atexit, "register", lambda f, *args: registered.append((f, args)))
+  monkeypatch.setattr(storage.threading.Thread, "start", lambda self: None)
+  path = str(tmp_path / "test.snapshot")
+  backend = InProcessBackend("test", snapshot_path=path)
+  #e.g. the master process with PRELOAD_APP, which never serves requests
+  assert registered == []
+
+  backend.start_snapshots()
+  backend.start_snapshots()
+  assert len(registered) == 1
+  backend.set("a", b"1", 60)
+  f, args = registered[0]
+  f(*args)
+  assert InProcessBackend("test", snapshot_path=path).get("a") == b"1"
+
+def test_snapshot_is_not_saved_at_exit_of_another_process(monkeypatch, tmp_path):
+  registered = []
+  monkeypatch.setattr(atexit, "register", lambda f, *args: registered.append((f, args)))
+  monkeypatch.setattr(storage.threading.Thread, "start", lambda self: None)
+  path = str(tmp_path / "test.snapshot")
+  backend = InProcessBackend("test", snapshot_path=path)
+  backend.start_snapshots()
+  f, args = registered[0]
+  monkeypatch.setattr(storage.os, "getpid", lambda: args[0] + 1)
+  f(*args)
+  assert not os.path.exists(path)
@@ -0,0 +1,88 @@
+"""
+Purpose: Tests of the content type probe of app URLs (url_probe)
+"""
+import asyncio
+import httpx
+import pytest
+import requests
+from kq_api import url_probe
+
+class FakeResponse(object):
+
+  def __init__(self, status_code, headers):
+    self.status_code = status_code
+    self.headers = headers
+    self.is_redirect = "location" in headers
+    self.closed = False
+
+  def close(self):
+    self.closed = True
+
+@pytest.fixture
+def public_dns(monkeypatch):
+  #every host except those named "internal..." resolves to a public address
+  def resolve(host, port):
+    return ["10.0.0.5"] if host.startswith("internal") else ["93.184.216.34"]
+  monkeypatch.setattr(url_probe, "_resolve", resolve)
+
+@pytest.mark.parametrize("url", [
+  "http://127.0.0.1/", "http://[::1]:8080/", "http://169.254.169.254/latest/meta-data/",
+  "http://10.1.2.3/", "http://192.168.0.1/", "http://[::ffff:127.0.0.1]/", "http://localhost/",
+  "file:///etc/passwd", "ftp://example.com/", "not a url", None
+])
+def test_non_public_urls_are_not_requested(monkeypatch, url):
+  monkeypatch.setattr(requests, "get", lambda *args, **kwargs: pytest.fail("requested {}".format(url)))
+  assert url_probe.get_content_type(url, 1) is None
+
+def test_only_headers_are_read(monkeypatch, public_dns):
+  calls = []
+  response = FakeResponse(200, {"content-type": "text/html"})
+  monkeypatch.setattr(requests, "get", lambda url, **kwargs: calls.append(kwargs) or response)
+  assert url_probe.get_content_type("https://app.example.com/", 1) == "text/html"
+  assert calls == [{"timeout": 1, "stream": True, "allow_redirects": False}]
+  assert response.closed
+
+def test_error_response_has_no_content_type(monkeypatch, public_dns):
+  monkeypatch.setattr(requests, "get", lambda url, **kwargs: FakeResponse(404, {"content-type": "text/html"}))
+  assert url_probe.get_content_type("https://app.example.com/", 1) is None
+
+def test_redirects_are_checked(monkeypatch, public_dns):
+  responses = {
+    "https://app.example.com/": FakeResponse(302, {"location": "/home"}),
+    "https://app.example.com/home": FakeResponse(301, {"location": "http://internal.example.com/"})
+  }
+  requested = []
+  monkeypatch.setattr(requests, "get", lambda url, **kwargs: requested.append(url) or responses[url])
+  assert url_probe.get_content_type("https://app.example.com/", 1) is None
+  assert requested == ["https://app.example.com/", "https://app.example.com/home"]
+
+def test_redirects_are_limited(monkeypatch, public_dns):
+  monkeypatch.setattr(requests, "get", lambda url, **kwargs: FakeResponse(302, {"location": url + "x"}))
+  assert url_probe.get_content_type("https://app.example.com/", 1) is None
+
+def test_async_probe_refuses_loopback_url():
+  class Client(object):
+    def build_request(self, *args, **kwargs):
+      pytest.fail("requested")
+  assert asyncio.run(url_probe.get_content_type_async(Client(), "http://127.0.0.1:8000/", 1)) is None
+
+def test_async_probe_follows_public_redirects(public_dns):
+  def handle(request):
+    if request.url.path == "/":
+      return httpx.Response(302, headers={"location": "/home"})
+    return httpx.Response(200, headers={"content-type": "application/json"}, content=b"{}")
+  async def probe():
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handle)) as client:
+      return await url_probe.get_content_type_async(client, "https://app.example.com/", 1)
+  assert asyncio.run(probe()) == "application/json"
+
+def test_async_probe_refuses_redirect_to_internal_host(public_dns):
+  requested = []
+  def handle(request):
+    requested.append(str(request.url))
+    return httpx.Response(302, headers={"location": "http://internal.example.com/"})
+  async def probe():
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handle)) as client:
+      return await url_probe.get_content_type_async(client, "https://app.example.com/", 1)
+  assert asyncio.run(probe()) is None
+  assert requested == ["https://app.example.com/"]